@@ -0,0 +1,238 @@
+"""
+Batch mode: runs a JSONL file of queries through the search + LLM pipeline.
+
+Usage: python batch_runner.py input.jsonl output.jsonl [--concurrency 8] [--search-rps 2] [--llm-rps 4] [--test-mode]
+
+Requests to each upstream go through the shared rate_limiter limiters; the
+--search-rps / --llm-rps flags override their PERPLEXITY_RPM / ANTHROPIC_RPM rates.
+
+Rows already present in the output file are skipped, so an interrupted run
+is resumed by starting the same command again. Rows whose last record has an
+error (including Claude or search being unavailable) are processed again and
+appended, so the last record for an id is the current one.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+from utils import process_input, needs_search, combine_input, format_output
+from search_api import asearch_perplexity
+from llm_api import aquery_llm, is_error_response
+from http_client import aclose_clients, PERPLEXITY, ANTHROPIC
+from rate_limiter import get_limiter, queue_wait
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '8'))
+
+
+def read_rows(path, field="query", id_field="id"):
+    """
+    Читает запросы из JSONL-файла построчно, не загружая его целиком.
+
+    Args:
+        path (str): Путь к входному файлу
+        field (str): Поле с текстом запроса
+        id_field (str): Поле с идентификатором строки; без него идентификатором служит номер строки
+
+    Yields:
+        tuple: (идентификатор строки, текст запроса)
+    """
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Строка {line_number} файла {path} не является JSON, пропускаю")
+                continue
+            row_id = str(row.get(id_field, line_number))
+            yield row_id, row.get(field) or ""
+
+
+def load_checkpoint(path):
+    """
+    Находит успешно обработанные строки в выходном файле и отрезает незавершенную последнюю запись.
+
+    Строки, последняя запись которых содержит ошибку, в результат не входят: при
+    возобновлении они обрабатываются заново.
+
+    Args:
+        path (str): Путь к выходному файлу
+
+    Returns:
+        set: Идентификаторы обработанных без ошибок строк
+    """
+    errors = {}
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'rb+') as f:
+        data = f.read()
+        # Запись, оборванная при сбое, не заканчивается переводом строки
+        complete = data.rfind(b'\n') + 1
+        if complete < len(data):
+            logger.warning(f"Отрезаю незавершенную запись в конце {path}")
+            f.truncate(complete)
+    for line in data[:complete].decode('utf-8').splitlines():
+        try:
+            record = json.loads(line)
+            errors[str(record["id"])] = record.get("error") is not None
+        except (json.JSONDecodeError, KeyError):
+            continue
+    return {row_id for row_id, failed in errors.items() if not failed}
+
+
+async def process_row(row_id, query, test_mode=False):
+    """
+    Обрабатывает один запрос так же, как /api/query: поиск при необходимости и ответ Claude.
+
+    Args:
+        row_id (str): Идентификатор строки
+        query (str): Текст запроса
+        test_mode (bool): Тестовый режим без обращения к API
+
+    Returns:
+        dict: Строка результата с ответом, источниками и временем этапов в секундах;
+            wait - часть времени search и llm, проведенная в очередях ограничителей;
+            error - текст ошибки, если Claude ответил ошибкой или поиск по части
+            подзапросов не удался (ответ по остальным при этом сохраняется)
+    """
+    start = time.perf_counter()
+    waits = []
+    queue_wait.set(waits)
+    timings = {"wait": 0.0, "search": 0.0, "llm": 0.0}
+    record = {"id": row_id, "query": query, "response": None, "search_performed": False, "sources": [], "error": None}
+    try:
+        processed_input = process_input(query)
+        if not processed_input:
+            raise ValueError("пустой запрос")
+
+        search_results = None
+        if needs_search(processed_input):
+            stage_start = time.perf_counter()
+            search_results = await asearch_perplexity(processed_input, test_mode=test_mode)
+            timings["search"] = time.perf_counter() - stage_start
+        record["search_performed"] = bool(search_results)
+        record["sources"] = search_results.sources if search_results else []
+        if search_results is not None and search_results.failed:
+            record["error"] = f"поиск не удался для подзапросов: {', '.join(search_results.failed)}"
+            logger.warning(f"Строка {row_id}: {record['error']}")
+
+        llm_input = combine_input(processed_input, search_results)
+        stage_start = time.perf_counter()
+        response = await aquery_llm(llm_input, test_mode=test_mode)
+        timings["llm"] = time.perf_counter() - stage_start
+        # aquery_llm не бросает исключений, а возвращает текст ошибки
+        if is_error_response(response):
+            raise RuntimeError(response)
+        record["response"] = format_output(response)
+    except Exception as e:
+        logger.error(f"Ошибка обработки строки {row_id}: {e}")
+        record["error"] = str(e)
+
+    timings["wait"] = sum(waits)
+    timings["total"] = time.perf_counter() - start
+    record["timings"] = {stage: round(seconds, 3) for stage, seconds in timings.items()}
+    return record
+
+
+async def run_batch(input_path, output_path, concurrency=DEFAULT_CONCURRENCY, search_rps=None,
+                    llm_rps=None, test_mode=False, field="query", id_field="id"):
+    """
+    Прогоняет JSONL-файл запросов через конвейер с ограниченной параллельностью.
+
+    Результаты дописываются в выходной файл по мере готовности (в порядке завершения),
+    каждая строка сбрасывается на диск сразу, поэтому выходной файл служит контрольной точкой.
+
+    Args:
+        input_path (str): Входной JSONL-файл
+        output_path (str): Выходной JSONL-файл
+        concurrency (int): Число одновременно обрабатываемых строк
+        search_rps (float, optional): Запросов к Perplexity в секунду (0 - без ограничения, None - из PERPLEXITY_RPM)
+        llm_rps (float, optional): Запросов к Claude в секунду (0 - без ограничения, None - из ANTHROPIC_RPM)
+        test_mode (bool): Тестовый режим без обращения к API
+        field (str): Поле с текстом запроса
+        id_field (str): Поле с идентификатором строки
+
+    Returns:
+        dict: Сводка: обработано, пропущено, ошибок, время, строк в секунду, p50/p95 времени строки
+    """
+    done = load_checkpoint(output_path)
+    if search_rps is not None:
+        get_limiter(PERPLEXITY).configure(rate=search_rps)
+    if llm_rps is not None:
+        get_limiter(ANTHROPIC).configure(rate=llm_rps)
+    # Очередь ограничена, чтобы большой файл не читался в память целиком
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    totals, errors, skipped = [], 0, 0
+    start = time.perf_counter()
+
+    with open(output_path, 'a', encoding='utf-8') as output:
+        async def worker():
+            nonlocal errors
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                record = await process_row(*item, test_mode=test_mode)
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+                totals.append(record["timings"]["total"])
+                errors += record["error"] is not None
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        try:
+            for row_id, query in read_rows(input_path, field, id_field):
+                if row_id in done:
+                    skipped += 1
+                    continue
+                done.add(row_id)
+                await queue.put((row_id, query))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await aclose_clients()
+
+    elapsed = time.perf_counter() - start
+    totals.sort()
+    return {
+        "processed": len(totals),
+        "skipped": skipped,
+        "errors": errors,
+        "elapsed": round(elapsed, 2),
+        "rows_per_second": round(len(totals) / elapsed, 2) if elapsed else 0.0,
+        "p50": totals[len(totals) // 2] if totals else 0.0,
+        "p95": totals[int(len(totals) * 0.95)] if totals else 0.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Пакетная обработка JSONL-файла запросов")
+    parser.add_argument("input", help="Входной JSONL-файл, по одному запросу в строке")
+    parser.add_argument("output", help="Выходной JSONL-файл; уже обработанные строки пропускаются")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Число одновременно обрабатываемых строк")
+    parser.add_argument("--search-rps", type=float, help="Запросов к Perplexity в секунду (0 - без ограничения, по умолчанию PERPLEXITY_RPM)")
+    parser.add_argument("--llm-rps", type=float, help="Запросов к Claude в секунду (0 - без ограничения, по умолчанию ANTHROPIC_RPM)")
+    parser.add_argument("--field", default="query", help="Поле с текстом запроса")
+    parser.add_argument("--id-field", default="id", help="Поле с идентификатором строки (по умолчанию номер строки)")
+    parser.add_argument("--test-mode", action="store_true", help="Тестовый режим без обращения к API")
+    args = parser.parse_args(argv)
+
+    summary = asyncio.run(run_batch(args.input, args.output, args.concurrency, args.search_rps, args.llm_rps,
+                                    args.test_mode, args.field, args.id_field))
+    print(f"Обработано: {summary['processed']}, пропущено: {summary['skipped']}, ошибок: {summary['errors']}")
+    print(f"Время: {summary['elapsed']} с, {summary['rows_per_second']} строк/с, "
+          f"p50 / p95 строки: {summary['p50']} / {summary['p95']} с")
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
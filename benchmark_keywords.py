@@ -0,0 +1,83 @@
+"""
+Microbenchmark: precompiled keyword engine vs per-call keyword list scans.
+
+Usage: python benchmark_keywords.py [iterations]
+"""
+import sys
+import time
+import search_api
+import llm_api
+import utils
+import search_classifier
+
+QUERIES = [
+    "Какая погода в Москве сегодня",
+    "Рыночная капитализация Apple и курс биткоина на сегодняшний день",
+    "Топ 5 крупнейших компаний мира по капитализации на 2024 год",
+    "Что такое фотосинтез и почему листья зеленые",
+    "Последние новости о запусках SpaceX. Также расскажи про акции Tesla",
+    "Привет! Что ты умеешь и чем можешь помочь?",
+    "Напиши функцию сортировки на Python с примерами и объяснением сложности алгоритма",
+    "Курс доллара, евро и юаня к рублю по данным ЦБ, прогноз на следующую неделю",
+]
+
+ENGINES = {
+    "search_api.TOPIC_KEYWORDS": search_api.TOPIC_KEYWORDS,
+    "search_api.TEST_RESPONSE_KEYWORDS": search_api.TEST_RESPONSE_KEYWORDS,
+    "llm_api.TEST_RESPONSE_KEYWORDS": llm_api.TEST_RESPONSE_KEYWORDS,
+    "utils.QUERY_MARKERS": utils.QUERY_MARKERS,
+}
+
+
+def list_scan(keywords, text):
+    """Прежний способ: any(word in text.lower() ...) с приведением регистра на каждое слово."""
+    return {category for category, words in keywords.items() if any(word in text.lower() for word in words)}
+
+
+def list_scan_lowered(keywords, text):
+    """Прежний способ в лучшем случае: регистр приводится один раз, списки перебираются по очереди."""
+    text = text.lower()
+    return {category for category, words in keywords.items() if any(word in text for word in words)}
+
+
+def per_query_us(func, iterations):
+    """Среднее время одного вызова func(query) в микросекундах по всем запросам набора."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for query in QUERIES:
+            func(query)
+    return (time.perf_counter() - start) / (iterations * len(QUERIES)) * 1e6
+
+
+def main(iterations=2000):
+    """Печатает время на запрос для каждого набора ключевых слов и для функций, которые их используют."""
+    print(f"{'набор ключевых слов':38} {'слов':>5} {'списки, мкс':>12} {'lower 1 раз':>12} {'движок, мкс':>12} {'ускорение':>10}")
+    total_lists = total_lowered = total_engine = 0.0
+    for name, engine in ENGINES.items():
+        # Результаты обоих способов должны совпадать
+        for query in QUERIES:
+            assert engine.match(query) == list_scan(engine.keywords, query), (name, query)
+        words = sum(len(words) for words in engine.keywords.values())
+        lists_us = per_query_us(lambda query: list_scan(engine.keywords, query), iterations)
+        lowered_us = per_query_us(lambda query: list_scan_lowered(engine.keywords, query), iterations)
+        engine_us = per_query_us(engine.match, iterations)
+        total_lists += lists_us
+        total_lowered += lowered_us
+        total_engine += engine_us
+        print(f"{name:38} {words:>5} {lists_us:>12.2f} {lowered_us:>12.2f} {engine_us:>12.2f} {lists_us / engine_us:>9.1f}x")
+    print(f"{'итого на запрос':38} {'':>5} {total_lists:>12.2f} {total_lowered:>12.2f} {total_engine:>12.2f} {total_lists / total_engine:>9.1f}x")
+
+    print()
+    functions = {
+        "search_api.split_complex_query": search_api.split_complex_query,
+        "search_api.enhance_query": search_api.enhance_query,
+        "search_api.generate_test_response": search_api.generate_test_response,
+        "llm_api.generate_test_response": llm_api.generate_test_response,
+        "search_classifier.classify_search_need": search_classifier.classify_search_need,
+    }
+    for name, func in functions.items():
+        print(f"{name:38} {per_query_us(func, iterations):>8.2f} мкс/запрос")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,262 @@
+"""
+Per-upstream circuit breakers that fail fast while Perplexity or Claude is down.
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import asynccontextmanager
+from http_client import PERPLEXITY, ANTHROPIC
+from rate_limiter import get_limiter
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Ответ дольше этого времени считается медленным; по умолчанию - треть прежнего таймаута
+_DEFAULT_SLOW_CALL = {PERPLEXITY: 20, ANTHROPIC: 15}
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    """Запрос не отправлен: автомат сервиса разомкнут."""
+
+    def __init__(self, name, retry_in):
+        super().__init__(f"{name} временно недоступен, повторная проверка через {retry_in:.0f} сек.")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Автомат для одного внешнего сервиса.
+
+    В замкнутом состоянии запоминает исходы последних window вызовов. Если среди них
+    не меньше min_calls и доля ошибок (5xx, 529, сетевые ошибки, таймауты) или медленных
+    ответов достигает failure_rate, автомат размыкается: вызовы сразу получают
+    CircuitOpenError, не дожидаясь таймаута. Через open_seconds автомат полуоткрыт и
+    пропускает до half_open_calls пробных вызовов: если они успешны, автомат замыкается,
+    если хотя бы один неудачен - снова размыкается.
+
+    Ответы 429 обрабатывает ограничитель запросов, а 4xx - ошибки самого запроса,
+    поэтому здоровье сервиса они не ухудшают.
+    """
+
+    def __init__(self, name, window=20, min_calls=10, failure_rate=0.5, slow_call=20.0,
+                 open_seconds=30.0, half_open_calls=2):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+
+        self.opened = 0
+        self.rejected = 0
+
+    def _open(self, now, reason):
+        self._state = OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        self.opened += 1
+        logger.warning(f"Автомат {self.name} разомкнут ({reason}): запросы отклоняются {self.open_seconds:.0f} сек.")
+
+    def _retry_in(self, now):
+        return max(self._opened_at + self.open_seconds - now, 0.0)
+
+    def check(self):
+        """
+        Быстрая проверка до постановки в очередь: разомкнутый автомат сразу отклоняет вызов.
+
+        Raises:
+            CircuitOpenError: Автомат разомкнут и время пробы еще не пришло
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._state == OPEN and self._retry_in(now) > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self._retry_in(now))
+
+    def allow(self):
+        """
+        Пропускает вызов или отклоняет его; в полуоткрытом состоянии пропускает ограниченное число проб.
+
+        Returns:
+            bool: True, если вызов - пробный (его исход решит состояние автомата)
+
+        Raises:
+            CircuitOpenError: Вызов не разрешен
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._state == OPEN:
+                if self._retry_in(now) > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, self._retry_in(now))
+                self._state = HALF_OPEN
+                self._probes = 0
+                self._probe_successes = 0
+                logger.info(f"Автомат {self.name} полуоткрыт: пропускаю пробные запросы")
+            if self._state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, 0.0)
+                self._probes += 1
+                return True
+            return False
+
+    def record(self, status=None, latency=None, error=False, probe=False):
+        """
+        Учитывает исход вызова.
+
+        Args:
+            status (int, optional): HTTP-статус ответа
+            latency (float, optional): Время до получения ответа в секундах
+            error (bool): Вызов завершился ошибкой сети или таймаутом
+            probe (bool): Вызов был пробным (из allow)
+        """
+        failed = error or (status is not None and status >= 500)
+        slow = latency is not None and latency > self.slow_call
+        with self._lock:
+            now = time.monotonic()
+            if self._state == HALF_OPEN:
+                if not probe:
+                    return
+                if failed or slow:
+                    self._open(now, "пробный запрос неудачен")
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_calls:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                    logger.info(f"Автомат {self.name} замкнут: сервис снова отвечает")
+                return
+            if self._state == OPEN:
+                return
+
+            self._outcomes.append(failed or slow)
+            if len(self._outcomes) >= self.min_calls:
+                rate = sum(self._outcomes) / len(self._outcomes)
+                if rate >= self.failure_rate:
+                    self._open(now, f"ошибок и медленных ответов {rate:.0%} из {len(self._outcomes)}")
+
+    def release_probe(self):
+        """Возвращает место пробы, если пробный вызов был отменен до получения исхода."""
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    @property
+    def state(self):
+        """Текущее состояние: closed, open или half_open."""
+        with self._lock:
+            if self._state == OPEN and self._retry_in(time.monotonic()) == 0:
+                return HALF_OPEN
+            return self._state
+
+    def stats(self):
+        """
+        Возвращает счетчики автомата.
+
+        Returns:
+            dict: Состояние, доля неудачных вызовов в окне, число размыканий и отклоненных вызовов
+        """
+        state = self.state
+        with self._lock:
+            outcomes = list(self._outcomes)
+            return {
+                "state": state,
+                "window_calls": len(outcomes),
+                "failure_rate": round(sum(outcomes) / len(outcomes), 3) if outcomes else 0.0,
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "retry_in": round(self._retry_in(time.monotonic()), 1) if self._state == OPEN else 0.0,
+            }
+
+
+def get_breaker(name):
+    """
+    Возвращает общий автомат внешнего сервиса, создавая его по настройкам окружения.
+
+    Настройки: {NAME}_BREAKER_FAILURE_RATE (по умолчанию 0.5), {NAME}_BREAKER_SLOW_CALL
+    (секунд), {NAME}_BREAKER_OPEN_SECONDS (по умолчанию 30), BREAKER_WINDOW (20) и
+    BREAKER_MIN_CALLS (10), где NAME - PERPLEXITY или ANTHROPIC.
+
+    Args:
+        name (str): Имя сервиса (http_client.PERPLEXITY, http_client.ANTHROPIC)
+
+    Returns:
+        CircuitBreaker: Автомат
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            prefix = name.upper()
+            breaker = _breakers[name] = CircuitBreaker(
+                name,
+                window=int(os.getenv("BREAKER_WINDOW", "20")),
+                min_calls=int(os.getenv("BREAKER_MIN_CALLS", "10")),
+                failure_rate=float(os.getenv(f"{prefix}_BREAKER_FAILURE_RATE", "0.5")),
+                slow_call=float(os.getenv(f"{prefix}_BREAKER_SLOW_CALL", str(_DEFAULT_SLOW_CALL.get(name, 20)))),
+                open_seconds=float(os.getenv(f"{prefix}_BREAKER_OPEN_SECONDS", "30")),
+            )
+        return breaker
+
+
+def is_available(name):
+    """Можно ли сейчас обращаться к сервису (автомат не разомкнут)."""
+    return get_breaker(name).state != OPEN
+
+
+@asynccontextmanager
+async def upstream_call(name):
+    """
+    Контекст одного запроса к внешнему сервису: автомат, затем ограничитель запросов.
+
+    Разомкнутый автомат отклоняет вызов до постановки в очередь ограничителя.
+    permit.record(status) внутри контекста учитывает ответ и в ограничителе, и в автомате.
+
+    Args:
+        name (str): Имя сервиса
+
+    Yields:
+        Разрешение ограничителя запросов
+
+    Raises:
+        CircuitOpenError: Автомат разомкнут
+    """
+    breaker = get_breaker(name)
+    breaker.check()
+    async with get_limiter(name).limit() as permit:
+        probe = breaker.allow()
+        try:
+            yield permit
+        except Exception:
+            breaker.record(permit.status, permit.latency, error=permit.status is None, probe=probe)
+            raise
+        except BaseException:
+            if probe:
+                breaker.release_probe()
+            raise
+        else:
+            breaker.record(permit.status, permit.latency if permit.latency is not None else permit.elapsed(), probe=probe)
+
+
+def get_breaker_stats():
+    """Возвращает счетчики автоматов всех внешних сервисов."""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.stats() for breaker in breakers}
@@ -0,0 +1,39 @@
+"""
+Общие фикстуры тестов: подмена Perplexity и Claude и свежее состояние модулей запросов.
+"""
+import weakref
+import httpx
+import pytest
+import http_client
+import rate_limiter
+import retry_policy
+import circuit_breaker
+import search_cache
+
+
+@pytest.fixture
+def mock_api(monkeypatch):
+    """
+    Подменяет внешние API обработчиком httpx.MockTransport.
+
+    Каждый вызов задает обработчик и сбрасывает пулы соединений, ограничители
+    частоты, политики повторов, автоматы отключения, кэш поиска и индекс
+    перефразировок, чтобы тесты не влияли друг на друга.
+
+    Returns:
+        callable: install(handler, policies=None, breakers=None), где policies и
+        breakers - словари {имя сервиса: объект} вместо настроек из окружения
+    """
+    def install(handler, policies=None, breakers=None):
+        monkeypatch.setenv("PERPLEXITY_API_KEY", "test-key")
+        monkeypatch.setenv("CLAUDE_API_KEY", "test-key")
+        monkeypatch.setattr(http_client, "_build_client", lambda name: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        # Клиенты фонового event loop (run_sync) созданы с прежним обработчиком
+        monkeypatch.setattr(http_client, "_clients", weakref.WeakKeyDictionary())
+        monkeypatch.setattr(rate_limiter, "_limiters", {})
+        monkeypatch.setattr(retry_policy, "_policies", dict(policies or {}))
+        monkeypatch.setattr(circuit_breaker, "_breakers", dict(breakers or {}))
+        monkeypatch.setattr(search_cache, "search_cache", search_cache.create_cache_backend("memory"))
+        monkeypatch.setattr(search_cache, "near_duplicate_index", search_cache.NearDuplicateIndex(threshold=0.5))
+
+    return install
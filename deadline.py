@@ -0,0 +1,135 @@
+"""
+Request deadlines shared by the search and LLM stages, with degrade modes for when time runs out.
+"""
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Что делать, если поиск не успел завершиться в отведенное ему время:
+# partial - ответить по результатам, которые успели прийти;
+# no_search - отбросить поиск и ответить знаниями модели;
+# summary - не вызывать Claude и вернуть найденные результаты как есть
+PARTIAL = "partial"
+NO_SEARCH = "no_search"
+SUMMARY = "summary"
+DEGRADE_MODES = (PARTIAL, NO_SEARCH, SUMMARY)
+
+DEFAULT_DEGRADE = os.getenv('DEADLINE_DEGRADE', PARTIAL)
+if DEFAULT_DEGRADE not in DEGRADE_MODES:
+    # Ошибка в настройке не должна ломать каждый запрос
+    logger.warning(f"Неизвестный режим DEADLINE_DEGRADE='{DEFAULT_DEGRADE}', допустимы: "
+                   f"{', '.join(DEGRADE_MODES)}; использую {PARTIAL}")
+    DEFAULT_DEGRADE = PARTIAL
+
+# Время, которое поиск оставляет на ответ Claude (не больше половины всего срока)
+LLM_RESERVE = float(os.getenv('DEADLINE_LLM_RESERVE', '12'))
+
+# Срок текущего запроса; контекст переходит и в корутины, запущенные через http_client.run_sync
+_current = contextvars.ContextVar("deadline", default=None)
+
+_stats_lock = threading.Lock()
+_stats = Counter()
+
+
+class Deadline:
+    """
+    Срок выполнения одного запроса пользователя.
+
+    Поиск получает оставшееся время за вычетом резерва на ответ Claude, Claude - все,
+    что осталось после поиска. Каждый запрос к внешнему сервису (с повторами) не
+    выходит за срок: его бюджет ограничивает retry_policy.
+
+    Attributes:
+        seconds (float): Весь срок в секундах
+        degrade (str): Режим деградации из DEGRADE_MODES
+        events (list): Что было сокращено из-за срока (search_timeout, llm_timeout, ...)
+    """
+
+    def __init__(self, seconds, degrade=None, llm_reserve=LLM_RESERVE):
+        degrade = degrade or DEFAULT_DEGRADE
+        if degrade not in DEGRADE_MODES:
+            raise ValueError(f"Неизвестный режим деградации '{degrade}', допустимы: {', '.join(DEGRADE_MODES)}")
+        self.seconds = seconds
+        self.degrade = degrade
+        self.llm_reserve = min(llm_reserve, seconds / 2)
+        self.expires_at = time.monotonic() + seconds
+        self.events = []
+
+    def remaining(self):
+        """Оставшееся время в секундах (не меньше нуля)."""
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self):
+        """Истек ли срок."""
+        return self.remaining() == 0.0
+
+    def search_budget(self):
+        """Время на поиск: остаток срока за вычетом резерва на ответ Claude."""
+        return max(self.remaining() - self.llm_reserve, 0.0)
+
+    def note(self, event):
+        """
+        Отмечает, что этап был сокращен из-за срока.
+
+        Args:
+            event (str): Событие, например search_timeout
+        """
+        self.events.append(event)
+        with _stats_lock:
+            _stats[event] += 1
+        logger.warning(f"Срок запроса ({self.seconds:.0f} сек.): {event}, режим {self.degrade}, "
+                       f"осталось {self.remaining():.1f} сек.")
+
+
+def current_deadline():
+    """Срок текущего запроса или None, если он не задан."""
+    return _current.get()
+
+
+def time_left(default):
+    """
+    Таймаут этапа с учетом срока запроса.
+
+    Args:
+        default (float): Таймаут этапа без срока
+
+    Returns:
+        float: default или оставшееся время, если оно меньше
+    """
+    deadline = _current.get()
+    return default if deadline is None else min(default, deadline.remaining())
+
+
+@contextmanager
+def deadline_scope(seconds, degrade=None, llm_reserve=LLM_RESERVE):
+    """
+    Задает срок для кода внутри блока (обработка одного запроса).
+
+    Args:
+        seconds (float): Срок в секундах
+        degrade (str, optional): Режим деградации, по умолчанию DEADLINE_DEGRADE
+        llm_reserve (float): Резерв на ответ Claude; 0 для запросов без Claude
+
+    Yields:
+        Deadline: Срок запроса
+    """
+    deadline = Deadline(seconds, degrade, llm_reserve)
+    token = _current.set(deadline)
+    with _stats_lock:
+        _stats["requests"] += 1
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def get_deadline_stats():
+    """Возвращает счетчики: запросов со сроком и сокращенных этапов по видам."""
+    with _stats_lock:
+        return dict(_stats)
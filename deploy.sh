@@ -37,7 +37,7 @@ else
     echo 'Файл .env уже существует на сервере.'
 fi"
 
-# Настройка запуска приложения через systemd
+# Настройка запуска приложения через systemd: gunicorn (serve.py) на порту, который проксирует nginx
 echo "Настраиваю автозапуск приложения через systemd..."
 cat > /tmp/ai_agent.service << EOF
 [Unit]
@@ -47,9 +47,11 @@ After=network.target
 [Service]
 User=root
 WorkingDirectory=$REMOTE_DIR
-ExecStart=$REMOTE_DIR/venv/bin/python $REMOTE_DIR/web_app.py
+ExecStart=$REMOTE_DIR/venv/bin/python $REMOTE_DIR/serve.py
+ExecReload=/bin/kill -HUP \$MAINPID
 Restart=always
 Environment=PYTHONUNBUFFERED=1
+Environment=PORT=5007
 
 [Install]
 WantedBy=multi-user.target
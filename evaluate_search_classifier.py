@@ -0,0 +1,103 @@
+"""
+Offline accuracy and latency report for the local search-need classifier.
+
+Usage: python evaluate_search_classifier.py [path/to/labeled.jsonl]
+
+Without arguments, reports both bundled sets: search_need_queries.jsonl, on
+which the keyword weights were tuned, and search_need_holdout.jsonl, a frozen
+set written after the last weight change that gives the accuracy to expect on
+new queries. Never tune on the holdout set; move such queries to the tuning set.
+"""
+import os
+import sys
+import json
+import time
+from search_classifier import classify_search_need, is_confident
+
+DEFAULT_DATASET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "search_need_queries.jsonl")
+HOLDOUT_DATASET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "search_need_holdout.jsonl")
+
+
+def load_dataset(path):
+    """
+    Загружает размеченные запросы.
+
+    Args:
+        path (str): Путь к JSONL-файлу со строками {"query": ..., "needs_search": ...}
+
+    Returns:
+        list: Список размеченных запросов
+    """
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def evaluate(rows, repeats=200):
+    """
+    Считает точность классификатора и время классификации одного запроса.
+
+    Args:
+        rows (list): Размеченные запросы
+        repeats (int): Сколько раз прогонять набор для замера времени
+
+    Returns:
+        dict: Метрики точности, доля локальных решений и задержка в микросекундах
+    """
+    correct = confident = confident_correct = 0
+    true_positive = predicted_positive = actual_positive = 0
+    errors = []
+    for row in rows:
+        decision = classify_search_need(row["query"])
+        expected = row["needs_search"]
+        correct += decision.needs_search == expected
+        predicted_positive += decision.needs_search
+        actual_positive += expected
+        true_positive += decision.needs_search and expected
+        if is_confident(decision):
+            confident += 1
+            if decision.needs_search == expected:
+                confident_correct += 1
+            else:
+                errors.append((row["query"], decision))
+
+    timings = []
+    for _ in range(repeats):
+        for row in rows:
+            start = time.perf_counter()
+            classify_search_need(row["query"])
+            timings.append(time.perf_counter() - start)
+    timings.sort()
+
+    return {
+        "queries": len(rows),
+        "accuracy": correct / len(rows),
+        "precision": true_positive / predicted_positive if predicted_positive else 0.0,
+        "recall": true_positive / actual_positive if actual_positive else 0.0,
+        "local_coverage": confident / len(rows),
+        "local_accuracy": confident_correct / confident if confident else 0.0,
+        "latency_p50_us": timings[len(timings) // 2] * 1e6,
+        "latency_p99_us": timings[int(len(timings) * 0.99)] * 1e6,
+        "errors": errors,
+    }
+
+
+def print_report(report):
+    """Печатает отчет о точности и скорости классификатора."""
+    print(f"Запросов в наборе:                {report['queries']}")
+    print(f"Точность (все решения):           {report['accuracy']:.1%}")
+    print(f"Precision / recall для поиска:    {report['precision']:.1%} / {report['recall']:.1%}")
+    print(f"Решено локально (без LLM):        {report['local_coverage']:.1%}")
+    print(f"Точность локальных решений:       {report['local_accuracy']:.1%}")
+    print(f"Задержка p50 / p99:               {report['latency_p50_us']:.1f} / {report['latency_p99_us']:.1f} мкс")
+    for query, decision in report["errors"]:
+        print(f"  ошибка: '{query}' -> {decision}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        print_report(evaluate(load_dataset(sys.argv[1])))
+    else:
+        for title, path in (("Набор для настройки весов", DEFAULT_DATASET), ("Отложенный набор", HOLDOUT_DATASET)):
+            print(f"{title} ({os.path.basename(path)}):")
+            print_report(evaluate(load_dataset(path)))
+            print()
@@ -0,0 +1,223 @@
+"""
+Shared pooled HTTP clients for the upstream APIs (Perplexity and Anthropic).
+"""
+import os
+import queue
+import asyncio
+import logging
+import threading
+import weakref
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Имена внешних сервисов, для каждого из которых держим отдельный пул соединений
+PERPLEXITY = "perplexity"
+ANTHROPIC = "anthropic"
+
+UPSTREAM_URLS = {
+    PERPLEXITY: "https://api.perplexity.ai",
+    ANTHROPIC: "https://api.anthropic.com",
+}
+
+# Асинхронные клиенты привязаны к event loop, поэтому храним отдельный набор для каждого цикла
+_clients = weakref.WeakKeyDictionary()
+
+# Фоновый event loop, на котором выполняются синхронные обертки над асинхронным API
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+
+
+def _http2_available():
+    """Проверяет, установлен ли пакет h2, необходимый httpx для HTTP/2."""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _build_client(name):
+    """
+    Создает асинхронный клиент с пулом keep-alive соединений для указанного сервиса.
+
+    Размер пула задается переменными окружения <NAME>_POOL_SIZE и
+    <NAME>_POOL_KEEPALIVE, HTTP/2 можно отключить через HTTP2_ENABLED=0.
+    """
+    prefix = name.upper()
+    max_connections = int(os.getenv(f'{prefix}_POOL_SIZE', '20'))
+    max_keepalive = int(os.getenv(f'{prefix}_POOL_KEEPALIVE', str(max_connections)))
+    keepalive_expiry = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '60'))
+    http2 = os.getenv('HTTP2_ENABLED', '1') != '0' and _http2_available()
+
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive,
+        keepalive_expiry=keepalive_expiry
+    )
+    logger.info(f"Создан пул соединений {name}: до {max_connections} соединений, HTTP/2={'да' if http2 else 'нет'}")
+    return httpx.AsyncClient(http2=http2, limits=limits, timeout=60)
+
+
+def get_async_client(name):
+    """
+    Возвращает клиент с пулом соединений для сервиса, общий для текущего event loop.
+
+    Args:
+        name (str): Имя сервиса (PERPLEXITY или ANTHROPIC)
+
+    Returns:
+        httpx.AsyncClient: Клиент, переиспользующий TCP/TLS соединения между запросами
+    """
+    loop = asyncio.get_running_loop()
+    loop_clients = _clients.get(loop)
+    if loop_clients is None:
+        loop_clients = _clients[loop] = {}
+    client = loop_clients.get(name)
+    if client is None:
+        client = loop_clients[name] = _build_client(name)
+    return client
+
+
+def _background_loop():
+    """Запускает (при первом обращении) фоновый event loop в отдельном потоке."""
+    global _loop, _loop_thread
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                _loop_thread = threading.Thread(target=loop.run_forever, name="http-client-loop", daemon=True)
+                _loop_thread.start()
+                _loop = loop
+    return _loop
+
+
+def submit(coro):
+    """
+    Запускает корутину на общем фоновом event loop, не дожидаясь результата.
+
+    Позволяет синхронному коду начать запрос заранее (например, поиск, пока
+    модель решает, нужен ли он) и отменить его через future.cancel().
+
+    Args:
+        coro: Корутина для выполнения
+
+    Returns:
+        concurrent.futures.Future: Будущий результат корутины
+    """
+    loop = _background_loop()
+    if threading.current_thread() is _loop_thread:
+        coro.close()
+        raise RuntimeError("submit нельзя вызывать из фонового event loop, используйте asyncio.create_task")
+    return asyncio.run_coroutine_threadsafe(coro, loop)
+
+
+def run_sync(coro):
+    """
+    Выполняет корутину на общем фоновом event loop и ждет результата.
+
+    Все синхронные вызовы попадают в один цикл, поэтому они разделяют
+    одни и те же пулы соединений независимо от того, из какого потока вызваны.
+
+    Args:
+        coro: Корутина для выполнения
+
+    Returns:
+        Результат корутины
+    """
+    if threading.current_thread() is _loop_thread:
+        coro.close()
+        raise RuntimeError("run_sync нельзя вызывать из фонового event loop, используйте await")
+    return submit(coro).result()
+
+
+def iterate_sync(agen):
+    """
+    Превращает асинхронный генератор в синхронный: генератор выполняется
+    на общем фоновом event loop, элементы передаются через очередь.
+
+    Если потребитель прекращает чтение (например, клиент закрыл соединение),
+    асинхронный генератор отменяется и освобождает соединение с сервисом.
+
+    Args:
+        agen: Асинхронный генератор
+
+    Yields:
+        Элементы асинхронного генератора по мере их появления
+    """
+    loop = _background_loop()
+    items = queue.Queue()
+    finished = object()
+
+    async def pump():
+        try:
+            async for item in agen:
+                items.put((item, None))
+        except BaseException as e:
+            items.put((finished, e))
+            raise
+        else:
+            items.put((finished, None))
+
+    future = asyncio.run_coroutine_threadsafe(pump(), loop)
+    try:
+        while True:
+            item, error = items.get()
+            if item is finished:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        future.cancel()
+
+
+def _reset_after_fork():
+    """Сбрасывает фоновый цикл и пулы в дочернем процессе: поток и сокеты родителя там недоступны."""
+    global _loop, _loop_thread, _loop_lock
+    _loop = None
+    _loop_thread = None
+    _loop_lock = threading.Lock()
+    _clients.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+async def aprewarm(names=None, timeout=5):
+    """
+    Заранее открывает соединения с внешними сервисами, чтобы первый запрос
+    пользователя не тратил время на TCP и TLS рукопожатие.
+
+    Args:
+        names (list, optional): Список сервисов, по умолчанию все известные
+        timeout (float): Таймаут прогревочного запроса в секундах
+    """
+    async def warm(name):
+        try:
+            response = await get_async_client(name).head(UPSTREAM_URLS[name], timeout=timeout)
+            logger.info(f"Пул соединений {name} прогрет (HTTP {response.status_code}, {response.http_version})")
+        except httpx.HTTPError as e:
+            logger.warning(f"Не удалось прогреть пул соединений {name}: {e}")
+
+    await asyncio.gather(*(warm(name) for name in names or UPSTREAM_URLS))
+
+
+def prewarm(names=None, timeout=5):
+    """Синхронная обертка над aprewarm: прогревает пулы фонового event loop."""
+    run_sync(aprewarm(names, timeout))
+
+
+async def aclose_clients():
+    """Закрывает пулы соединений, открытые в текущем event loop."""
+    loop_clients = _clients.pop(asyncio.get_running_loop(), {})
+    for client in loop_clients.values():
+        await client.aclose()
+
+
+def close_clients():
+    """Закрывает пулы соединений фонового event loop."""
+    if _loop is not None:
+        run_sync(aclose_clients())
@@ -0,0 +1,119 @@
+"""
+Precompiled multi-pattern keyword matcher shared by the text-processing functions.
+"""
+import re
+
+
+def normalize_text(text):
+    """
+    Приводит текст к виду, в котором ищутся ключевые слова: нижний регистр, ё заменена на е.
+
+    Args:
+        text (str): Исходный текст
+
+    Returns:
+        str: Нормализованный текст
+    """
+    return text.lower().replace('ё', 'е')
+
+
+def _trie_pattern(words):
+    """
+    Строит регулярное выражение-префиксное дерево: общие начала слов проверяются
+    один раз, а из нескольких слов с одной позиции выбирается самое длинное.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node):
+        is_end = '' in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char != '']
+        if not branches:
+            return ''
+        if len(branches) == 1 and not is_end:
+            return branches[0]
+        group = "(?:" + "|".join(branches) + ")"
+        return group + "?" if is_end else group
+
+    return build(trie)
+
+
+class KeywordEngine:
+    """
+    Находит за один проход по тексту все категории, ключевые слова которых в нем встречаются.
+
+    Все ключевые слова собираются при создании в одно регулярное выражение
+    (префиксное дерево внутри опережающей проверки), поэтому текст приводится
+    к нижнему регистру один раз, а время поиска почти не зависит от числа слов.
+    Совпадения могут перекрываться: в "курс криптовалют" найдутся и "курс",
+    и "крипто", и "криптовалют", даже если одно слово входит в другое.
+
+    Ключевое слово совпадает с любой подстрокой ("акци" находит "акции").
+    "$" в конце слова требует, чтобы после него не было буквы или цифры
+    ("топ$" не находит "топливо"); при word_start=True слово должно начинаться
+    с начала слова текста.
+    """
+
+    def __init__(self, categories, word_start=False):
+        """
+        Args:
+            categories (dict): Категория -> список ключевых слов
+            word_start (bool): Искать ключевые слова только с начала слов текста
+        """
+        self.keywords = {category: tuple(words) for category, words in categories.items()}
+        entries = {}
+        for category, words in categories.items():
+            for word in words:
+                whole = word.endswith("$")
+                text = normalize_text(word[:-1] if whole else word)
+                entries.setdefault(text, set()).add((category, word[:-1] if whole else word, whole))
+
+        # Регулярное выражение на каждой позиции берет самое длинное слово, поэтому
+        # заранее добавляем к нему все слова-префиксы: они встречаются там же
+        self._closure = {}
+        for text in entries:
+            closure = []
+            for prefix, prefix_entries in entries.items():
+                if text.startswith(prefix):
+                    closure.extend((category, keyword, len(prefix), whole) for category, keyword, whole in prefix_entries)
+            self._closure[text] = tuple(closure)
+
+        boundary = r"(?<!\w)" if word_start else ""
+        self._pattern = re.compile(boundary + "(?=(" + _trie_pattern(entries) + "))")
+
+    def scan(self, text):
+        """
+        Находит ключевые слова в тексте.
+
+        Args:
+            text (str): Текст запроса в любом регистре
+
+        Returns:
+            dict: Категория -> множество найденных ключевых слов этой категории
+        """
+        text = normalize_text(text)
+        found = {}
+        for match in self._pattern.finditer(text):
+            start = match.start()
+            for category, keyword, length, whole in self._closure[match.group(1)]:
+                end = start + length
+                if whole and end < len(text) and (text[end].isalnum() or text[end] == '_'):
+                    continue
+                found.setdefault(category, set()).add(keyword)
+        return found
+
+    def match(self, text):
+        """
+        Возвращает категории, ключевые слова которых встречаются в тексте.
+
+        Args:
+            text (str): Текст запроса в любом регистре
+
+        Returns:
+            set: Найденные категории
+        """
+        return set(self.scan(text))
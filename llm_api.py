@@ -2,12 +2,204 @@
 Module for interacting with Claude 3.5 Haiku API.
 """
 import os
-import requests
+import httpx
 import logging
 import json
+import hashlib
+import threading
+from http_client import get_async_client, run_sync, iterate_sync, ANTHROPIC
+from circuit_breaker import upstream_call, is_available, CircuitOpenError
+from retry_policy import get_retry_policy
+from deadline import current_deadline
+from singleflight import SingleFlight
+from search_classifier import classify_search_need, is_confident
+from keyword_engine import KeywordEngine
+from prompt_budget import PROMPT_TOKEN_BUDGET, SYSTEM_PROMPT_TOKEN_BUDGET, estimate_tokens, truncate_to_tokens
 
 logger = logging.getLogger(__name__)
 
+# Объединяет одновременные одинаковые запросы к Claude
+llm_flight = SingleFlight("anthropic")
+
+
+CLAUDE_API_URL = "https://api.anthropic.com/v1/messages"
+CLAUDE_MODEL = "claude-3-haiku-20240307"
+
+# Ключевые слова тестовых ответов generate_test_response
+TEST_RESPONSE_KEYWORDS = KeywordEngine({
+    "greeting": ['привет', 'здравствуй', 'добрый день', 'доброе утро', 'добрый вечер'],
+    "news": ['новост', 'событи', 'произошло', 'случилось'],
+    "weather": ['погод', 'температур', 'осадк', 'дожд', 'снег'],
+    "finance": ['курс', 'валют', 'доллар', 'евро', 'акци', 'биткоин', 'крипто'],
+    "programming": ['код', 'программ', 'python', 'javascript', 'java', 'разработ'],
+    "ai": ['искусств', 'интеллект', 'ai', 'нейросет', 'машинн', 'обучени'],
+    "help": ['помо', 'умеешь', 'можешь', 'способ', 'функци'],
+})
+
+# Системный промпт более информативный, но всё ещё компактный
+DEFAULT_SYSTEM_PROMPT = """Ты - полезный ассистент, отвечающий на русском языке.
+Если информация может быть устаревшей или тебе нужны актуальные данные для ответа - явно об этом сообщи.
+Отвечай точно, информативно и полезно."""
+
+# Ответ, когда автомат Claude разомкнут (circuit_breaker) и запрос не отправляется
+UNAVAILABLE_MESSAGE = "Сервис Claude временно недоступен. Пожалуйста, попробуйте через минуту."
+
+# Начала текстов, которые aquery_llm возвращает вместо ответа при ошибке (см. is_error_response)
+ERROR_PREFIXES = (
+    "Ошибка: ",
+    "Ошибка при обращении к API Claude",
+    "Ошибка при обработке ответа от API Claude",
+    "Произошла неожиданная ошибка: ",
+    UNAVAILABLE_MESSAGE,
+)
+
+# Заголовок раздела с результатами поиска в промпте utils.combine_input
+SEARCH_RESULTS_HEADING = "АКТУАЛЬНАЯ ИНФОРМАЦИЯ ИЗ ИНТЕРНЕТА:"
+
+# Дополнительные требования по типу запроса: название типа в промпте и текст требования
+QUERY_TYPES = {
+    "future": ("будущий период", "Не делай предположений о будущем. Используй ТОЛЬКО самые актуальные данные "
+               "из поиска и явно укажи, что это последние доступные данные, а не прогноз на запрашиваемый период. "
+               "Чётко обозначь дату актуальности информации."),
+    "ranking": ("рейтинг или список", "Приведи точный список из поисковых результатов. Не изменяй порядок "
+                "элементов и сохрани все числовые показатели. Обязательно укажи источник данных и дату их актуальности."),
+    "factual": ("фактическая информация", "Приведи точные данные из поисковых результатов. Включи все "
+                "релевантные числа, даты и факты. Избегай обобщений."),
+}
+
+# Инструкции для ответа по результатам поиска не зависят от запроса, поэтому передаются
+# не в сообщении пользователя, а неизменным блоком системного промпта, который кэширует API
+SEARCH_INSTRUCTIONS = (
+    f"Если в сообщении есть раздел \"{SEARCH_RESULTS_HEADING}\", следуй ИНСТРУКЦИЯМ:\n"
+    "1. Для ответа на запрос пользователя СТРОГО ИСПОЛЬЗУЙ предоставленную информацию из поиска.\n"
+    "2. НИКОГДА не выдумывай факты и не дополняй информацию своими знаниями, когда отвечаешь на вопросы "
+    "о текущих данных, рейтингах, ценах или событиях.\n"
+    "3. Если в поисковых результатах есть противоречия, укажи это и приведи разные данные с источниками.\n"
+    "4. Четко укажи временной период, к которому относятся данные, и приведи источники информации.\n"
+    "5. Для запросов о будущих периодах всегда опирайся на последние известные данные и явно "
+    "указывай, что это актуальная информация на текущий момент, а не прогноз.\n\n"
+    "Если в сообщении указан тип запроса, ВАЖНО выполнить требования для него:\n"
+    + "\n".join(f"- {label}: {requirement}" for label, requirement in QUERY_TYPES.values())
+)
+
+# Суммарное использование токенов Claude, включая чтение и запись кэша промптов
+_usage_lock = threading.Lock()
+_usage = {"requests": 0, "input_tokens": 0, "output_tokens": 0,
+          "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+
+
+def _cached_block(text):
+    """Текстовый блок промпта, отмеченный точкой кэширования."""
+    return {"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}
+
+
+def _record_usage(usage):
+    """
+    Учитывает поле usage ответа Messages API.
+    
+    Args:
+        usage (dict or None): Использование токенов из ответа
+    """
+    if not usage:
+        return
+    with _usage_lock:
+        _usage["requests"] += 1
+        for name in ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens"):
+            _usage[name] += usage.get(name) or 0
+    logger.info(f"Claude usage: input {usage.get('input_tokens')}, output {usage.get('output_tokens')}, "
+                f"cache write {usage.get('cache_creation_input_tokens') or 0}, cache read {usage.get('cache_read_input_tokens') or 0}")
+
+
+def get_llm_usage_stats():
+    """Возвращает суммарное использование токенов Claude и долю входных токенов, прочитанных из кэша."""
+    with _usage_lock:
+        stats = dict(_usage)
+    total_input = stats["input_tokens"] + stats["cache_creation_input_tokens"] + stats["cache_read_input_tokens"]
+    stats["cache_read_ratio"] = round(stats["cache_read_input_tokens"] / total_input, 3) if total_input else 0.0
+    return stats
+
+
+def _note_deadline_timeout():
+    """Отмечает в сроке запроса, что Claude не успел ответить, если таймаут вызван истекшим сроком."""
+    deadline = current_deadline()
+    # Таймаут последней попытки совпадает с концом срока с точностью до срабатывания таймера
+    if deadline is not None and deadline.remaining() < 1.0:
+        deadline.note("llm_timeout")
+
+
+def _prepare_prompt(input_text, system_prompt):
+    """
+    Подставляет системный промпт по умолчанию, ограничивает промпты бюджетами в токенах
+    и собирает системный промпт из кэшируемых блоков.
+    
+    Неизменные части (системный промпт, инструкции для результатов поиска) идут первыми
+    и отмечены cache_control, переменные запрос и результаты поиска - в сообщении после них.
+    
+    Args:
+        input_text (str): Текст запроса пользователя
+        system_prompt (str or None): Системный промпт
+        
+    Returns:
+        tuple: (input_text, system) - текст сообщения и список блоков системного промпта
+    """
+    if system_prompt is None:
+        system_prompt = DEFAULT_SYSTEM_PROMPT
+    else:
+        system_prompt, dropped = truncate_to_tokens(system_prompt, SYSTEM_PROMPT_TOKEN_BUDGET)
+        if dropped:
+            logger.warning(f"System prompt too long, truncated to {SYSTEM_PROMPT_TOKEN_BUDGET} tokens ({dropped} tokens dropped)")
+    
+    # Промпты combine_input уже упакованы в бюджет; обрезается только слишком длинный ввод пользователя
+    input_text, dropped = truncate_to_tokens(input_text, PROMPT_TOKEN_BUDGET)
+    if dropped:
+        logger.warning(f"Input text too long, truncated to {PROMPT_TOKEN_BUDGET} tokens ({dropped} tokens dropped)")
+    
+    system = [_cached_block(system_prompt)]
+    if SEARCH_RESULTS_HEADING in input_text:
+        system.append(_cached_block(SEARCH_INSTRUCTIONS))
+    return input_text, system
+
+
+def _api_headers(api_key):
+    """Заголовки запроса к Messages API."""
+    return {
+        "x-api-key": api_key,
+        "anthropic-version": "2023-06-01",
+        "content-type": "application/json"
+    }
+
+
+async def _apost_messages(url, headers, data, timeout):
+    """
+    Отправляет запрос к Messages API; одинаковые одновременные запросы
+    (та же модель, системный промпт и сообщения) разделяют один вызов,
+    использование токенов учитывается один раз на реальный вызов.
+    
+    Args:
+        url (str): Адрес Messages API
+        headers (dict): Заголовки запроса с API ключом
+        data (dict): Тело запроса
+        timeout (float): Бюджет времени запроса с повторами в секундах
+        
+    Returns:
+        httpx.Response: Ответ API
+    """
+    key = hashlib.sha256(json.dumps(data, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+    
+    async def call():
+        # Временные сбои (429, 529, 5xx, таймауты) повторяются; timeout - бюджет вызова вместе с повторами
+        async for attempt in get_retry_policy(ANTHROPIC).attempts(budget=timeout):
+            async with attempt:
+                async with upstream_call(ANTHROPIC) as permit:
+                    response = await get_async_client(ANTHROPIC).post(url, headers=headers, json=data, timeout=attempt.timeout(timeout))
+                    permit.record(response.status_code)
+                attempt.check(response)
+        if response.status_code == 200:
+            _record_usage(response.json().get("usage"))
+        return response
+    
+    return await llm_flight.run(key, call)
+
 def generate_test_response(input_text):
     """
     Генерирует тестовый ответ, когда API недоступен или работаем в тестовом режиме.
@@ -18,49 +210,49 @@ def generate_test_response(input_text):
     Returns:
         str: Сгенерированный ответ
     """
-    input_lower = input_text.lower()
+    topics = TEST_RESPONSE_KEYWORDS.match(input_text)
     
     # Базовый ответ для большинства запросов
     default_response = """Это тестовый ответ от AI Agent. В настоящий момент я работаю в тестовом режиме без доступа к API Claude.
 Я могу симулировать ответы на типичные запросы. Для полноценной работы потребуется настроить доступ к API Claude."""
     
     # Ответы на приветствия
-    if any(greeting in input_lower for greeting in ['привет', 'здравствуй', 'добрый день', 'доброе утро', 'добрый вечер']):
+    if "greeting" in topics:
         return """Здравствуйте! Я AI Agent, работающий в тестовом режиме. 
 Чем могу помочь вам сегодня? Обратите внимание, что сейчас я функционирую без доступа к API Claude."""
     
     # Ответы на запросы о новостях
-    if any(word in input_lower for word in ['новост', 'событи', 'произошло', 'случилось']):
+    if "news" in topics:
         return """В тестовом режиме я не могу предоставить актуальные новости, так как не имею доступа к интернету.
 В реальном режиме работы я бы выполнил поиск последних новостей через Perplexity API и предоставил вам актуальную информацию.
 Пожалуйста, настройте API ключи для полноценной работы."""
     
     # Ответы на запросы о погоде
-    if any(word in input_lower for word in ['погод', 'температур', 'осадк', 'дожд', 'снег']):
+    if "weather" in topics:
         return """В тестовом режиме я не могу предоставить актуальный прогноз погоды, так как не имею доступа к метеорологическим данным.
 В полноценном режиме я бы выполнил поиск через Perplexity API и предоставил вам точную информацию о погоде в указанном регионе.
 Для получения реальных данных требуется настройка API ключей."""
     
     # Ответы на запросы о курсах валют и финансах
-    if any(word in input_lower for word in ['курс', 'валют', 'доллар', 'евро', 'акци', 'биткоин', 'крипто']):
+    if "finance" in topics:
         return """В тестовом режиме я не могу предоставить актуальные данные о курсах валют или финансовых рынках.
 В полноценном режиме работы я бы получил последние котировки через Perplexity API и представил вам актуальную информацию.
 Для получения реальных данных требуется настройка API ключей."""
     
     # Ответы на технические и программные запросы
-    if any(word in input_lower for word in ['код', 'программ', 'python', 'javascript', 'java', 'разработ']):
+    if "programming" in topics:
         return """В тестовом режиме я могу предоставить общую информацию о программировании, но не могу выполнять сложный анализ кода или создавать оптимальные программные решения.
 В полноценном режиме работы я мог бы дать более детальные ответы с использованием возможностей Claude 3.5 Haiku.
 Для получения более качественных технических ответов требуется настройка API ключей."""
     
     # Ответы на запросы об AI и машинном обучении
-    if any(word in input_lower for word in ['искусств', 'интеллект', 'ai', 'нейросет', 'машинн', 'обучени']):
+    if "ai" in topics:
         return """В тестовом режиме я могу предоставить базовую информацию об искусственном интеллекте и машинном обучении.
 Искусственный интеллект - это область компьютерных наук, направленная на создание систем, способных выполнять задачи, требующие человеческого интеллекта.
 Для более глубокого и актуального анализа требуется настройка API ключей для доступа к возможностям Claude 3.5 Haiku."""
     
     # Ответы на запросы о помощи или возможностях
-    if any(word in input_lower for word in ['помо', 'умеешь', 'можешь', 'способ', 'функци']):
+    if "help" in topics:
         return """Я - AI Agent, работающий в тестовом режиме. Мои возможности:
 1. Имитация ответов на базовые запросы
 2. Демонстрация интерфейса взаимодействия
@@ -74,9 +266,131 @@ def generate_test_response(input_text):
     # Для всех остальных запросов
     return default_response
 
-def query_llm(input_text, system_prompt=None, detect_search_needs=False, **kwargs):
+
+# Промпт классификатора: нужна ли для ответа актуальная информация из интернета
+SEARCH_DECISION_PROMPT = """Ты - полезный ассистент, который анализирует запросы.
+Твоя задача - определить, требуется ли для ответа на запрос актуальная информация из интернета.
+Если запрос требует актуальные данные о погоде, курсах валют, ценах, новостях, рейтингах или других 
+динамически меняющихся данных - ответь "ДА" в первой строке.
+Если запрос касается общих знаний, определений, неизменной информации, принципов работы чего-либо или
+исторических фактов, ответь "НЕТ" в первой строке.
+После этого на новой строке напиши оптимизированный поисковый запрос, если поиск нужен.
+Отвечай только в указанном формате."""
+
+
+async def adetect_search_need(input_text, **kwargs):
     """
-    Send a query to Claude 3.5 Haiku and get a response.
+    Asynchronously ask Claude whether answering the query requires a web search.
+    
+    Queries the local keyword classifier decides with high confidence are answered
+    without an API call; only low-confidence ones go to Claude. The Claude call is
+    short (max_tokens=300), so callers can run it concurrently with a speculative
+    search and drop the search on "НЕТ".
+    
+    Args:
+        input_text (str): The user query
+        **kwargs: Additional keyword arguments, including test_mode
+        
+    Returns:
+        tuple: (search_needed, search_query); on any error search is assumed to be needed
+    """
+    if kwargs.get('test_mode', False):
+        return True, input_text
+    
+    # Уверенные решения локального классификатора не требуют обращения к Claude
+    decision = classify_search_need(input_text)
+    if is_confident(decision):
+        logger.info(f"Local search decision: {decision.needs_search} (confidence {decision.confidence}, signals: {decision.signals})")
+        return decision.needs_search, input_text
+    
+    # Пока Claude недоступен (автомат разомкнут), решает локальный классификатор
+    if not is_available(ANTHROPIC):
+        logger.warning(f"Claude API unavailable, using local search decision: {decision.needs_search}")
+        return decision.needs_search, input_text
+    
+    api_key = os.getenv('CLAUDE_API_KEY')
+    if not api_key:
+        logger.error("CLAUDE_API_KEY not found in environment variables")
+        return True, input_text
+    
+    input_text, _ = _prepare_prompt(input_text, None)
+    url = CLAUDE_API_URL
+    headers = _api_headers(api_key)
+    messages = [
+        {"role": "user", "content": input_text}
+    ]
+    
+    # Подготовка данных для определения необходимости поиска
+    search_data = {
+        "model": CLAUDE_MODEL,
+        "max_tokens": 300,
+        "system": [_cached_block(SEARCH_DECISION_PROMPT)],
+        "messages": messages
+    }
+    
+    logger.info("Sending request to Claude API to determine search necessity")
+    
+    try:
+        search_response = await _apost_messages(url, headers, search_data, timeout=15)
+        
+        if search_response.status_code == 200:
+            search_response_data = search_response.json()
+            if "content" in search_response_data and len(search_response_data["content"]) > 0:
+                decision_text = search_response_data["content"][0]["text"]
+                
+                # Разбиваем результат на строки для анализа
+                decision_lines = decision_text.strip().split('\n')
+                first_line = decision_lines[0].upper() if decision_lines else ""
+                
+                # Определяем необходимость поиска
+                search_needed = "ДА" in first_line
+                
+                # Определяем поисковый запрос
+                search_query = ""
+                if len(decision_lines) > 1 and search_needed:
+                    search_query = decision_lines[1].strip()
+                else:
+                    search_query = input_text
+                    
+                logger.info(f"Search needed: {search_needed}, Search query: {search_query}")
+            else:
+                # В случае ошибки разбора ответа по умолчанию считаем, что поиск нужен
+                search_needed = True
+                search_query = input_text
+                logger.warning("Unexpected search decision format, defaulting to search=True")
+        else:
+            # В случае ошибки API по умолчанию считаем, что поиск нужен
+            search_needed = True
+            search_query = input_text
+            logger.warning(f"Error from Claude API when determining search necessity: {search_response.status_code}")
+    
+    except Exception as e:
+        # В случае исключения при запросе по умолчанию считаем, что поиск нужен
+        search_needed = True
+        search_query = input_text
+        logger.error(f"Exception when determining search necessity: {e}")
+    
+    return search_needed, search_query
+
+
+def detect_search_need(input_text, **kwargs):
+    """
+    Ask Claude whether answering the query requires a web search.
+    Synchronous wrapper around adetect_search_need.
+    
+    Args:
+        input_text (str): The user query
+        **kwargs: Additional keyword arguments, including test_mode
+        
+    Returns:
+        tuple: (search_needed, search_query)
+    """
+    return run_sync(adetect_search_need(input_text, **kwargs))
+
+
+async def aquery_llm(input_text, system_prompt=None, detect_search_needs=False, **kwargs):
+    """
+    Asynchronously send a query to Claude 3.5 Haiku and get a response.
     
     Args:
         input_text (str): The input text to send to the LLM
@@ -109,29 +423,13 @@ def query_llm(input_text, system_prompt=None, detect_search_needs=False, **kwarg
                 return generate_test_response(input_text)
             return "Ошибка: API ключ Claude не найден. Пожалуйста, установите переменную окружения CLAUDE_API_KEY."
         
-        # Системный промпт более информативный, но всё ещё компактный
-        if system_prompt is None:
-            system_prompt = """Ты - полезный ассистент, отвечающий на русском языке.
-Если информация может быть устаревшей или тебе нужны актуальные данные для ответа - явно об этом сообщи.
-Отвечай точно, информативно и полезно."""
-        elif len(system_prompt) > 800:
-            logger.warning(f"System prompt too long ({len(system_prompt)} chars), truncating")
-            system_prompt = system_prompt[:800]
-        
-        # Ограничиваем длину пользовательского ввода
-        if len(input_text) > 8000:
-            logger.warning(f"Input text too long ({len(input_text)} chars), truncating")
-            input_text = input_text[:8000]
+        input_text, system = _prepare_prompt(input_text, system_prompt)
         
         # Claude API endpoint
-        url = "https://api.anthropic.com/v1/messages"
+        url = CLAUDE_API_URL
         
         # Set up headers with API key
-        headers = {
-            "x-api-key": api_key,
-            "anthropic-version": "2023-06-01",
-            "content-type": "application/json"
-        }
+        headers = _api_headers(api_key)
         
         # Prepare standard messages
         messages = [
@@ -140,81 +438,23 @@ def query_llm(input_text, system_prompt=None, detect_search_needs=False, **kwarg
         
         # Отдельная логика для определения необходимости поиска
         if detect_search_needs:
-            # Особый промпт для определения необходимости поиска
-            search_system_prompt = """Ты - полезный ассистент, который анализирует запросы.
-Твоя задача - определить, требуется ли для ответа на запрос актуальная информация из интернета.
-Если запрос требует актуальные данные о погоде, курсах валют, ценах, новостях, рейтингах или других 
-динамически меняющихся данных - ответь "ДА" в первой строке.
-Если запрос касается общих знаний, определений, неизменной информации, принципов работы чего-либо или
-исторических фактов, ответь "НЕТ" в первой строке.
-После этого на новой строке напиши оптимизированный поисковый запрос, если поиск нужен.
-Отвечай только в указанном формате."""
-            
-            # Подготовка данных для определения необходимости поиска
-            search_data = {
-                "model": "claude-3-haiku-20240307",
-                "max_tokens": 300,
-                "system": search_system_prompt,
-                "messages": messages
-            }
-            
-            logger.info("Sending request to Claude API to determine search necessity")
-            
-            try:
-                search_response = requests.post(url, headers=headers, json=search_data, timeout=15)
-                
-                if search_response.status_code == 200:
-                    search_response_data = search_response.json()
-                    if "content" in search_response_data and len(search_response_data["content"]) > 0:
-                        decision_text = search_response_data["content"][0]["text"]
-                        
-                        # Разбиваем результат на строки для анализа
-                        decision_lines = decision_text.strip().split('\n')
-                        first_line = decision_lines[0].upper() if decision_lines else ""
-                        
-                        # Определяем необходимость поиска
-                        search_needed = "ДА" in first_line
-                        
-                        # Определяем поисковый запрос
-                        search_query = ""
-                        if len(decision_lines) > 1 and search_needed:
-                            search_query = decision_lines[1].strip()
-                        else:
-                            search_query = input_text
-                            
-                        logger.info(f"Search needed: {search_needed}, Search query: {search_query}")
-                    else:
-                        # В случае ошибки разбора ответа по умолчанию считаем, что поиск нужен
-                        search_needed = True
-                        search_query = input_text
-                        logger.warning("Unexpected search decision format, defaulting to search=True")
-                else:
-                    # В случае ошибки API по умолчанию считаем, что поиск нужен
-                    search_needed = True
-                    search_query = input_text
-                    logger.warning(f"Error from Claude API when determining search necessity: {search_response.status_code}")
-            
-            except Exception as e:
-                # В случае исключения при запросе по умолчанию считаем, что поиск нужен
-                search_needed = True
-                search_query = input_text
-                logger.error(f"Exception when determining search necessity: {e}")
+            search_needed, search_query = await adetect_search_need(input_text)
         
         # Prepare the request data для основного ответа
         data = {
-            "model": "claude-3-haiku-20240307",
+            "model": CLAUDE_MODEL,
             "max_tokens": 1500,  # Увеличено для более полных ответов
-            "system": system_prompt,
+            "system": system,
             "messages": messages,
             "temperature": 0.2  # Пониженная температура для более точных ответов
         }
         
         # Логируем запрос для отладки
-        logger.info(f"Sending main request to Claude API with input length: {len(input_text)}")
+        logger.info(f"Sending main request to Claude API with input length: {len(input_text)} chars (~{estimate_tokens(input_text)} tokens)")
         
         # Make the API call
         try:
-            response = requests.post(url, headers=headers, json=data, timeout=45)  # Увеличенный таймаут
+            response = await _apost_messages(url, headers, data, timeout=45)  # Увеличенный таймаут
             
             # Логируем ответ для отладки
             logger.info(f"Claude API response status: {response.status_code}")
@@ -242,10 +482,14 @@ def query_llm(input_text, system_prompt=None, detect_search_needs=False, **kwarg
                 logger.error(f"Unexpected response format: {response_data}")
                 return "Ошибка: Неожиданный формат ответа от API Claude."
                 
-        except requests.exceptions.Timeout:
+        except CircuitOpenError as e:
+            logger.warning(f"Claude API request skipped: {e}")
+            return UNAVAILABLE_MESSAGE
+        except httpx.TimeoutException:
             logger.error("Timeout when querying Claude API")
+            _note_deadline_timeout()
             return "Ошибка: Превышено время ожидания ответа от API Claude. Пожалуйста, попробуйте позже."
-        except requests.exceptions.RequestException as e:
+        except httpx.RequestError as e:
             logger.error(f"API request error: {e}")
             return f"Ошибка при обращении к API Claude: {str(e)}"
         except json.JSONDecodeError as e:
@@ -255,3 +499,144 @@ def query_llm(input_text, system_prompt=None, detect_search_needs=False, **kwarg
     except Exception as e:
         logger.error(f"Unexpected error in query_llm: {e}")
         return f"Произошла неожиданная ошибка: {str(e)}"
+
+
+def is_error_response(text):
+    """
+    Проверяет, что aquery_llm вернул сообщение об ошибке, а не ответ модели.
+
+    Args:
+        text (str): Результат aquery_llm
+
+    Returns:
+        bool: True для сообщений об ошибке и о недоступности Claude
+    """
+    return isinstance(text, str) and text.startswith(ERROR_PREFIXES)
+
+
+def query_llm(input_text, system_prompt=None, detect_search_needs=False, stream=False, **kwargs):
+    """
+    Send a query to Claude 3.5 Haiku and get a response.
+    Synchronous wrapper around aquery_llm.
+    
+    Args:
+        input_text (str): The input text to send to the LLM
+        system_prompt (str, optional): System prompt to guide the model's behavior
+        detect_search_needs (bool, optional): If True, the model will analyze if search is needed.
+            Not supported with stream: decide on search first with detect_search_need
+        stream (bool, optional): If True, return a generator of text chunks (see stream_llm)
+        **kwargs: Additional keyword arguments, including test_mode for backwards compatibility
+        
+    Returns:
+        str or tuple or generator: The response from the LLM, a tuple with (response, search_needed, search_query)
+                      if detect_search_needs is True, or a generator of text chunks if stream is True
+    
+    Raises:
+        ValueError: If both stream and detect_search_needs are set
+    """
+    if stream:
+        # Генератор фрагментов не может вернуть кортеж с решением о поиске
+        if detect_search_needs:
+            raise ValueError("detect_search_needs is not supported with stream=True; call detect_search_need first")
+        return stream_llm(input_text, system_prompt=system_prompt, **kwargs)
+    return run_sync(aquery_llm(input_text, system_prompt=system_prompt, detect_search_needs=detect_search_needs, **kwargs))
+
+
+async def astream_llm(input_text, system_prompt=None, **kwargs):
+    """
+    Stream a response from Claude 3.5 Haiku using the Messages API with stream: true.
+    
+    Args:
+        input_text (str): The input text to send to the LLM
+        system_prompt (str, optional): System prompt to guide the model's behavior
+        **kwargs: Additional keyword arguments, including test_mode
+        
+    Yields:
+        str: Text chunks as soon as they arrive from the API
+    """
+    if kwargs.get('test_mode', False):
+        logger.info("Using test mode for streamed LLM query")
+        yield generate_test_response(input_text)
+        return
+    
+    api_key = os.getenv('CLAUDE_API_KEY')
+    if not api_key:
+        logger.error("CLAUDE_API_KEY not found in environment variables")
+        yield "Ошибка: API ключ Claude не найден. Пожалуйста, установите переменную окружения CLAUDE_API_KEY."
+        return
+    
+    input_text, system = _prepare_prompt(input_text, system_prompt)
+    data = {
+        "model": CLAUDE_MODEL,
+        "max_tokens": 1500,
+        "system": system,
+        "messages": [{"role": "user", "content": input_text}],
+        "temperature": 0.2,
+        "stream": True
+    }
+    
+    logger.info(f"Sending streaming request to Claude API with input length: {len(input_text)} chars (~{estimate_tokens(input_text)} tokens)")
+    try:
+        # Повтор возможен только до первого фрагмента ответа
+        async for attempt in get_retry_policy(ANTHROPIC).attempts():
+            async with attempt:
+                async with upstream_call(ANTHROPIC) as permit, \
+                        get_async_client(ANTHROPIC).stream("POST", CLAUDE_API_URL, headers=_api_headers(api_key), json=data, timeout=attempt.timeout(45)) as response:
+                    permit.record(response.status_code)
+                    attempt.check(response)
+                    if response.status_code != 200:
+                        error_text = (await response.aread()).decode('utf-8', errors='replace')
+                        logger.error(f"Claude API error: {response.status_code} - {error_text}")
+                        yield f"Ошибка при обращении к API Claude: {response.status_code}. Проверьте API ключ и формат запроса."
+                        return
+            
+                    # Ответ приходит как Server-Sent Events; текст содержится в событиях content_block_delta,
+                    # входные токены и кэш - в message_start, итоговое число выходных токенов - в message_delta
+                    usage = {}
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        event = json.loads(line[5:])
+                        if event.get("type") == "content_block_delta" and event["delta"].get("type") == "text_delta":
+                            # После первого фрагмента повтор продублировал бы уже показанный текст
+                            attempt.commit()
+                            yield event["delta"]["text"]
+                        elif event.get("type") == "message_start":
+                            usage.update(event["message"].get("usage") or {})
+                        elif event.get("type") == "message_delta":
+                            usage.update(event.get("usage") or {})
+                        elif event.get("type") == "message_stop":
+                            _record_usage(usage)
+                        elif event.get("type") == "error":
+                            logger.error(f"Claude API stream error: {event.get('error')}")
+                            yield "\nОшибка при получении ответа от API Claude."
+                            return
+    except CircuitOpenError as e:
+        logger.warning(f"Claude API stream skipped: {e}")
+        yield UNAVAILABLE_MESSAGE
+    except httpx.TimeoutException:
+        logger.error("Timeout when streaming from Claude API")
+        _note_deadline_timeout()
+        yield "Ошибка: Превышено время ожидания ответа от API Claude. Пожалуйста, попробуйте позже."
+    except httpx.RequestError as e:
+        logger.error(f"API request error: {e}")
+        yield f"Ошибка при обращении к API Claude: {str(e)}"
+    except json.JSONDecodeError as e:
+        logger.error(f"JSON decode error in stream: {e}")
+        yield "Ошибка при обработке ответа от API Claude."
+
+
+def stream_llm(input_text, system_prompt=None, **kwargs):
+    """
+    Stream a response from Claude 3.5 Haiku.
+    Synchronous generator wrapper around astream_llm.
+    
+    Args:
+        input_text (str): The input text to send to the LLM
+        system_prompt (str, optional): System prompt to guide the model's behavior
+        **kwargs: Additional keyword arguments, including test_mode
+        
+    Yields:
+        str: Text chunks as soon as they arrive from the API
+    """
+    yield from iterate_sync(astream_llm(input_text, system_prompt=system_prompt, **kwargs))
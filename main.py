@@ -3,9 +3,11 @@ Main entry point for the AI agent application.
 """
 import os
 import logging
-from llm_api import query_llm
-from search_api import search_perplexity
-from utils import process_input, format_output, needs_search, combine_input
+from http_client import submit
+from llm_api import query_llm, detect_search_need
+from search_api import asearch_perplexity
+from utils import process_input, format_output, combine_input
+from search_classifier import classify_search_need, is_confident
 
 # Set up console logging in addition to file logging
 console_handler = logging.StreamHandler()
@@ -26,6 +28,24 @@ def check_api_keys():
     
     return missing_keys
 
+def print_streamed_response(chunks):
+    """
+    Печатает ответ модели по мере поступления фрагментов.
+    
+    Args:
+        chunks (iterable): Фрагменты текста ответа
+        
+    Returns:
+        str: Полный отформатированный ответ
+    """
+    print("\n" + "=" * 50)
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        print(chunk, end="", flush=True)
+    print("\n" + "=" * 50 + "\n")
+    return format_output("".join(parts))
+
 def main():
     """Main function to run the AI agent."""
     print("=" * 50)
@@ -72,65 +92,42 @@ def main():
             
             print("Обрабатываю ваш запрос...")
             
-            # Первый шаг: Отправляем запрос пользователя в модель Claude с флагом определения необходимости поиска
+            # Сначала локальный классификатор; если он не уверен, спрашиваем Claude и одновременно
+            # спекулятивно начинаем поиск: если поиск нужен, результаты будут готовы раньше,
+            # если нет - поиск отменяется
             print("Анализирую запрос...")
-            result = query_llm(processed_input, system_prompt=system_prompt, detect_search_needs=True)
-            
-            # Проверяем, вернулся ли кортеж (ответ, search_needed, search_query)
-            if isinstance(result, tuple) and len(result) == 3:
-                initial_response, search_needed, search_query = result
-                
-                # Если модель определила необходимость поиска
-                if search_needed and search_query:
-                    print(f"Выполняю поиск информации по запросу: {search_query}")
-                    
-                    # Выполняем поиск с оптимизированным запросом
-                    search_results = search_perplexity(search_query)
-                    
-                    if search_results:
-                        print("Найдена информация. Формирую окончательный ответ...")
-                        
-                        # Комбинируем исходный запрос пользователя и результаты поиска для финального запроса к модели
-                        combined_prompt = combine_input(processed_input, search_results)
-                        
-                        # Получаем финальный ответ от модели с учетом результатов поиска
-                        final_response = query_llm(combined_prompt, system_prompt=system_prompt)
-                        formatted_response = format_output(final_response)
-                    else:
-                        print("Поиск не дал результатов. Использую первоначальный ответ модели...")
-                        formatted_response = format_output(initial_response)
-                else:
-                    # Если поиск не требуется, используем первоначальный ответ
-                    print("Модель определила, что поиск не требуется. Использую базовые знания.")
-                    formatted_response = format_output(initial_response)
+            local_decision = classify_search_need(processed_input)
+            if is_confident(local_decision) and not local_decision.needs_search:
+                # Запрос явно к знаниям модели: ни поиск, ни классификатор Claude не нужны
+                search_needed, speculative_search = False, None
             else:
-                # Если произошла ошибка при определении необходимости поиска, используем стандартный подход
-                print("Использую стандартный подход для обработки запроса...")
+                speculative_search = submit(asearch_perplexity(processed_input))
+                search_needed, search_query = detect_search_need(processed_input)
+            
+            if not search_needed:
+                if speculative_search is not None:
+                    speculative_search.cancel()
+                print("Поиск не требуется. Использую базовые знания.")
                 
-                # Проверяем необходимость поиска с помощью функции needs_search
-                if needs_search(processed_input):
-                    print("Выполняю поиск информации...")
-                    search_results = search_perplexity(processed_input)
-                    
-                    if search_results:
-                        print("Найдена информация. Формирую ответ...")
-                    else:
-                        print("Поиск не дал результатов. Использую только базовые знания...")
-                    
-                    # Комбинируем запрос и результаты поиска
-                    llm_input = combine_input(processed_input, search_results)
-                else:
-                    print("Использую базовые знания для ответа...")
-                    llm_input = f"Запрос пользователя: {processed_input}\n\nПожалуйста, ответь на этот запрос, используя свои знания."
+                # Ответ без поиска генерируется только сейчас, когда он действительно нужен
+                print_streamed_response(query_llm(processed_input, system_prompt=system_prompt, stream=True))
+                continue
+            
+            logger.info(f"Поиск нужен, оптимизированный запрос модели: {search_query}")
+            print("Выполняю поиск информации...")
+            search_results = speculative_search.result()
+            
+            if search_results:
+                print("Найдена информация. Формирую окончательный ответ...")
                 
-                # Получаем ответ от модели
-                response = query_llm(llm_input, system_prompt=system_prompt)
-                formatted_response = format_output(response)
+                # Комбинируем исходный запрос пользователя и результаты поиска для финального запроса к модели
+                llm_input = combine_input(processed_input, search_results)
+            else:
+                print("Поиск не дал результатов. Использую только базовые знания...")
+                llm_input = processed_input
             
-            # Выводим ответ пользователю
-            print("\n" + "=" * 50)
-            print(formatted_response)
-            print("=" * 50 + "\n")
+            # Получаем финальный ответ от модели, печатая его по мере генерации
+            print_streamed_response(query_llm(llm_input, system_prompt=system_prompt, stream=True))
             
         except KeyboardInterrupt:
             print("\nПрограмма прервана пользователем. До свидания!")
@@ -0,0 +1,210 @@
+"""
+Token-aware packing of search results into the Claude prompt budget.
+"""
+import os
+import re
+import logging
+import threading
+from collections import namedtuple
+from query_normalizer import query_terms
+
+logger = logging.getLogger(__name__)
+
+# Бюджеты в токенах: текст запроса к Claude (промпт combine_input целиком) и системный промпт
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '3000'))
+SYSTEM_PROMPT_TOKEN_BUDGET = int(os.getenv('SYSTEM_PROMPT_TOKEN_BUDGET', '300'))
+
+# Слова, числа и отдельные знаки препинания; пробелы токенизатор склеивает с соседними словами
+_TOKEN_PATTERN = re.compile(r'\d+|[^\W\d]+|[^\w\s]')
+
+# Символов на токен: латиница кодируется плотнее кириллицы, числа делятся на группы цифр
+_CHARS_PER_TOKEN_ASCII = 4
+_CHARS_PER_TOKEN_OTHER = 3
+_DIGITS_PER_TOKEN = 3
+
+# Результат упаковки: текст, его размер в токенах, сколько токенов и разделов не вошло
+PackedContext = namedtuple("PackedContext", ["text", "tokens", "dropped_tokens", "dropped_sections"])
+
+_stats_lock = threading.Lock()
+_stats = {"packed": 0, "over_budget": 0, "dropped_sections": 0, "dropped_tokens": 0, "truncated": 0}
+
+
+def _piece_tokens(piece):
+    """Оценка числа токенов одного слова, числа или знака."""
+    if piece.isdigit():
+        per_token = _DIGITS_PER_TOKEN
+    elif piece.isascii():
+        per_token = _CHARS_PER_TOKEN_ASCII
+    else:
+        per_token = _CHARS_PER_TOKEN_OTHER
+    return -(-len(piece) // per_token)
+
+
+def estimate_tokens(text):
+    """
+    Оценивает число токенов Claude в тексте без обращения к API.
+
+    Оценка намеренно немного завышена для кириллицы, чтобы промпт
+    гарантированно укладывался в бюджет.
+
+    Args:
+        text (str): Текст
+
+    Returns:
+        int: Оценка числа токенов
+    """
+    return sum(_piece_tokens(piece) for piece in _TOKEN_PATTERN.findall(text or ""))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    Обрезает текст так, чтобы он уложился в max_tokens токенов.
+
+    Args:
+        text (str): Текст
+        max_tokens (int): Бюджет в токенах
+
+    Returns:
+        tuple: (обрезанный текст, число отброшенных токенов)
+    """
+    text, dropped = _truncate(text, max_tokens)
+    if dropped:
+        with _stats_lock:
+            _stats["truncated"] += 1
+            _stats["dropped_tokens"] += dropped
+    return text, dropped
+
+
+def _truncate(text, max_tokens):
+    """truncate_to_tokens без учета в счетчиках."""
+    used = 0
+    for match in _TOKEN_PATTERN.finditer(text):
+        used += _piece_tokens(match.group())
+        if used > max_tokens:
+            return text[:match.start()].rstrip(), estimate_tokens(text[match.start():])
+    return text, 0
+
+
+def _is_sources_block(section):
+    """Раздел, в каждой строке которого есть ссылка, - это список источников."""
+    lines = [line for line in section.splitlines() if line.strip()]
+    return bool(lines) and all("http://" in line or "https://" in line for line in lines)
+
+
+def section_relevance(section, *queries):
+    """
+    Доля значимых слов запроса, встречающихся в разделе (лучшая по запросам).
+
+    Args:
+        section (str): Текст раздела
+        *queries (str): Запрос пользователя, подзапрос
+
+    Returns:
+        float: Релевантность от 0 до 1
+    """
+    section_terms = set(query_terms(section))
+    best = 0.0
+    for query in queries:
+        terms = set(query_terms(query))
+        if terms:
+            best = max(best, len(terms & section_terms) / len(terms))
+    return best
+
+
+def _render_packed(search_results, kept):
+    """Собирает текст из выбранных разделов в исходном порядке, с источниками и заголовками "ЗАПРОС:"."""
+    blocks = []
+    for index, result in enumerate(search_results.subqueries):
+        if not result.found:
+            continue
+        sections = [section for position, section in kept if position[0] == index]
+        if not sections:
+            continue
+        text = "\n\n".join(sections)
+        if result.sources:
+            text += "\n\nИСТОЧНИКИ:\n" + "\n".join(result.sources)
+        blocks.append((result.query, text))
+
+    if len(search_results.subqueries) == 1:
+        return blocks[0][1] if blocks else ""
+    return "\n\n=== РЕЗУЛЬТАТЫ ПОИСКА ===\n\n" + "".join(
+        f"ЗАПРОС: {query}\n\n{text}\n\n---\n\n" for query, text in blocks)
+
+
+def pack_search_results(query, search_results, budget):
+    """
+    Укладывает результаты поиска в бюджет токенов.
+
+    Если полный текст результатов помещается, он возвращается без изменений.
+    Иначе разделы всех подзапросов ранжируются по релевантности запросу
+    пользователя и подзапросу и добавляются жадно, пока хватает бюджета;
+    источники подзапроса добавляются вместе с его первым разделом, а
+    выбранные разделы выводятся в исходном порядке.
+
+    Args:
+        query (str): Запрос пользователя
+        search_results (SearchResult): Результаты поиска
+        budget (int): Бюджет в токенах для текста результатов
+
+    Returns:
+        PackedContext: Упакованный текст и статистика отброшенного
+    """
+    full_text = search_results.render()
+    full_tokens = estimate_tokens(full_text)
+    with _stats_lock:
+        _stats["packed"] += 1
+    if full_tokens <= budget:
+        return PackedContext(full_text, full_tokens, 0, 0)
+
+    candidates = []
+    for index, result in enumerate(search_results.subqueries):
+        if not result.found:
+            continue
+        sections = [section for section in result.sections if not _is_sources_block(section)] or [result.content]
+        for order, section in enumerate(sections):
+            score = section_relevance(section, query, result.query)
+            # При равной релевантности раньше идут первые разделы: в них основной ответ
+            candidates.append((-score, order, index, section))
+    candidates.sort(key=lambda candidate: candidate[:3])
+
+    # Заголовки "ЗАПРОС:", "ИСТОЧНИКИ:" и разделители считаем заранее для всех подзапросов, с запасом
+    overhead = "=== РЕЗУЛЬТАТЫ ПОИСКА ===" if len(search_results.subqueries) > 1 else ""
+    used = estimate_tokens(overhead + "".join(f" ЗАПРОС: {result.query} ИСТОЧНИКИ: ---"
+                                              for result in search_results.subqueries if result.found))
+    kept = []
+    with_sources = set()
+    for _, order, index, section in candidates:
+        cost = estimate_tokens(section) + 1
+        if index not in with_sources:
+            cost += estimate_tokens(" ".join(search_results.subqueries[index].sources))
+        if used + cost <= budget:
+            kept.append(((index, order), section))
+            with_sources.add(index)
+            used += cost
+
+    if not kept and candidates:
+        # Даже самый релевантный раздел не помещается целиком: берем его начало
+        _, order, index, section = candidates[0]
+        sources_cost = estimate_tokens(" ".join(search_results.subqueries[index].sources))
+        section, _ = _truncate(section, max(budget - used - sources_cost - 1, 0))
+        if section:
+            kept.append(((index, order), section))
+
+    kept.sort(key=lambda item: item[0])
+    text = _render_packed(search_results, kept)
+    tokens = estimate_tokens(text)
+    dropped_sections = len(candidates) - len(kept)
+    dropped_tokens = max(full_tokens - tokens, 0)
+    with _stats_lock:
+        _stats["over_budget"] += 1
+        _stats["dropped_sections"] += dropped_sections
+        _stats["dropped_tokens"] += dropped_tokens
+    logger.info(f"Результаты поиска ({full_tokens} токенов) не помещаются в бюджет {budget}: "
+                f"отброшено {dropped_sections} разделов, {dropped_tokens} токенов")
+    return PackedContext(text, tokens, dropped_tokens, dropped_sections)
+
+
+def get_prompt_budget_stats():
+    """Возвращает счетчики упаковки промптов: сколько не поместилось и сколько токенов отброшено."""
+    with _stats_lock:
+        return dict(_stats, prompt_token_budget=PROMPT_TOKEN_BUDGET)
@@ -0,0 +1,200 @@
+"""
+Normalization of Russian queries for paraphrase-tolerant caching.
+"""
+import re
+from difflib import SequenceMatcher
+
+# Служебные слова и слова-связки, которые не меняют смысл поискового запроса.
+# Слова текущего времени ("сейчас", "сегодня") тоже убираем: свежесть результата
+# и так гарантирует время жизни записи в кэше.
+STOP_WORDS = frozenset([
+    "в", "во", "на", "по", "о", "об", "обо", "и", "а", "но", "или", "у", "к", "ко",
+    "с", "со", "за", "из", "от", "до", "для", "про", "при", "же", "ли", "бы", "то",
+    "какой", "какая", "какое", "какие", "каков", "какова", "каковы", "что", "как",
+    "скажи", "расскажи", "подскажи", "покажи", "пожалуйста", "мне", "нам", "есть",
+    "это", "этот", "эта", "эти", "такое", "такой", "ну", "вот",
+    "сейчас", "сегодня", "сегодняшний", "теперь", "нынче", "текущий", "текущая",
+    "текущее", "актуальный", "актуальная", "актуальное",
+])
+
+# Окончания русских слов, от длинных к коротким: отбрасываем одно, самое длинное
+_ENDINGS = sorted([
+    "иями", "ями", "ами", "иях", "ях", "ах", "ого", "его", "ому", "ему", "ыми", "ими",
+    "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие", "ых", "их", "ом", "ем",
+    "ам", "ям", "ую", "юю", "ов", "ев", "ью", "ия", "ии", "ию",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+], key=len, reverse=True)
+
+_MIN_STEM_LENGTH = 3
+
+# Предлоги направления: "курс доллара к евро" и "курс евро к доллару", "рейс из Москвы
+# в Казань" и "рейс из Казани в Москву" - разные запросы, поэтому эти предлоги (в отличие
+# от остальных служебных слов) остаются в точном ключе кэша вместе с порядком слов
+DIRECTION_WORDS = {"к": "к", "ко": "к", "в": "в", "во": "в", "из": "из", "до": "до", "от": "от"}
+
+_TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def fold_text(text):
+    """
+    Приводит текст к нижнему регистру и заменяет ё на е.
+
+    Args:
+        text (str): Исходный текст
+
+    Returns:
+        str: Нормализованный текст
+    """
+    return text.lower().replace('ё', 'е')
+
+
+def stem(word):
+    """
+    Облегченный стемминг: отбрасывает типичное русское окончание.
+
+    Args:
+        word (str): Слово в нижнем регистре
+
+    Returns:
+        str: Основа слова
+    """
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM_LENGTH:
+            return word[:-len(ending)]
+    return word
+
+
+def query_terms(text):
+    """
+    Разбивает запрос на значимые основы слов без стоп-слов.
+
+    Args:
+        text (str): Текст запроса
+
+    Returns:
+        list: Основы слов в порядке появления
+    """
+    return [stem(token) for token in _TOKEN_PATTERN.findall(fold_text(text)) if token not in STOP_WORDS]
+
+
+def canonical_query(text):
+    """
+    Строит каноническую форму запроса: основы слов и предлоги направления в исходном порядке.
+
+    Регистр, ё/е, падежные окончания и служебные слова не меняют результат,
+    поэтому "погода в Москве сегодня" и "какая сегодня погода в москве" дают
+    одну и ту же строку. Порядок слов сохраняется: перестановки находит
+    индекс перефразировок, который проверяет и направление (query_directions).
+
+    Args:
+        text (str): Текст запроса
+
+    Returns:
+        str: Каноническая форма запроса
+    """
+    terms = []
+    for token in _TOKEN_PATTERN.findall(fold_text(text)):
+        if token in DIRECTION_WORDS:
+            terms.append(DIRECTION_WORDS[token])
+        elif token not in STOP_WORDS:
+            terms.append(stem(token))
+    if not any(term not in DIRECTION_WORDS for term in terms):
+        return re.sub(r'\s+', ' ', fold_text(text)).strip()
+    return " ".join(terms)
+
+
+def query_directions(text):
+    """
+    Возвращает направления запроса: пары (предлог направления, основа следующего слова).
+
+    Args:
+        text (str): Текст запроса
+
+    Returns:
+        dict: Основа слова после каждого предлога, например {"из": "москв", "в": "казан"}
+    """
+    directions = {}
+    preposition = None
+    for token in _TOKEN_PATTERN.findall(fold_text(text)):
+        if token in DIRECTION_WORDS:
+            preposition = DIRECTION_WORDS[token]
+        elif token not in STOP_WORDS:
+            if preposition is not None:
+                directions.setdefault(preposition, stem(token))
+            preposition = None
+    return directions
+
+
+def directions_conflict(directions, other_directions):
+    """
+    Проверяет, что запросы указывают разные направления одним и тем же предлогом.
+
+    Запрос без предлога ("курс евро доллар") с запросом "курс евро к доллару" не конфликтует.
+
+    Args:
+        directions (dict): Направления первого запроса из query_directions
+        other_directions (dict): Направления второго запроса
+
+    Returns:
+        bool: True, если хотя бы один предлог ведет к разным словам
+    """
+    return any(
+        preposition in other_directions and other_directions[preposition] != target
+        for preposition, target in directions.items()
+    )
+
+
+def query_shingles(text):
+    """
+    Возвращает множество признаков запроса для оценки похожести: основы слов
+    и символьные триграммы основ.
+
+    Args:
+        text (str): Текст запроса
+
+    Returns:
+        frozenset: Признаки запроса
+    """
+    shingles = set()
+    for term in query_terms(text):
+        shingles.add(term)
+        padded = f"#{term}#"
+        shingles.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(shingles)
+
+
+def query_numbers(text):
+    """
+    Возвращает числа из запроса: запросы с разными годами или суммами не считаются похожими.
+
+    Args:
+        text (str): Текст запроса
+
+    Returns:
+        frozenset: Числа, встречающиеся в запросе
+    """
+    return frozenset(re.findall(r'\d+', text))
+
+
+def terms_aligned(terms, other_terms, min_ratio=0.75):
+    """
+    Проверяет, что у каждого слова одного запроса есть близкое слово в другом.
+
+    Защищает от ложных совпадений, когда запросы отличаются целым значимым
+    словом ("курс доллара" и "курс доллара к евро"), но допускает опечатки
+    и варианты написания ("биткоина" и "биткойна").
+
+    Args:
+        terms (set): Основы слов первого запроса
+        other_terms (set): Основы слов второго запроса
+        min_ratio (float): Минимальная посимвольная похожесть основ
+
+    Returns:
+        bool: True, если слова запросов попарно сопоставимы
+    """
+    def covered(source, target):
+        return all(
+            term in target or any(SequenceMatcher(None, term, candidate).ratio() >= min_ratio for candidate in target)
+            for term in source
+        )
+    return covered(terms, other_terms) and covered(other_terms, terms)
@@ -0,0 +1,333 @@
+"""
+Per-upstream token bucket with AIMD adaptive concurrency for the Perplexity and Claude APIs.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+import concurrent.futures
+from collections import deque
+from contextlib import asynccontextmanager
+from http_client import PERPLEXITY, ANTHROPIC
+
+logger = logging.getLogger(__name__)
+
+# Все созданные ограничители, чтобы отдавать их счетчики в /api/metrics
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+# Если в контексте задан список, каждое ожидание ограничителя добавляется в него (время строки в batch_runner)
+queue_wait = contextvars.ContextVar("queue_wait", default=None)
+
+# Сколько последних ожиданий хранить для перцентилей
+_WAIT_WINDOW = 1000
+
+# Лимиты по умолчанию - начальные уровни провайдеров; для своего тарифа задайте {NAME}_RPM
+_DEFAULT_RPM = {PERPLEXITY: 50, ANTHROPIC: 50}
+_DEFAULT_BURST = 10
+
+
+def _env_number(name, default):
+    """Числовая настройка из переменной окружения."""
+    return float(os.getenv(name, default))
+
+
+class UpstreamLimiter:
+    """
+    Ограничивает запросы к одному внешнему сервису двумя способами:
+
+    - корзина токенов: не более rate запросов в секунду с всплеском до burst;
+    - адаптивный лимит одновременных запросов (AIMD): при 429, 5xx, ошибках сети
+      и всплесках задержки лимит уменьшается вдвое, после каждого успешного
+      ответа растет на 1/limit, то есть примерно на 1 за "окно" успешных запросов.
+
+    Ожидающие получают разрешения по очереди (FIFO). Ожидание построено на
+    concurrent.futures.Future, поэтому ограничитель общий для всех event loop.
+    """
+
+    def __init__(self, name, rate, burst=None, max_concurrency=16, min_concurrency=1,
+                 backoff=0.5, spike_factor=3.0):
+        self.name = name
+        self.rate = rate
+        self.burst = burst if burst else max(rate, 1.0)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.backoff = backoff
+        self.spike_factor = spike_factor
+
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        self._limit = float(max_concurrency)
+        self._in_flight = 0
+        self._waiters = deque()
+        self._latency = None
+        self._latency_samples = 0
+        self._decreased_at = 0.0
+        self._waits = deque(maxlen=_WAIT_WINDOW)
+
+        self.acquired = 0
+        self.throttled = 0
+        self.failures = 0
+        self.latency_spikes = 0
+        self.decreases = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def configure(self, rate=None, burst=None, max_concurrency=None):
+        """
+        Меняет настройки ограничителя на лету (например, из batch_runner).
+
+        Args:
+            rate (float, optional): Запросов в секунду, 0 - без ограничения
+            burst (float, optional): Размер всплеска
+            max_concurrency (int, optional): Верхняя граница лимита одновременных запросов
+        """
+        with self._lock:
+            if rate is not None:
+                self.rate = rate
+                self.burst = burst if burst else max(rate, 1.0)
+                self._tokens = min(self._tokens, self.burst)
+            elif burst:
+                self.burst = burst
+            if max_concurrency is not None:
+                self.max_concurrency = max_concurrency
+                self._limit = min(self._limit, float(max_concurrency))
+            self._wake_head()
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _try_take(self, now):
+        """
+        Пытается взять разрешение. Вызывается под блокировкой.
+
+        Returns:
+            float or None: 0, если разрешение получено; время до следующего токена;
+                None, если нужно ждать освобождения места
+        """
+        if self._in_flight >= max(int(self._limit), self.min_concurrency):
+            return None
+        if self.rate > 0:
+            self._refill(now)
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+        self._in_flight += 1
+        return 0.0
+
+    def _wake_head(self):
+        """Будит первого в очереди, чтобы он заново проверил условия. Вызывается под блокировкой."""
+        if self._waiters:
+            future = self._waiters[0][1]
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    async def acquire(self):
+        """
+        Ждет разрешения на запрос.
+
+        Returns:
+            float: Время ожидания в очереди в секундах
+        """
+        start = time.monotonic()
+        entry = [object(), None]
+        with self._lock:
+            if not self._waiters and self._try_take(start) == 0.0:
+                self.acquired += 1
+                self._record_wait(0.0)
+                return 0.0
+            self._waiters.append(entry)
+
+        try:
+            while True:
+                with self._lock:
+                    delay = None
+                    if self._waiters[0] is entry:
+                        delay = self._try_take(time.monotonic())
+                        if delay == 0.0:
+                            self._waiters.popleft()
+                            self._wake_head()
+                            break
+                    entry[1] = concurrent.futures.Future()
+                # Место освобождается по сигналу release; проверяем и по таймауту, чтобы не зависнуть
+                try:
+                    await asyncio.wait_for(asyncio.wrap_future(entry[1]), timeout=delay if delay else 1.0)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._lock:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                self._wake_head()
+            raise
+
+        waited = time.monotonic() - start
+        with self._lock:
+            self.acquired += 1
+            self._record_wait(waited)
+        if waited > 1:
+            logger.info(f"Запрос к {self.name} ждал в очереди ограничителя {waited:.2f} сек.")
+        return waited
+
+    def _record_wait(self, waited):
+        self._waits.append(waited)
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        waits = queue_wait.get()
+        if waits is not None:
+            waits.append(waited)
+
+    def release(self, status=None, latency=None, error=False):
+        """
+        Возвращает разрешение и подстраивает лимит одновременных запросов.
+
+        Args:
+            status (int, optional): HTTP-статус ответа
+            latency (float, optional): Время до получения ответа в секундах
+            error (bool): Запрос завершился ошибкой сети или таймаутом
+        """
+        with self._lock:
+            self._in_flight -= 1
+            now = time.monotonic()
+            spike = (latency is not None and self._latency is not None and self._latency_samples >= 10
+                     and latency > self._latency * self.spike_factor)
+            if status == 429:
+                self.throttled += 1
+                # Провайдер отказал по лимиту: ближайшие запросы ждут нового токена
+                self._tokens = min(self._tokens, 0.0)
+            if error or (status is not None and status >= 500):
+                self.failures += 1
+            if spike:
+                self.latency_spikes += 1
+
+            if error or spike or status == 429 or (status is not None and status >= 500):
+                # Несколько одновременных отказов - один сигнал перегрузки: уменьшаем лимит
+                # не чаще, чем раз за типичное время ответа
+                if now - self._decreased_at >= (self._latency or 0.0):
+                    old_limit = self._limit
+                    self._limit = max(float(self.min_concurrency), self._limit * self.backoff)
+                    self._decreased_at = now
+                    self.decreases += 1
+                    logger.warning(f"Лимит одновременных запросов к {self.name} снижен {old_limit:.1f} -> {self._limit:.1f} "
+                                   f"(статус {status}, задержка {latency if latency is None else round(latency, 2)})")
+            else:
+                self._limit = min(float(self.max_concurrency), self._limit + 1.0 / self._limit)
+                if latency is not None:
+                    self._latency = latency if self._latency is None else self._latency * 0.9 + latency * 0.1
+                    self._latency_samples += 1
+            self._wake_head()
+
+    @asynccontextmanager
+    async def limit(self):
+        """
+        Контекст одного запроса: ждет разрешения и возвращает его при выходе.
+
+        Внутри нужно вызвать permit.record(response.status_code), как только известен
+        статус: задержка считается до этого момента (для потоковых ответов - до заголовков).
+        Исключение внутри контекста считается ошибкой сервиса.
+
+        Yields:
+            _Permit: Разрешение на запрос
+        """
+        await self.acquire()
+        permit = _Permit()
+        try:
+            yield permit
+        except Exception:
+            self.release(permit.status, permit.latency, error=permit.status is None)
+            raise
+        except BaseException:
+            # Отмена вызывающим не говорит о перегрузке сервиса
+            self.release(permit.status, None)
+            raise
+        else:
+            self.release(permit.status, permit.latency if permit.latency is not None else permit.elapsed())
+
+    def stats(self):
+        """
+        Возвращает счетчики ограничителя.
+
+        Returns:
+            dict: Настройки, текущий лимит, очередь, отказы и время ожидания (среднее, p50, p95, максимум)
+        """
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "concurrency_limit": round(self._limit, 2),
+                "in_flight": self._in_flight,
+                "queued": len(self._waiters),
+                "acquired": self.acquired,
+                "throttled": self.throttled,
+                "failures": self.failures,
+                "latency_spikes": self.latency_spikes,
+                "decreases": self.decreases,
+                "latency_ewma": round(self._latency, 3) if self._latency is not None else None,
+                "queue_wait_avg": round(self.total_wait / self.acquired, 4) if self.acquired else 0.0,
+                "queue_wait_p50": round(waits[len(waits) // 2], 4) if waits else 0.0,
+                "queue_wait_p95": round(waits[int(len(waits) * 0.95)], 4) if waits else 0.0,
+                "queue_wait_max": round(self.max_wait, 4),
+            }
+
+
+class _Permit:
+    """Разрешение на один запрос: запоминает статус и задержку ответа."""
+
+    __slots__ = ("status", "latency", "_start")
+
+    def __init__(self):
+        self.status = None
+        self.latency = None
+        self._start = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self._start
+
+    def record(self, status):
+        """
+        Запоминает статус ответа и задержку до его получения.
+
+        Args:
+            status (int): HTTP-статус
+        """
+        self.status = status
+        self.latency = self.elapsed()
+
+
+def get_limiter(name):
+    """
+    Возвращает общий ограничитель внешнего сервиса, создавая его по настройкам окружения.
+
+    Настройки: {NAME}_RPM (запросов в минуту, 0 - без ограничения), {NAME}_BURST,
+    {NAME}_MAX_CONCURRENCY, где NAME - PERPLEXITY или ANTHROPIC.
+
+    Args:
+        name (str): Имя сервиса (http_client.PERPLEXITY, http_client.ANTHROPIC)
+
+    Returns:
+        UpstreamLimiter: Ограничитель
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            prefix = name.upper()
+            limiter = _limiters[name] = UpstreamLimiter(
+                name,
+                rate=_env_number(f"{prefix}_RPM", _DEFAULT_RPM.get(name, 0)) / 60,
+                burst=_env_number(f"{prefix}_BURST", _DEFAULT_BURST),
+                max_concurrency=int(_env_number(f"{prefix}_MAX_CONCURRENCY", 16)),
+            )
+        return limiter
+
+
+def get_rate_limiter_stats():
+    """Возвращает счетчики ограничителей всех внешних сервисов."""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.stats() for limiter in limiters}
@@ -0,0 +1,118 @@
+"""
+Single-pass parser for the sections and sources of Perplexity answers.
+"""
+import re
+from bisect import bisect_left
+
+# Один проход находит все интересующие нас элементы ответа: ссылки, маркеры
+# разделов "1)"/"1." ... "3)"/"3." и слово "источник" в любом регистре.
+# Ссылки проверяются первыми, поэтому "1." внутри URL не считается маркером.
+_TOKEN_PATTERN = re.compile(
+    r'(?P<url>https?://[^\s)"\\]+)'
+    r'|(?P<marker>[123])[.)]'
+    r'|(?P<sources>(?i:источник)(?i:и)?)'
+)
+
+# Заголовок раздела источников, завершающий разделы 2 и 3
+_SOURCES_HEADINGS = frozenset(["ИСТОЧНИКИ", "Источники", "источники"])
+
+
+class _Tokens:
+    """Позиции элементов ответа, собранные за один проход по тексту."""
+
+    def __init__(self, content):
+        self.markers = {"1": [], "2": [], "3": []}
+        self.closed_markers = set()
+        self.headings = []
+        self.sources_words = []
+        self.urls = []
+        for match in _TOKEN_PATTERN.finditer(content):
+            kind = match.lastgroup
+            if kind == "url":
+                self.urls.append((match.start(), match.group()))
+            elif kind == "marker":
+                digit = match.group("marker")
+                self.markers[digit].append(match.start())
+                if match.group().endswith(")"):
+                    self.closed_markers.add(digit)
+            else:
+                self.sources_words.append(match.start())
+                if match.group() in _SOURCES_HEADINGS:
+                    self.headings.append(match.start())
+
+
+def _first_at_or_after(positions, start, default=None):
+    """Возвращает первую позицию из отсортированного списка, не меньшую start."""
+    index = bisect_left(positions, start)
+    return positions[index] if index < len(positions) else default
+
+
+def _line_end(content, position):
+    """Позиция конца строки, на которой находится position (заголовок раздела пропускается)."""
+    end = content.find('\n', position)
+    return len(content) if end == -1 else end
+
+
+def parse_search_content(content):
+    """
+    Разбирает ответ Perplexity на разделы и источники за время O(n).
+
+    Разделы 1-3 начинаются с маркеров "1)"/"1." ... "3)"/"3." (строка с маркером
+    считается заголовком и пропускается) и продолжаются до следующего раздела
+    или заголовка "Источники"; раздел источников идет до конца текста. Если в
+    тексте нет маркеров "1)" и "2)", он делится на разделы по пустым строкам.
+
+    Args:
+        content (str): Текст ответа
+
+    Returns:
+        dict: {"sections": список текстов разделов, "sources": список URL,
+               "has_sources": упоминаются ли в ответе источники}
+    """
+    tokens = _Tokens(content)
+    end_of_text = len(content)
+    spans = []
+
+    if {"1", "2"} <= tokens.closed_markers:
+        first_markers = tokens.markers["1"]
+        if first_markers:
+            start = _line_end(content, first_markers[0])
+            end = _first_at_or_after(tokens.markers["2"], start)
+            if end is not None:
+                spans.append((start, end))
+
+        if tokens.markers["2"]:
+            start = _line_end(content, tokens.markers["2"][0])
+            end = min(_first_at_or_after(tokens.markers["3"], start, end_of_text),
+                      _first_at_or_after(tokens.headings, start, end_of_text))
+            spans.append((start, end))
+
+        if tokens.markers["3"]:
+            start = _line_end(content, tokens.markers["3"][0])
+            spans.append((start, _first_at_or_after(tokens.headings, start, end_of_text)))
+
+        if tokens.headings:
+            spans.append((_line_end(content, tokens.headings[0]), end_of_text))
+
+        spans = [(start, end) for start, end in spans if content[start:end].strip()]
+
+    if spans:
+        sections = [content[start:end].strip() for start, end in spans]
+    else:
+        sections = [part.strip() for part in content.split('\n\n') if part.strip()]
+
+    has_sources = bool(tokens.sources_words)
+    sources = []
+    if has_sources:
+        # Источники берем из последнего раздела, если разделов три и больше,
+        # иначе из текста, начиная с первого упоминания источников
+        if len(sections) < 3:
+            block_start, block_end = tokens.sources_words[0], end_of_text
+        elif spans:
+            block_start, block_end = spans[-1]
+        else:
+            block_start = content.rfind(sections[-1])
+            block_end = block_start + len(sections[-1])
+        sources = [url for position, url in tokens.urls if block_start <= position < block_end]
+
+    return {"sections": sections, "sources": sources, "has_sources": has_sources}
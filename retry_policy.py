@@ -0,0 +1,261 @@
+"""
+Shared retry policy for upstream calls: capped exponential backoff with full jitter and Retry-After.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+import email.utils
+from collections import Counter
+import httpx
+from http_client import PERPLEXITY, ANTHROPIC
+from deadline import time_left
+
+logger = logging.getLogger(__name__)
+
+# Статусы временных сбоев: 408 таймаут, 425/429 слишком рано или слишком часто,
+# 5xx ошибки шлюза и сервиса, 529 перегрузка Anthropic
+RETRY_STATUSES = frozenset([408, 425, 429, 500, 502, 503, 504, 529])
+
+# Ошибки, при которых запрос заведомо не дошел до сервиса: повтор безопасен всегда
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# Ошибки, после которых запрос мог быть обработан: повтор только для идемпотентных вызовов
+_TRANSIENT_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+# Не начинаем новую попытку, если до конца бюджета осталось меньше этого времени
+_MIN_ATTEMPT_TIME = 0.5
+
+# Бюджеты по умолчанию совпадают с прежними таймаутами одного запроса
+_DEFAULT_BUDGETS = {PERPLEXITY: 60, ANTHROPIC: 45}
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def parse_retry_after(response):
+    """
+    Читает задержку из заголовков Retry-After (секунды или HTTP-дата) и retry-after-ms.
+
+    Args:
+        response (httpx.Response): Ответ сервиса
+
+    Returns:
+        float or None: Задержка в секундах или None, если заголовка нет
+    """
+    value = response.headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(float(value) / 1000, 0.0)
+        except ValueError:
+            pass
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class _RetryableStatus(Exception):
+    """Ответ с временной ошибкой, который нужно повторить."""
+
+    def __init__(self, status, delay):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.delay = delay
+
+
+class RetryPolicy:
+    """
+    Политика повторов для одного внешнего сервиса.
+
+    Задержка перед попыткой n - случайная величина от 0 до min(max_delay, base_delay * 2**n)
+    ("full jitter"), либо значение Retry-After, если сервис его прислал. Все попытки
+    вместе с паузами укладываются в бюджет времени вызова.
+
+    Использование:
+
+        async for attempt in policy.attempts():
+            async with attempt:
+                response = await client.post(..., timeout=attempt.timeout(60))
+                attempt.check(response)
+    """
+
+    def __init__(self, name, max_attempts=3, base_delay=0.5, max_delay=8.0, budget=60.0):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.recovered = 0
+        self.exhausted = 0
+        self.reasons = Counter()
+
+    def backoff(self, attempt_number):
+        """Случайная задержка перед повтором после попытки attempt_number (с 1)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt_number - 1)))
+
+    async def attempts(self, budget=None, idempotent=True):
+        """
+        Выдает попытки вызова, пока предыдущая требует повтора.
+
+        Args:
+            budget (float, optional): Бюджет времени вызова в секундах (по умолчанию self.budget);
+                не выходит за срок запроса пользователя (deadline), если он задан
+            idempotent (bool): Можно ли повторять запрос, который мог дойти до сервиса
+
+        Yields:
+            _Attempt: Контекст очередной попытки
+        """
+        deadline = time.monotonic() + time_left(budget if budget is not None else self.budget)
+        with self._lock:
+            self.calls += 1
+        number = 0
+        while True:
+            number += 1
+            attempt = _Attempt(self, number, deadline, idempotent)
+            yield attempt
+            if attempt.retry_delay is None:
+                if number > 1 and attempt.succeeded:
+                    with self._lock:
+                        self.recovered += 1
+                return
+            await asyncio.sleep(attempt.retry_delay)
+
+    def _plan_retry(self, attempt, reason, retry_after=None):
+        """
+        Решает, повторять ли попытку, и учитывает решение в счетчиках.
+
+        Returns:
+            float or None: Задержка перед повтором или None, если повтора не будет
+        """
+        delay = retry_after if retry_after is not None else self.backoff(attempt.number)
+        remaining = attempt.deadline - time.monotonic()
+        can_retry = attempt.number < self.max_attempts and delay + _MIN_ATTEMPT_TIME <= remaining
+        with self._lock:
+            self.reasons[reason] += 1
+            if can_retry:
+                self.retries += 1
+            else:
+                self.exhausted += 1
+        if not can_retry:
+            logger.warning(f"Запрос к {self.name} не повторяется после попытки {attempt.number} ({reason}): "
+                           f"попыток {self.max_attempts}, осталось {max(remaining, 0):.1f} сек. бюджета")
+            return None
+        logger.warning(f"Запрос к {self.name}: {reason}, попытка {attempt.number + 1} через {delay:.2f} сек.")
+        return delay
+
+    def stats(self):
+        """
+        Возвращает счетчики политики.
+
+        Returns:
+            dict: Число вызовов, повторов, восстановленных после повтора вызовов,
+                вызовов с исчерпанными попытками и причины повторов
+        """
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "recovered": self.recovered,
+                "exhausted": self.exhausted,
+                "reasons": dict(self.reasons),
+            }
+
+
+class _Attempt:
+    """Одна попытка вызова: таймаут с учетом бюджета, проверка ответа и решение о повторе."""
+
+    def __init__(self, policy, number, deadline, idempotent):
+        self.policy = policy
+        self.number = number
+        self.deadline = deadline
+        self.idempotent = idempotent
+        self.committed = False
+        self.succeeded = False
+        self.retry_delay = None
+
+    def timeout(self, default):
+        """Таймаут запроса: не больше default и не дольше оставшегося бюджета."""
+        return max(min(default, self.deadline - time.monotonic()), 0.1)
+
+    def commit(self):
+        """Отмечает, что результат уже начал передаваться (например, первый фрагмент потока) - повторять нельзя."""
+        self.committed = True
+
+    def check(self, response):
+        """
+        Проверяет статус ответа; при временной ошибке, если повтор возможен, прерывает попытку.
+
+        Ответ с ошибкой, который повторить нельзя, возвращается вызывающему как есть.
+
+        Args:
+            response (httpx.Response): Ответ сервиса
+        """
+        if response.status_code not in RETRY_STATUSES or self.committed:
+            return
+        delay = self.policy._plan_retry(self, f"HTTP {response.status_code}", parse_retry_after(response))
+        if delay is not None:
+            raise _RetryableStatus(response.status_code, delay)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        if exc is None:
+            self.succeeded = True
+            return False
+        if isinstance(exc, _RetryableStatus):
+            self.retry_delay = exc.delay
+            return True
+        if self.committed or not isinstance(exc, _TRANSIENT_ERRORS):
+            return False
+        if not self.idempotent and not isinstance(exc, _NOT_SENT_ERRORS):
+            return False
+        self.retry_delay = self.policy._plan_retry(self, type(exc).__name__)
+        return self.retry_delay is not None
+
+
+def get_retry_policy(name):
+    """
+    Возвращает общую политику повторов внешнего сервиса, создавая ее по настройкам окружения.
+
+    Настройки: {NAME}_MAX_ATTEMPTS (по умолчанию 3), {NAME}_RETRY_BUDGET (секунд на вызов
+    вместе с повторами), RETRY_BASE_DELAY и RETRY_MAX_DELAY, где NAME - PERPLEXITY или ANTHROPIC.
+
+    Args:
+        name (str): Имя сервиса (http_client.PERPLEXITY, http_client.ANTHROPIC)
+
+    Returns:
+        RetryPolicy: Политика повторов
+    """
+    with _policies_lock:
+        policy = _policies.get(name)
+        if policy is None:
+            prefix = name.upper()
+            policy = _policies[name] = RetryPolicy(
+                name,
+                max_attempts=int(os.getenv(f"{prefix}_MAX_ATTEMPTS", "3")),
+                base_delay=float(os.getenv("RETRY_BASE_DELAY", "0.5")),
+                max_delay=float(os.getenv("RETRY_MAX_DELAY", "8")),
+                budget=float(os.getenv(f"{prefix}_RETRY_BUDGET", str(_DEFAULT_BUDGETS.get(name, 60)))),
+            )
+        return policy
+
+
+def get_retry_stats():
+    """Возвращает счетчики повторов всех внешних сервисов."""
+    with _policies_lock:
+        policies = list(_policies.values())
+    return {policy.name: policy.stats() for policy in policies}
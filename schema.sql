@@ -1,9 +1,12 @@
 
 CREATE TABLE IF NOT EXISTS chats (
     id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL DEFAULT '',
     timestamp TEXT NOT NULL,
     user_input TEXT NOT NULL,
     response TEXT NOT NULL,
     search_performed INTEGER NOT NULL,
     test_mode INTEGER NOT NULL
 );
+
+CREATE INDEX IF NOT EXISTS idx_chats_session_timestamp ON chats (session_id, timestamp, id);
@@ -2,14 +2,75 @@
 Module for interacting with Perplexity API for search functionality.
 """
 import os
-import requests
+import httpx
 import logging
 import json
 import time
-import re
+import asyncio
+from http_client import get_async_client, run_sync, iterate_sync, PERPLEXITY
+from circuit_breaker import upstream_call, CircuitOpenError
+from retry_policy import get_retry_policy
+from deadline import current_deadline
+import search_cache
+from singleflight import SingleFlight
+from keyword_engine import KeywordEngine
+from response_parser import parse_search_content
+from search_models import SearchResult, SubQueryResult
+from dataclasses import replace
 
 logger = logging.getLogger(__name__)
 
+# Объединяет одновременные одинаковые подзапросы к Perplexity
+perplexity_flight = SingleFlight("perplexity")
+
+# Разделители для сложных запросов, в порядке приоритета
+QUERY_SEPARATORS = ['. и ', ' и ', '. а также ', '. также ', '. кроме того, ', '. при этом ', '. еще ', '. плюс ']
+
+# Текст подзапроса, пропущенного из-за разомкнутого автомата Perplexity (circuit_breaker)
+UNAVAILABLE_MESSAGE = "Поиск временно недоступен."
+
+# Текст подзапроса, не успевшего завершиться до срока запроса (deadline)
+TIMEOUT_MESSAGE = "Поиск не успел завершиться."
+
+# Результат корутины, не завершившейся в отведенное время (_run_until)
+_TIMED_OUT = object()
+
+# Компании, для которых поиск уточняется запросом капитализации или цены акций
+KNOWN_COMPANIES = ["apple", "google", "microsoft", "amazon", "сбербанк", "газпром", "яндекс", "tesla"]
+
+# Ключевые слова тем запроса: собираются в одно выражение при импорте,
+# и каждая функция находит все темы запроса за один проход
+TOPIC_KEYWORDS = KeywordEngine({
+    "weather": ["погода", "температура", "осадки"],
+    "company": KNOWN_COMPANIES + ["компании", "корпорации"],
+    "capitalization": ["капитализац"],
+    "stock": ["акци"],
+    "financial": ["компани", "капитализац", "биржа", "акци", "бизнес", "рейтинг", "топ"],
+    "crypto": ["крипто", "биткоин", "bitcoin", "eth", "блокчейн"],
+    # Признаки разных тем в одном запросе, по которым его можно разделить на части
+    "split_weather": ["погода", "погоде", "погоду", "погоды", "температура", "температуре", "температуры", "осадки", "осадков"],
+    "split_financial": ["компания", "компаний", "компании", "акция", "акций", "акции", "капитализация",
+                        "капитализаций", "капитализации", "рынок", "биржа", "рейтинг", "топ"],
+    "split_crypto": ["крипто", "биткоин", "ethereum", "блокчейн"],
+})
+
+# Ключевые слова тестовых ответов generate_test_response
+TEST_RESPONSE_KEYWORDS = KeywordEngine({
+    "capitalization": ["капитализац"],
+    "apple": ["apple"],
+    "google": ["google", "alphabet"],
+    "microsoft": ["microsoft"],
+    "weather": ["погода", "температура", "осадки"],
+    "moscow": ["москв"],
+    "currency": ["курс", "доллар", "евро", "валют"],
+    "crypto": ["биткоин", "крипто", "bitcoin", "eth"],
+    "stocks": ["акции", "акция", "компания", "компании"],
+    "programming": ["язык", "языки", "программирование", "разработка", "code", "coding"],
+    "future": ["будущ", "технологии", "трендов", "популярн", "2025", "2026"],
+    "space": ["запуск", "ракет", "spaceх", "космос", "миссия", "космическ"],
+    "pushkin": ["пушкин", "александр сергеевич"],
+})
+
 def split_complex_query(query):
     """
     Разделяет сложный запрос на несколько простых подзапросов.
@@ -20,12 +81,10 @@ def split_complex_query(query):
     Returns:
         list: Список подзапросов
     """
-    # Разделители для сложных запросов
-    separators = ['. и ', ' и ', '. а также ', '. также ', '. кроме того, ', '. при этом ', '. еще ', '. плюс ']
-    
     # Ищем разделители в запросе
-    for separator in separators:
-        if separator.lower() in query.lower():
+    query_lower = query.lower()
+    for separator in QUERY_SEPARATORS:
+        if separator in query_lower:
             parts = query.split(separator, 1)
             # Рекурсивно разделяем дальше, если необходимо
             result = [parts[0]]
@@ -34,15 +93,10 @@ def split_complex_query(query):
             return result
     
     # Проверка на запрос с двумя разными темами
-    import re
-    weather_pattern = re.compile(r'погод[аеуы]|температур[аеы]|осадк[иов]')
-    financial_pattern = re.compile(r'компани[яйи]|акци[яйи]|капитализаци[яйи]|рынок|биржа|рейтинг|топ')
-    crypto_pattern = re.compile(r'крипто|биткоин|ethereum|блокчейн')
+    topics = TOPIC_KEYWORDS.match(query)
     
     # Если есть признаки двух разных тем, разделяем запрос по точке или запятой
-    topics_count = sum([1 if weather_pattern.search(query.lower()) else 0,
-                      1 if financial_pattern.search(query.lower()) else 0,
-                      1 if crypto_pattern.search(query.lower()) else 0])
+    topics_count = len(topics & {"split_weather", "split_financial", "split_crypto"})
     
     if topics_count > 1:
         for split_char in ['. ', ', ']:
@@ -54,30 +108,54 @@ def split_complex_query(query):
     # Если не нашли разделителей, возвращаем исходный запрос как единственный элемент списка
     return [query]
 
-def enhance_query(query):
+def classify_query_topic(query):
+    """
+    Определяет тему запроса, от которой зависят уточнения поиска и свежесть кэша.
+    
+    Args:
+        query (str): Исходный запрос
+        
+    Returns:
+        str: Одна из тем: weather, capitalization, stock, financial, crypto, general
+    """
+    topics = TOPIC_KEYWORDS.match(query)
+    
+    if "weather" in topics:
+        return "weather"
+    elif "capitalization" in topics and "company" in topics:
+        return "capitalization"
+    elif "stock" in topics and "company" in topics:
+        return "stock"
+    elif "financial" in topics:
+        return "financial"
+    elif "crypto" in topics:
+        return "crypto"
+    return "general"
+
+def enhance_query(query, topic=None):
     """
     Улучшает запрос, добавляя уточнения в зависимости от типа запроса.
     
     Args:
         query (str): Исходный запрос
+        topic (str, optional): Тема запроса, если уже определена через classify_query_topic
         
     Returns:
         str: Улучшенный запрос
     """
-    query_lower = query.lower()
+    if topic is None:
+        topic = classify_query_topic(query)
     
     # Определяем тип запроса
-    if any(word in query_lower for word in ["погода", "температура", "осадки"]):
+    if topic == "weather":
         # Для погоды добавляем требование актуальности
         return f"{query}. Найди актуальный прогноз погоды с указанием даты и источника данных."
     
     # Проверяем запрос на капитализацию компаний
-    elif "капитализац" in query_lower and any(company in query_lower for company in ["apple", "google", "microsoft", "amazon", "сбербанк", "газпром", "яндекс", "tesla", "компании", "корпорации"]):
+    elif topic == "capitalization":
         # Извлекаем название компании из запроса
-        company_names = []
-        for company in ["apple", "google", "microsoft", "amazon", "сбербанк", "газпром", "яндекс", "tesla"]:
-            if company in query_lower:
-                company_names.append(company)
+        mentioned = TOPIC_KEYWORDS.scan(query).get("company", set())
+        company_names = [company for company in KNOWN_COMPANIES if company in mentioned]
         
         company_str = ", ".join(company_names) if company_names else "указанной компании"
         
@@ -88,18 +166,18 @@ def enhance_query(query):
                 f"с самыми актуальными данными - Bloomberg, Yahoo Finance, MarketWatch, Reuters или Google Finance.")
     
     # Проверяем запрос на акции компаний
-    elif "акци" in query_lower and any(company in query_lower for company in ["apple", "google", "microsoft", "amazon", "сбербанк", "газпром", "яндекс", "tesla", "компании", "корпорации"]):
+    elif topic == "stock":
         # Специальное улучшение для запросов о ценах акций
         return (f"{query}. Укажи ТОЛЬКО текущую цену акций на сегодняшний день. ОБЯЗАТЕЛЬНО укажи "
                 f"точную цифру стоимости за акцию, биржевой тикер, дату и источник данных - биржу или "
                 f"финансовый портал. Используй данные из Yahoo Finance, Bloomberg, MarketWatch или Reuters.")
     
     # Общие финансовые запросы
-    elif any(word in query_lower for word in ["компани", "капитализац", "биржа", "акци", "бизнес", "рейтинг", "топ"]):
+    elif topic == "financial":
         # Для финансовых запросов добавляем требование актуальности и точности
         return f"{query}. Предоставь ТОЛЬКО актуальные данные на текущую дату. Укажи точные цифры и источники информации (биржа, финансовый портал, годовой отчет компании)."
     
-    elif any(word in query_lower for word in ["крипто", "биткоин", "bitcoin", "eth", "блокчейн"]):
+    elif topic == "crypto":
         # Для крипто-запросов
         return f"{query}. Предоставь ТОЛЬКО самые актуальные данные с сегодняшней даты. Укажи текущие цены и источники (биржи, криптовалютные трекеры)."
     
@@ -119,12 +197,12 @@ def generate_test_response(query):
     Returns:
         str: Сгенерированный ответ для тестирования
     """
-    query_lower = query.lower()
+    topics = TEST_RESPONSE_KEYWORDS.match(query)
     current_date = time.strftime("%d.%m.%Y")
     
     # Обработка запросов о капитализации компаний
-    if "капитализац" in query_lower:
-        if "apple" in query_lower:
+    if "capitalization" in topics:
+        if "apple" in topics:
             return f"""По состоянию на {current_date}, рыночная капитализация Apple Inc. (AAPL) составляет **$3.44 триллиона долларов США**. Это делает Apple самой дорогой публичной компанией в мире по рыночной стоимости.
 
 Данные о капитализации основаны на текущей цене акций $224.32 за акцию и общем количестве выпущенных акций в обращении 15.33 миллиарда.
@@ -136,7 +214,7 @@ def generate_test_response(query):
 
 Обратите внимание, что рыночная капитализация может меняться в течение дня в зависимости от колебаний цены акций компании на бирже NASDAQ."""
         
-        elif "google" in query_lower or "alphabet" in query_lower:
+        elif "google" in topics:
             return f"""По состоянию на {current_date}, рыночная капитализация Alphabet Inc. (материнской компании Google) составляет **$2.12 триллиона долларов США**.
 
 Эта оценка основана на текущих ценах акций:
@@ -150,7 +228,7 @@ Alphabet имеет две основные категории акций, то
 - [Bloomberg](https://www.bloomberg.com/quote/GOOGL:US)
 - [NASDAQ](https://www.nasdaq.com/market-activity/stocks/googl)"""
         
-        elif "microsoft" in query_lower:
+        elif "microsoft" in topics:
             return f"""По состоянию на {current_date}, рыночная капитализация Microsoft Corporation (MSFT) составляет **$3.01 триллиона долларов США**.
 
 Данная оценка основана на текущей цене акций Microsoft $402.78 за акцию при общем количестве выпущенных акций в обращении около 7.47 миллиарда.
@@ -176,8 +254,8 @@ Microsoft является одной из крупнейших компаний
 Рыночная капитализация компаний постоянно меняется в зависимости от цены акций. Крупнейшими компаниями по капитализации в мире на текущий момент являются Apple, Microsoft, Saudi Aramco, Alphabet (Google) и Amazon."""
     
     # Обработка запросов о погоде
-    elif any(word in query_lower for word in ["погода", "температура", "осадки"]):
-        if "москв" in query_lower:
+    elif "weather" in topics:
+        if "moscow" in topics:
             return f"""Погода в Москве на {current_date}:
 - Температура: +7°C (ощущается как +5°C)
 - Облачность: переменная облачность
@@ -204,7 +282,7 @@ Microsoft является одной из крупнейших компаний
 - Гидрометцентр России"""
     
     # Обработка запросов о курсе валют
-    elif any(word in query_lower for word in ["курс", "доллар", "евро", "валют"]):
+    elif "currency" in topics:
         return f"""По состоянию на {current_date}, официальные курсы основных валют по данным Центрального Банка России:
 
 - 1 USD (Доллар США) = 89.53 RUB (российских рублей)
@@ -220,7 +298,7 @@ Microsoft является одной из крупнейших компаний
 - Reuters (reuters.com)"""
     
     # Обработка запросов о криптовалютах
-    elif any(word in query_lower for word in ["биткоин", "крипто", "bitcoin", "eth"]):
+    elif "crypto" in topics:
         return f"""По состоянию на {current_date}, курсы основных криптовалют:
 
 - Bitcoin (BTC): $92,467 (+2.1% за 24ч)
@@ -238,8 +316,8 @@ Microsoft является одной из крупнейших компаний
 - CoinDesk (coindesk.com)"""
     
     # Запросы о компаниях и акциях
-    elif any(word in query_lower for word in ["акции", "акция", "компания", "компании"]):
-        if "apple" in query_lower:
+    elif "stocks" in topics:
+        if "apple" in topics:
             return f"""По состоянию на {current_date}, акции Apple Inc. (тикер: AAPL) торгуются на NASDAQ по цене **$224.32 за акцию**. Изменение за последние сутки: +1.8% (+$3.97).
 
 Основные финансовые показатели Apple:
@@ -272,7 +350,7 @@ Microsoft является одной из крупнейших компаний
 - MarketWatch (marketwatch.com)"""
     
     # Запрос с недостаточной информацией
-    elif len(query_lower) < 10 or query_lower in ["расскажи про", "расскажи о", "что такое"]:
+    elif len(query) < 10 or query.lower() in ["расскажи про", "расскажи о", "что такое"]:
         return """Похоже, что ваш запрос слишком короткий или не содержит конкретной темы. Для получения полезной информации, пожалуйста, сформулируйте более конкретный вопрос, указав тему или предмет интереса.
 
 Например, вместо "расскажи про" вы можете спросить "расскажи про искусственный интеллект" или "что такое блокчейн".
@@ -280,7 +358,7 @@ Microsoft является одной из крупнейших компаний
 Я готов помочь с информацией по широкому кругу тем, включая науку, технологии, историю, культуру и актуальные события."""
     
     # Запросы о языках программирования
-    elif any(word in query_lower for word in ["язык", "языки", "программирование", "разработка", "code", "coding"]):
+    elif "programming" in topics:
         return f"""По состоянию на {current_date}, самые популярные языки программирования по данным TIOBE Index и GitHub:
 
 1. Python - 17.2% (↑1.2%) - особенно популярен в области машинного обучения, анализа данных и веб-разработки (Django, Flask)
@@ -307,7 +385,7 @@ Microsoft является одной из крупнейших компаний
 - [IEEE Spectrum](https://spectrum.ieee.org/)"""
     
     # Запросы о технологиях будущего
-    elif any(word in query_lower for word in ["будущ", "технологии", "трендов", "популярн", "2025", "2026"]):
+    elif "future" in topics:
         return f"""Согласно отчетам ведущих аналитических агентств (Gartner, Forrester, McKinsey), к 2026 году ожидается значительное развитие следующих технологий:
 
 1. **Искусственный интеллект и машинное обучение**
@@ -347,7 +425,7 @@ Microsoft является одной из крупнейших компаний
 - [McKinsey Technology Trends Outlook](https://www.mckinsey.com/capabilities/mckinsey-digital/our-insights)"""
     
     # Запросы о космических запусках
-    elif any(word in query_lower for word in ["запуск", "ракет", "spaceх", "космос", "миссия", "космическ"]):
+    elif "space" in topics:
         return f"""За последний месяц (до {current_date}) состоялись следующие значимые космические запуски:
 
 1. **SpaceX Falcon 9 - Starlink Group 6-48**
@@ -398,7 +476,7 @@ Microsoft является одной из крупнейших компаний
 - [Spaceflight Now](https://spaceflightnow.com/launch-schedule/)"""
     
     # Запросы о знаменитых личностях
-    elif "пушкин" in query_lower or "александр сергеевич" in query_lower:
+    elif "pushkin" in topics:
         return f"""Александр Сергеевич Пушкин (6 июня [26 мая по старому стилю] 1799, Москва — 10 февраля [29 января по старому стилю] 1837, Санкт-Петербург) — русский поэт, драматург и прозаик, создатель современного русского литературного языка, один из самых авторитетных литературных деятелей первой трети XIX века.
 
 Основные факты:
@@ -439,16 +517,174 @@ Microsoft является одной из крупнейших компаний
 Дата обработки запроса: {current_date}"""
 
 
-def search_perplexity(query, test_mode=False):
+def _parse_search_response(subquery, response_data):
     """
-    Поиск информации с использованием Perplexity API.
+    Разбирает ответ Perplexity API для одного подзапроса.
+    
+    Args:
+        subquery (str): Подзапрос, для которого получен ответ
+        response_data (dict): Декодированный JSON ответа API
+        
+    Returns:
+        SubQueryResult: Результат подзапроса с разделами и источниками
+    """
+    # Логируем статус ответа
+    logger.info(f"Perplexity API вернул ID: {response_data.get('id', 'N/A')}")
+    
+    # Process and format the search results
+    if "choices" in response_data and len(response_data["choices"]) > 0:
+        # Extract the content from the response
+        content = response_data["choices"][0]["message"]["content"]
+        logger.info(f"Получен ответ от Perplexity длиной {len(content)} символов")
+        logger.info(f"Начало ответа: {content[:200]}...")
+    
+        # Разделы, источники и ссылки находим за один проход по тексту
+        parsed = parse_search_content(content)
+        sections = parsed["sections"]
+        sources = parsed["sources"]
+    
+        # Логируем найденные секции
+        logger.info(f"Разделено на {len(sections)} секций")
+        for i, section in enumerate(sections[:3]):
+            logger.info(f"Секция {i+1} (до 100 символов): {section[:100]}...")
+        if sources:
+            logger.info(f"Извлечены источники: {sources}")
+    
+        logger.info(f"Подготовлены результаты поиска от Perplexity API: {len(sections)} секций и {len(sources)} источников")
+    
+        # Возвращаем результат подзапроса; текст для промпта собирается позже, в SearchResult.render
+        return SubQueryResult(subquery, content, sections, sources, model=response_data.get("model") or "sonar")
+    else:
+        logger.warning(f"Результаты поиска не найдены в ответе Perplexity: {response_data}")
+        return SubQueryResult(subquery, "Информация по запросу не найдена.", found=False)
+
+
+def _build_search_payload(search_query, stream=False):
+    """
+    Формирует тело запроса к Perplexity API для улучшенного подзапроса.
+    
+    Args:
+        search_query (str): Подзапрос после enhance_query
+        stream (bool): Запросить потоковую выдачу токенов
+        
+    Returns:
+        dict: Тело запроса
+    """
+    # Формируем запрос к API с использованием модели "sonar" согласно документации
+    data = {
+        "model": "sonar",
+        "messages": [
+            {
+                "role": "system",
+                "content": "Ты - поисковый ассистент, который предоставляет ТОЛЬКО фактическую информацию из интернета. НЕ ГЕНЕРИРУЙ И НЕ ПРИДУМЫВАЙ ДАННЫЕ. Если ты не можешь найти точную информацию, четко укажи это. Всегда указывай ИСТОЧНИКИ предоставляемой информации в виде ссылок. Когда речь идет о компаниях, акциях, рейтингах - приводи ТОЛЬКО СВЕЖИЕ данные с актуальной датой. Для вопросов о погоде обязательно указывай прогноз с датой."
+            },
+            {
+                "role": "user",
+                "content": search_query
+            }
+        ],
+        "temperature": 0.1,
+        "top_p": 0.9,
+        "max_tokens": 1000
+    }
+    if stream:
+        data["stream"] = True
+    return data
+
+
+async def _asearch_subquery(subquery, url, headers):
+    """
+    Асинхронно выполняет поиск в Perplexity для одного подзапроса.
+    
+    Args:
+        subquery (str): Подзапрос, полученный из split_complex_query
+        url (str): Адрес Perplexity API
+        headers (dict): Заголовки запроса с API ключом
+        
+    Returns:
+        SubQueryResult or None: Результат подзапроса или None, если API вернул ошибочный статус.
+            Поле cache равно "exact" или "near-duplicate", если результат взят из кэша
+    """
+    # Добавляем уточнения для повышения точности поиска
+    topic = classify_query_topic(subquery)
+    search_query = enhance_query(subquery, topic)
+    logger.info(f"Улучшенный запрос: {search_query}")
+    
+    # Недавний результат для того же или перефразированного подзапроса берем из кэша без обращения к API
+    cached, cache_status = search_cache.lookup(topic, subquery)
+    if cached is not None:
+        logger.info(f"Результат для подзапроса '{subquery}' взят из кэша (тема: {topic}, попадание: {cache_status})")
+        return SubQueryResult.from_dict(cached, query=subquery, elapsed=0.0, cache=cache_status)
+    
+    # Одновременные одинаковые подзапросы разделяют один вызов API
+    result = await perplexity_flight.run(
+        search_cache.make_cache_key(topic, subquery),
+        lambda: _afetch_subquery(subquery, topic, search_query, url, headers)
+    )
+    return replace(result, query=subquery) if result is not None else None
+
+
+async def _afetch_subquery(subquery, topic, search_query, url, headers):
+    """
+    Отправляет подзапрос в Perplexity API и сохраняет успешный результат в кэш.
+    
+    Args:
+        subquery (str): Исходный подзапрос
+        topic (str): Тема подзапроса из classify_query_topic
+        search_query (str): Подзапрос после enhance_query
+        url (str): Адрес Perplexity API
+        headers (dict): Заголовки запроса с API ключом
+        
+    Returns:
+        SubQueryResult or None: Результат подзапроса или None, если API вернул ошибочный статус
+    """
+    data = _build_search_payload(search_query)
+    
+    logger.info(f"Отправка запроса для подзапроса: {subquery}")
+    # Временные сбои (429, 5xx, таймауты) повторяются с паузой в пределах бюджета вызова
+    async for attempt in get_retry_policy(PERPLEXITY).attempts():
+        async with attempt:
+            async with upstream_call(PERPLEXITY) as permit:
+                start_time = time.time()
+                response = await get_async_client(PERPLEXITY).post(url, headers=headers, json=data, timeout=attempt.timeout(60))
+                request_time = time.time() - start_time
+                permit.record(response.status_code)
+            attempt.check(response)
+    
+    # Обрабатываем ошибочные статусы
+    if response.status_code != 200:
+        try:
+            error_data = response.json()
+            error_detail = json.dumps(error_data, ensure_ascii=False)
+        except:
+            error_detail = response.text[:500] if response.text else "Нет деталей ошибки"
+    
+        logger.error(f"Ошибка Perplexity API: {response.status_code}")
+        logger.error(f"Детали ошибки: {error_detail}")
+    
+        # Сигнализируем вызывающей функции о необходимости резервного поиска
+        return None
+    
+    # Parse the response
+    result = _parse_search_response(subquery, response.json())
+    result.elapsed = round(request_time, 2)
+    if result.found:
+        search_cache.store(topic, subquery, result.to_dict())
+    return result
+
+
+async def asearch_perplexity(query, test_mode=False, max_concurrency=None):
+    """
+    Асинхронный поиск информации с использованием Perplexity API.
     
     Args:
         query (str): Поисковый запрос
         test_mode (bool): Если True, возвращает тестовые данные без вызова реального API
+        max_concurrency (int, optional): Максимальное число одновременных запросов к API.
+            По умолчанию берется из PERPLEXITY_MAX_CONCURRENCY (4)
         
     Returns:
-        str: Результаты поиска в текстовом формате
+        SearchResult: Результаты подзапросов; текст для промпта дает str(result)
     """
     # Разделяем составные запросы на отдельные подзапросы
     subqueries = split_complex_query(query)
@@ -458,13 +694,13 @@ def search_perplexity(query, test_mode=False):
     api_key = os.getenv('PERPLEXITY_API_KEY')
     if test_mode or not api_key:
         logger.info("Использование тестового режима для запросов")
-        return generate_test_response(query)
+        return SearchResult(query, [SubQueryResult.from_text(query, generate_test_response(query), model="test")])
     
     try:
         # Если API ключ отсутствует (и не в тестовом режиме), возвращаем ошибку
         if not api_key:
             logger.error("PERPLEXITY_API_KEY не найден в переменных окружения")
-            return "Ошибка: API ключ Perplexity не настроен."
+            return SearchResult(query, [SubQueryResult(query, "Ошибка: API ключ Perplexity не настроен.", found=False, error=True)])
         
         # Настраиваем URL и заголовки для запроса
         url = "https://api.perplexity.ai/chat/completions"
@@ -473,172 +709,133 @@ def search_perplexity(query, test_mode=False):
             "Content-Type": "application/json"
         }
         
-        # Собираем результаты поиска для всех подзапросов
-        all_results = []
-        
-        for subquery in subqueries:
-            # Добавляем уточнения для повышения точности поиска
-            search_query = enhance_query(subquery)
-            logger.info(f"Улучшенный запрос: {search_query}")
-
-            # Формируем запрос к API с использованием модели "sonar" согласно документации
-            data = {
-                "model": "sonar",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "Ты - поисковый ассистент, который предоставляет ТОЛЬКО фактическую информацию из интернета. НЕ ГЕНЕРИРУЙ И НЕ ПРИДУМЫВАЙ ДАННЫЕ. Если ты не можешь найти точную информацию, четко укажи это. Всегда указывай ИСТОЧНИКИ предоставляемой информации в виде ссылок. Когда речь идет о компаниях, акциях, рейтингах - приводи ТОЛЬКО СВЕЖИЕ данные с актуальной датой. Для вопросов о погоде обязательно указывай прогноз с датой."
-                    },
-                    {
-                        "role": "user",
-                        "content": search_query
-                    }
-                ],
-                "temperature": 0.1,
-                "top_p": 0.9,
-                "max_tokens": 1000
-            }
-
-            logger.info(f"Отправка запроса для подзапроса: {subquery}")
-            start_time = time.time()
-            response = requests.post(url, headers=headers, json=data, timeout=60)
-            request_time = time.time() - start_time
-
-            # Обрабатываем ошибочные статусы
-            if response.status_code != 200:
+        # Ограничиваем число одновременных запросов к Perplexity
+        if max_concurrency is None:
+            max_concurrency = int(os.getenv('PERPLEXITY_MAX_CONCURRENCY', '4'))
+        workers = max(1, min(max_concurrency, len(subqueries)))
+        logger.info(f"Отправка {len(subqueries)} подзапросов, одновременно не более {workers}")
+        
+        # Выполняем подзапросы параллельно; gather сохраняет исходный порядок результатов
+        semaphore = asyncio.Semaphore(workers)
+        
+        async def limited_search(subquery):
+            async with semaphore:
                 try:
-                    error_data = response.json()
-                    error_detail = json.dumps(error_data, ensure_ascii=False)
-                except:
-                    error_detail = response.text[:500] if response.text else "Нет деталей ошибки"
-                
-                logger.error(f"Ошибка Perplexity API: {response.status_code}")
-                logger.error(f"Детали ошибки: {error_detail}")
-                
-                # Пробуем использовать резервный метод поиска
-                logger.info("Переключение на резервный метод поиска...")
-                return fallback_search(query)
-            
-            # Parse the response
-            response_data = response.json()
-            
-            # Логируем статус ответа
-            logger.info(f"Perplexity API вернул ID: {response_data.get('id', 'N/A')}")
-            
-            # Process and format the search results
-            if "choices" in response_data and len(response_data["choices"]) > 0:
-                # Extract the content from the response
-                content = response_data["choices"][0]["message"]["content"]
-                logger.info(f"Получен ответ от Perplexity длиной {len(content)} символов")
-                logger.info(f"Начало ответа: {content[:200]}...")
-                
-                # Разделяем контент на разделы для лучшей структуры
-                sections = []
-                
-                # Пытаемся разбить контент по маркерам
-                if "1)" in content and "2)" in content:
-                    # Используем регулярные выражения для более надежного извлечения разделов
-                    section_patterns = [
-                        r'(?:1\)|1\.)[^\n]*((?:.|\n)*?)(?=2\)|2\.)', # Раздел 1
-                        r'(?:2\)|2\.)[^\n]*((?:.|\n)*?)(?=3\)|3\.|ИСТОЧНИКИ|Источники|источники|$)', # Раздел 2
-                        r'(?:3\)|3\.)[^\n]*((?:.|\n)*?)(?=ИСТОЧНИКИ|Источники|источники|$)', # Раздел 3
-                        r'(?:ИСТОЧНИКИ|Источники|источники)[^\n]*((?:.|\n)*)$' # Раздел источников
-                    ]
-                    
-                    for pattern in section_patterns:
-                        match = re.search(pattern, content)
-                        if match:
-                            section_text = match.group(1).strip()
-                            if section_text:
-                                sections.append(section_text)
-                                logger.info(f"Найден раздел по шаблону: {pattern[:30]}... длиной {len(section_text)} символов")
-                    
-                    if not sections:  # Если регулярки не сработали
-                        logger.warning("Регулярные выражения не смогли извлечь разделы, использую разделение по параграфам")
-                        sections = [s.strip() for s in content.split('\n\n') if s.strip()]
-                else:
-                    # Если контент не был структурирован по нашему запросу
-                    logger.info("Контент не содержит маркеров разделов, использую разделение по параграфам")
-                    sections = [s.strip() for s in content.split('\n\n') if s.strip()]
-                
-                # Логируем найденные секции
-                logger.info(f"Разделено на {len(sections)} секций")
-                for i, section in enumerate(sections[:3]):
-                    logger.info(f"Секция {i+1} (до 100 символов): {section[:100]}...")
-                
-                # Создаем структурированный результат с дополнительной обработкой
-                structured_result = {
-                    "full_content": content,
-                    "sections": sections,
-                    "timestamp": response_data.get("created", 0),
-                    "model": response_data.get("model", "pplx-7b-online"),
-                    "has_sources": "источник" in content.lower() or "источники" in content.lower()
-                }
-                
-                # Пытаемся извлечь источники отдельно
-                sources = []
-                if "источник" in content.lower() or "источники" in content.lower():
-                    source_section = ""
-                    if len(sections) >= 3:
-                        source_section = sections[-1]
-                    elif "источник" in content.lower():
-                        match = re.search(r'(?:источник|источники)[^\n]*(?:\n.*)*', content, re.IGNORECASE)
-                        if match:
-                            source_section = match.group(0)
-                    
-                    # Извлекаем URL из текста
-                    urls = re.findall(r'https?://[^\s)"\\]+', source_section)
-                    if urls:
-                        sources = urls
-                        structured_result["sources"] = sources
-                        logger.info(f"Извлечены источники: {sources}")
-                
-                # Преобразуем результаты в текстовый формат для использования в системном промпте
-                text_result = content
-                
-                # Добавляем форматирование для лучшей читаемости
-                if len(sources) > 0:
-                    text_result += "\n\nИСТОЧНИКИ:\n" + "\n".join(sources)
-                
-                logger.info(f"Подготовлены результаты поиска от Perplexity API: {len(sections)} секций и {len(sources)} источников")
-                
-                # Добавляем результат подзапроса в общий список
-                all_results.append({"query": subquery, "result": text_result})
-            else:
-                logger.warning(f"Результаты поиска не найдены в ответе Perplexity: {response_data}")
-                all_results.append({"query": subquery, "result": "Информация по запросу не найдена."})
-                
-        logger.info(f"Все подзапросы обработаны")
+                    return await _asearch_subquery(subquery, url, headers)
+                except CircuitOpenError as e:
+                    # Perplexity недоступен: не ждем таймаута, подзапрос остается без результата
+                    logger.warning(f"Подзапрос '{subquery}' пропущен: {e}")
+                    return SubQueryResult(subquery, UNAVAILABLE_MESSAGE, found=False, error=True)
+                except (httpx.RequestError, json.JSONDecodeError) as e:
+                    # Ошибка одного подзапроса не отменяет остальные
+                    logger.error(f"Ошибка поиска для подзапроса '{subquery}': {e}")
+                    return None
+                except Exception as e:
+                    # Любая другая ошибка тоже остается в своем подзапросе: результаты остальных сохраняются
+                    logger.error(f"Непредвиденная ошибка поиска для подзапроса '{subquery}': {e}")
+                    return SubQueryResult(subquery, "Произошла ошибка при поиске.", found=False, error=True)
         
-        # Комбинируем результаты всех подзапросов
-        if len(all_results) == 1:
-            # Если был только один подзапрос, просто возвращаем его результат
-            return all_results[0]["result"]
-        else:
-            # Иначе формируем составной результат
-            combined_results = "\n\n=== РЕЗУЛЬТАТЫ ПОИСКА ===\n\n"
-            
-            for result_item in all_results:
-                combined_results += f"ЗАПРОС: {result_item['query']}\n\n{result_item['result']}\n\n---\n\n"
-            
-            return combined_results
+        # Если задан срок запроса, поиск не выходит за отведенную ему часть
+        deadline = current_deadline()
+        search_end = time.monotonic() + deadline.search_budget() if deadline else None
+        
+        search_start = time.time()
+        all_results = await _run_until([limited_search(subquery) for subquery in subqueries], search_end)
+        
+        # Успешные результаты сохраняем; резервный поиск выполняется только для неудавшихся подзапросов, параллельно
+        failed = [index for index, result_item in enumerate(all_results) if result_item is None]
+        if failed:
+            logger.info(f"Резервный поиск для {len(failed)} из {len(subqueries)} подзапросов")
+            fallbacks = await _run_until([_afallback_subquery(subqueries[index]) for index in failed], search_end)
+            for index, result_item in zip(failed, fallbacks):
+                all_results[index] = result_item
+        
+        # Не успевшие к сроку подзапросы остаются без результата
+        timed_out = [index for index, result_item in enumerate(all_results) if result_item is _TIMED_OUT]
+        for index in timed_out:
+            all_results[index] = SubQueryResult(subqueries[index], TIMEOUT_MESSAGE, found=False, error=True)
+        if timed_out:
+            deadline.note("search_timeout")
+        
+        elapsed = round(time.time() - search_start, 2)
+        results = SearchResult(query, all_results, elapsed)
+        logger.info(f"Поиск по {len(subqueries)} подзапросам занял {elapsed:.2f} сек.")
+        if results.missing:
+            logger.warning(f"Нет результатов по подзапросам: {results.missing}")
+        
+        # Текст с заголовками "ЗАПРОС:" собирается только при построении промпта
+        return results
 
 
-    except requests.exceptions.RequestException as e:
+    except httpx.RequestError as e:
         logger.error(f"Ошибка запроса API: {e}")
         # Попробуем еще раз с другой моделью в случае ошибки
         logger.info("Используем резервный метод поиска после ошибки основного метода")
-        fallback_result = fallback_search(query)
-        return fallback_result
+        return SearchResult(query, [await _afallback_subquery(query)])
     except json.JSONDecodeError as e:
         logger.error(f"Ошибка декодирования JSON: {e}")
-        return "Ошибка при обработке результатов поиска."
+        return SearchResult(query, [SubQueryResult(query, "Ошибка при обработке результатов поиска.", found=False, error=True)])
     except Exception as e:
         logger.error(f"Непредвиденная ошибка в search_perplexity: {e}")
-        return "Произошла непредвиденная ошибка при поиске."
+        return SearchResult(query, [SubQueryResult(query, "Произошла непредвиденная ошибка при поиске.", found=False, error=True)])
 
 
-def fallback_search(query):
+async def _run_until(coros, end=None):
+    """
+    Выполняет корутины параллельно; не завершившиеся к моменту end отменяются,
+    и функция дожидается завершения их отмены (закрытия соединений).
+    
+    Args:
+        coros (list): Корутины
+        end (float, optional): Момент по time.monotonic(); None - ждать все
+        
+    Returns:
+        list: Результаты в исходном порядке; _TIMED_OUT для отмененных по сроку,
+            None для завершившихся отменой, которую они получили не от нас
+            (такой подзапрос считается неудавшимся)
+    """
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    if not tasks:
+        return []
+    timeout = max(end - time.monotonic(), 0.0) if end is not None else None
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=timeout)
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+    results = []
+    for task in tasks:
+        if task not in done:
+            results.append(_TIMED_OUT)
+        elif task.cancelled():
+            # Чужая отмена (например, из общего вызова singleflight) не отменяет весь поиск
+            logger.error("Подзапрос завершился отменой, не связанной со сроком поиска")
+            results.append(None)
+        else:
+            results.append(task.result())
+    return results
+
+
+def search_perplexity(query, test_mode=False, max_concurrency=None):
+    """
+    Поиск информации с использованием Perplexity API.
+    Синхронная обертка над asearch_perplexity.
+    
+    Args:
+        query (str): Поисковый запрос
+        test_mode (bool): Если True, возвращает тестовые данные без вызова реального API
+        max_concurrency (int, optional): Максимальное число одновременных запросов к API
+        
+    Returns:
+        SearchResult: Результаты подзапросов; текст для промпта дает str(result)
+    """
+    return run_sync(asearch_perplexity(query, test_mode=test_mode, max_concurrency=max_concurrency))
+
+
+async def afallback_search(query):
     """
     Резервный метод поиска с использованием наиболее стабильной модели.
     Применяется, когда основной метод поиска не работает.
@@ -649,6 +846,34 @@ def fallback_search(query):
     Returns:
         str: Результаты поиска в текстовом формате или сообщение об ошибке
     """
+    content, _ = await _afallback(query)
+    return content
+
+
+async def _afallback_subquery(subquery):
+    """
+    Резервный поиск для одного подзапроса, основной поиск по которому не удался.
+    
+    Args:
+        subquery (str): Подзапрос
+        
+    Returns:
+        SubQueryResult: Результат с fallback=True; found=False и error=True, если и резервный поиск не удался
+    """
+    content, found = await _afallback(subquery)
+    return SubQueryResult.from_text(subquery, content, fallback=True, found=found, error=not found)
+
+
+async def _afallback(query):
+    """
+    Выполняет резервный поиск одним запросом к модели sonar и сообщает, удался ли он.
+    
+    Args:
+        query (str): Поисковый запрос от пользователя
+        
+    Returns:
+        tuple: (результаты поиска в текстовом формате или сообщение об ошибке, найдена ли информация)
+    """
     logger.info(f"Запуск резервного метода поиска для запроса: '{query}'")
     
     try:
@@ -656,7 +881,7 @@ def fallback_search(query):
         api_key = os.getenv('PERPLEXITY_API_KEY')
         if not api_key:
             logger.error("PERPLEXITY_API_KEY не найден в переменных окружения")
-            return "К сожалению, невозможно выполнить поиск. API ключ не настроен."
+            return "К сожалению, невозможно выполнить поиск. API ключ не настроен.", False
         
         # URL и заголовки для API Perplexity
         url = "https://api.perplexity.ai/chat/completions"
@@ -685,9 +910,14 @@ def fallback_search(query):
         
         try:
             # Отправляем запрос с увеличенным таймаутом для стабильности
-            start_time = time.time()
-            response = requests.post(url, headers=headers, json=data, timeout=60)
-            request_time = time.time() - start_time
+            async for attempt in get_retry_policy(PERPLEXITY).attempts():
+                async with attempt:
+                    async with upstream_call(PERPLEXITY) as permit:
+                        start_time = time.time()
+                        response = await get_async_client(PERPLEXITY).post(url, headers=headers, json=data, timeout=attempt.timeout(60))
+                        request_time = time.time() - start_time
+                        permit.record(response.status_code)
+                    attempt.check(response)
             
             # Подробное логирование ответа
             logger.info(f"Получен ответ от Perplexity API за {request_time:.2f} сек. Статус: {response.status_code}")
@@ -699,13 +929,13 @@ def fallback_search(query):
                 
                 # Генерируем информативный ответ на основе типа ошибки
                 if response.status_code == 400:
-                    return "К сожалению, запрос был некорректным. Попробуйте изменить формулировку."
+                    return "К сожалению, запрос был некорректным. Попробуйте изменить формулировку.", False
                 elif response.status_code == 401:
-                    return "Проблема с авторизацией API. Пожалуйста, проверьте настройки API ключа."
+                    return "Проблема с авторизацией API. Пожалуйста, проверьте настройки API ключа.", False
                 elif response.status_code == 429:
-                    return "Превышен лимит запросов к API. Пожалуйста, попробуйте позже."
+                    return "Превышен лимит запросов к API. Пожалуйста, попробуйте позже.", False
                 else:
-                    return f"Не удалось получить информацию. Ошибка сервиса: {response.status_code}."
+                    return f"Не удалось получить информацию. Ошибка сервиса: {response.status_code}.", False
             
             # Обработка успешного ответа с дополнительными проверками
             try:
@@ -720,35 +950,296 @@ def fallback_search(query):
                         # Проверяем качество ответа
                         if content_length < 10:
                             logger.warning(f"Слишком короткий ответ от API: '{content}'")
-                            return "Не удалось найти достаточно информации по вашему запросу."
+                            return "Не удалось найти достаточно информации по вашему запросу.", False
                         
                         logger.info(f"Успешно получен ответ от Perplexity длиной {content_length} символов")
-                        return content
+                        return content, True
                 
                 # Лог неожиданного формата ответа
                 logger.warning(f"Неожиданный формат ответа API: {json.dumps(response_data, ensure_ascii=False)[:300]}...")
-                return "Не удалось корректно обработать результаты поиска."
+                return "Не удалось корректно обработать результаты поиска.", False
         
             except json.JSONDecodeError as json_err:
                 logger.error(f"Ошибка декодирования JSON в резервном методе: {json_err}")
                 logger.error(f"Содержимое ответа: {response.text[:200]}...")
-                return "Не удалось обработать ответ поисковой системы. Технические проблемы."
+                return "Не удалось обработать ответ поисковой системы. Технические проблемы.", False
                 
-        except requests.exceptions.Timeout as timeout_err:
+        except CircuitOpenError as breaker_err:
+            # Пустой результат: ответ будет построен без поиска
+            logger.warning(f"Резервный поиск пропущен: {breaker_err}")
+            return "", False
+            
+        except httpx.TimeoutException as timeout_err:
             logger.error(f"Таймаут запроса к Perplexity API: {timeout_err}")
-            return "Поисковый запрос занял слишком много времени. Пожалуйста, попробуйте позже."
+            return "Поисковый запрос занял слишком много времени. Пожалуйста, попробуйте позже.", False
             
-        except requests.exceptions.ConnectionError as conn_err:
+        except httpx.ConnectError as conn_err:
             logger.error(f"Ошибка соединения с Perplexity API: {conn_err}")
-            return "Не удалось установить соединение с поисковой системой. Проверьте подключение к интернету."
+            return "Не удалось установить соединение с поисковой системой. Проверьте подключение к интернету.", False
             
-        except requests.exceptions.RequestException as req_err:
+        except httpx.RequestError as req_err:
             logger.error(f"Общая ошибка запроса к Perplexity API: {req_err}")
-            return "Произошла ошибка при обработке поискового запроса. Пожалуйста, попробуйте позже."
+            return "Произошла ошибка при обработке поискового запроса. Пожалуйста, попробуйте позже.", False
     
     except Exception as e:
         logger.error(f"Непредвиденная ошибка в резервном методе поиска: {repr(e)}")
         # Добавляем stack trace для больших ошибок
         import traceback
         logger.error(f"Stack trace: {traceback.format_exc()}")
-        return "К сожалению, произошла непредвиденная ошибка при поиске информации."
\ No newline at end of file
+        return "К сожалению, произошла непредвиденная ошибка при поиске информации.", False
+
+
+def fallback_search(query):
+    """
+    Резервный метод поиска. Синхронная обертка над afallback_search.
+    
+    Args:
+        query (str): Поисковый запрос от пользователя
+        
+    Returns:
+        str: Результаты поиска в текстовом формате или сообщение об ошибке
+    """
+    return run_sync(afallback_search(query))
+
+
+async def _astream_subquery_tokens(index, subquery, url, headers, emit):
+    """
+    Выполняет подзапрос в потоковом режиме Perplexity, передавая токены по мере генерации.
+    
+    Одновременные одинаковые подзапросы, как и в _asearch_subquery, разделяют один вызов
+    API: токены получает только поток, начавший вызов, присоединившиеся получают готовый
+    результат без токенов.
+    
+    Args:
+        index (int): Номер подзапроса
+        subquery (str): Подзапрос
+        url (str): Адрес Perplexity API
+        headers (dict): Заголовки запроса с API ключом
+        emit (callable): Корутина, принимающая событие {"type": "token", ...}
+        
+    Returns:
+        SubQueryResult or None: Результат подзапроса или None, если API вернул ошибочный статус
+    """
+    topic = classify_query_topic(subquery)
+    search_query = enhance_query(subquery, topic)
+    
+    cached, cache_status = search_cache.lookup(topic, subquery)
+    if cached is not None:
+        return SubQueryResult.from_dict(cached, query=subquery, elapsed=0.0, cache=cache_status)
+    
+    result = await perplexity_flight.run(
+        search_cache.make_cache_key(topic, subquery),
+        lambda: _afetch_subquery_tokens(index, subquery, topic, search_query, url, headers, emit)
+    )
+    return replace(result, query=subquery) if result is not None else None
+
+
+async def _afetch_subquery_tokens(index, subquery, topic, search_query, url, headers, emit):
+    """
+    Отправляет подзапрос в потоковом режиме Perplexity и сохраняет успешный результат в кэш.
+    
+    Args:
+        index (int): Номер подзапроса
+        subquery (str): Исходный подзапрос
+        topic (str): Тема подзапроса из classify_query_topic
+        search_query (str): Подзапрос после enhance_query
+        url (str): Адрес Perplexity API
+        headers (dict): Заголовки запроса с API ключом
+        emit (callable): Корутина, принимающая событие {"type": "token", ...}
+        
+    Returns:
+        SubQueryResult or None: Результат подзапроса или None, если API вернул ошибочный статус
+    """
+    start_time = time.time()
+    async for attempt in get_retry_policy(PERPLEXITY).attempts():
+        async with attempt:
+            content_parts = []
+            last_chunk = {}
+            error_text = None
+            async with upstream_call(PERPLEXITY) as permit, \
+                    get_async_client(PERPLEXITY).stream("POST", url, headers=headers, json=_build_search_payload(search_query, stream=True), timeout=attempt.timeout(60)) as response:
+                permit.record(response.status_code)
+                attempt.check(response)
+                if response.status_code != 200:
+                    error_text = (await response.aread()).decode('utf-8', errors='replace')
+                else:
+                    # Поток в формате Server-Sent Events, совместимом с OpenAI: текст в choices[0].delta.content
+                    finished = False
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        payload = line[5:].strip()
+                        if payload == "[DONE]":
+                            finished = True
+                            break
+                        last_chunk = json.loads(payload)
+                        choices = last_chunk.get("choices") or [{}]
+                        text = choices[0].get("delta", {}).get("content")
+                        if text:
+                            # После первого фрагмента повтор продублировал бы уже отправленный текст
+                            attempt.commit()
+                            content_parts.append(text)
+                            await emit({"type": "token", "index": index, "text": text})
+                    if not finished:
+                        # Оборванный поток: до первого фрагмента попытка повторяется, после -
+                        # ошибка доходит до astream_search, и частичный ответ не попадает в кэш
+                        raise httpx.RemoteProtocolError("поток Perplexity закончился без [DONE]")
+    
+    if error_text is not None:
+        logger.error(f"Ошибка Perplexity API: {response.status_code} - {error_text[:500]}")
+        return None
+    
+    # Собираем ответ в том же виде, что и непотоковый, чтобы разобрать его общей функцией
+    content = "".join(content_parts)
+    response_data = {
+        "id": last_chunk.get("id", "N/A"),
+        "model": last_chunk.get("model", "sonar"),
+        "created": last_chunk.get("created", 0),
+        "choices": [{"message": {"content": content}}] if content else []
+    }
+    result = _parse_search_response(subquery, response_data)
+    result.elapsed = round(time.time() - start_time, 2)
+    if result.found:
+        search_cache.store(topic, subquery, result.to_dict())
+    return result
+
+
+def _result_event(index, result, start_time):
+    """Событие потокового поиска с результатом подзапроса."""
+    return {
+        "type": "result",
+        "index": index,
+        "query": result.query,
+        "result": result.render(),
+        "sections": result.sections,
+        "sources": result.sources,
+        "cache": result.cache,
+        "fallback": result.fallback,
+        "found": result.found,
+        "elapsed": round(time.time() - start_time, 2)
+    }
+
+
+async def astream_search(query, test_mode=False, max_concurrency=None, stream_tokens=False):
+    """
+    Потоковый поиск: результат каждого подзапроса отдается сразу после получения,
+    не дожидаясь остальных.
+    
+    Если задан срок запроса (deadline_scope), подзапросы, не успевшие к концу времени
+    на поиск, отменяются и отдаются как результаты с ошибкой и TIMEOUT_MESSAGE.
+    
+    Args:
+        query (str): Поисковый запрос
+        test_mode (bool): Если True, возвращает тестовые данные без вызова реального API
+        max_concurrency (int, optional): Максимальное число одновременных запросов к API
+        stream_tokens (bool): Передавать также токены ответа Perplexity по мере генерации
+        
+    Yields:
+        dict: События поиска:
+            {"type": "plan", "subqueries": [...]} - список подзапросов;
+            {"type": "token", "index", "text"} - очередной фрагмент ответа (если stream_tokens);
+            {"type": "result", "index", "query", "result", "sections", "sources", "cache", "fallback", "found", "elapsed"} - результат подзапроса;
+            {"type": "done", "elapsed"} - поиск завершен
+    """
+    start_time = time.time()
+    subqueries = split_complex_query(query)
+    yield {"type": "plan", "query": query, "subqueries": subqueries}
+    
+    api_key = os.getenv('PERPLEXITY_API_KEY')
+    if test_mode or not api_key:
+        logger.info("Использование тестового режима для потокового поиска")
+        yield _result_event(0, SubQueryResult.from_text(query, generate_test_response(query), model="test"), start_time)
+        yield {"type": "done", "elapsed": round(time.time() - start_time, 2)}
+        return
+    
+    url = "https://api.perplexity.ai/chat/completions"
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    
+    if max_concurrency is None:
+        max_concurrency = int(os.getenv('PERPLEXITY_MAX_CONCURRENCY', '4'))
+    semaphore = asyncio.Semaphore(max(1, min(max_concurrency, len(subqueries))))
+    events = asyncio.Queue()
+    
+    async def run(index, subquery):
+        result = None
+        try:
+            async with semaphore:
+                if stream_tokens:
+                    result = await _astream_subquery_tokens(index, subquery, url, headers, events.put)
+                else:
+                    result = await _asearch_subquery(subquery, url, headers)
+                # Если API вернул ошибку, используем резервный метод только для этого подзапроса
+                if result is None:
+                    result = await _afallback_subquery(subquery)
+        except CircuitOpenError as e:
+            logger.warning(f"Подзапрос '{subquery}' пропущен: {e}")
+            result = SubQueryResult(subquery, UNAVAILABLE_MESSAGE, found=False, error=True)
+        except Exception as e:
+            logger.error(f"Ошибка потокового поиска для подзапроса '{subquery}': {e}")
+            result = SubQueryResult(subquery, "Произошла ошибка при поиске.", found=False, error=True)
+        finally:
+            # Результат подзапроса отдается всегда, даже если задача прервана отменой:
+            # иначе потребитель ждал бы его бесконечно
+            if result is None:
+                message = TIMEOUT_MESSAGE if timed_out else "Произошла ошибка при поиске."
+                result = SubQueryResult(subquery, message, found=False, error=True)
+            events.put_nowait(_result_event(index, result, start_time))
+    
+    # Как и в asearch_perplexity, поиск укладывается в срок запроса за вычетом резерва на ответ
+    deadline = current_deadline()
+    search_end = time.monotonic() + deadline.search_budget() if deadline else None
+    timed_out = False
+    
+    tasks = [asyncio.create_task(run(index, subquery)) for index, subquery in enumerate(subqueries)]
+    pending = set(range(len(tasks)))
+    try:
+        while pending:
+            try:
+                timeout = max(search_end - time.monotonic(), 0.0) if search_end is not None else None
+                event = await asyncio.wait_for(events.get(), timeout)
+            except asyncio.TimeoutError:
+                timed_out = True
+                break
+            if event["type"] == "result":
+                pending.discard(event["index"])
+                logger.info(f"Подзапрос {event['index'] + 1}/{len(tasks)} готов через {event['elapsed']} сек.")
+            yield event
+    finally:
+        # Если срок истек или потребитель перестал читать поток, не оставляем запросы висеть
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    if timed_out:
+        logger.warning(f"Не уложились в срок подзапросы: {', '.join(subqueries[index] for index in sorted(pending))}")
+        # Отмененные задачи уже положили в очередь свои результаты
+        while not events.empty():
+            event = events.get_nowait()
+            if event["type"] == "result":
+                pending.discard(event["index"])
+            yield event
+        # Задачи, отмененные до начала выполнения, результата не оставляют
+        for index in sorted(pending):
+            yield _result_event(index, SubQueryResult(subqueries[index], TIMEOUT_MESSAGE, found=False, error=True), start_time)
+        deadline.note("search_timeout")
+    
+    yield {"type": "done", "elapsed": round(time.time() - start_time, 2)}
+
+
+def stream_search(query, test_mode=False, max_concurrency=None, stream_tokens=False):
+    """
+    Потоковый поиск. Синхронный генератор-обертка над astream_search.
+    
+    Args:
+        query (str): Поисковый запрос
+        test_mode (bool): Если True, возвращает тестовые данные без вызова реального API
+        max_concurrency (int, optional): Максимальное число одновременных запросов к API
+        stream_tokens (bool): Передавать также токены ответа Perplexity по мере генерации
+        
+    Yields:
+        dict: События поиска (см. astream_search)
+    """
+    yield from iterate_sync(astream_search(query, test_mode=test_mode, max_concurrency=max_concurrency, stream_tokens=stream_tokens))
@@ -0,0 +1,657 @@
+"""
+Cache of Perplexity search results with per-topic freshness and pluggable storage backends.
+"""
+import os
+import json
+import zlib
+import random
+import time
+import socket
+import sqlite3
+import logging
+import threading
+import urllib.parse
+from collections import OrderedDict
+from query_normalizer import canonical_query, query_terms, query_shingles, query_numbers, query_directions, directions_conflict, terms_aligned
+
+logger = logging.getLogger(__name__)
+
+# Время жизни результатов поиска (в секундах) для каждой темы из enhance_query.
+# Цены акций и криптовалют быстро устаревают, общие факты можно хранить часами.
+DEFAULT_TOPIC_TTLS = {
+    "weather": 30 * 60,
+    "capitalization": 10 * 60,
+    "stock": 5 * 60,
+    "crypto": 2 * 60,
+    "financial": 30 * 60,
+    "general": 6 * 60 * 60,
+}
+
+
+def get_topic_ttl(topic):
+    """
+    Возвращает время жизни кэша для темы запроса.
+
+    Значение можно переопределить переменной окружения SEARCH_CACHE_TTL_<TOPIC>,
+    например SEARCH_CACHE_TTL_CRYPTO=60.
+
+    Args:
+        topic (str): Тема запроса
+
+    Returns:
+        float: Время жизни записи в секундах
+    """
+    default_ttl = DEFAULT_TOPIC_TTLS.get(topic, DEFAULT_TOPIC_TTLS["general"])
+    return float(os.getenv(f'SEARCH_CACHE_TTL_{topic.upper()}', default_ttl))
+
+
+def make_cache_key(topic, query):
+    """
+    Формирует ключ кэша из темы и канонической формы подзапроса.
+
+    Каноническая форма не зависит от регистра, ё/е, окончаний и служебных слов,
+    но сохраняет порядок слов и предлоги направления: "курс доллара к евро"
+    и "курс евро к доллару" получают разные ключи.
+
+    Args:
+        topic (str): Тема запроса
+        query (str): Подзапрос до enhance_query
+
+    Returns:
+        str: Ключ кэша
+    """
+    return f"{topic}:{canonical_query(query)}"
+
+
+class CacheBackendError(Exception):
+    """Ошибка хранилища кэша (например, сбой соединения с Redis)."""
+
+
+class CacheBackend:
+    """
+    Базовый интерфейс хранилища кэша результатов поиска.
+
+    Наследники реализуют _get, _set, _delete и _clear. Сбой хранилища не должен
+    ломать поиск, поэтому ошибки логируются и считаются промахом кэша.
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self._counters_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _count(self, counter):
+        with self._counters_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key):
+        """
+        Возвращает свежий результат из кэша или None.
+
+        Args:
+            key (str): Ключ, построенный make_cache_key
+
+        Returns:
+            dict or None: Сохраненный результат подзапроса
+        """
+        try:
+            value = self._get(key)
+        except Exception as e:
+            logger.warning(f"Ошибка чтения из кэша {self.name}: {e}")
+            self._count("errors")
+            value = None
+        self._count("hits" if value is not None else "misses")
+        return value
+
+    def set(self, key, value, ttl):
+        """
+        Сохраняет результат подзапроса.
+
+        Args:
+            key (str): Ключ, построенный make_cache_key
+            value (dict): Результат подзапроса с полем "result"
+            ttl (float): Время жизни записи в секундах
+        """
+        try:
+            self._set(key, value, ttl)
+        except Exception as e:
+            logger.warning(f"Ошибка записи в кэш {self.name}: {e}")
+            self._count("errors")
+
+    def delete(self, key):
+        """Удаляет запись из кэша."""
+        try:
+            self._delete(key)
+        except Exception as e:
+            logger.warning(f"Ошибка удаления из кэша {self.name}: {e}")
+            self._count("errors")
+
+    def clear(self):
+        """Полностью очищает кэш."""
+        try:
+            self._clear()
+        except Exception as e:
+            logger.warning(f"Ошибка очистки кэша {self.name}: {e}")
+            self._count("errors")
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def _delete(self, key):
+        raise NotImplementedError
+
+    def _clear(self):
+        raise NotImplementedError
+
+    def _backend_stats(self):
+        return {}
+
+    def stats(self):
+        """
+        Возвращает счетчики кэша.
+
+        Returns:
+            dict: Попадания, промахи, ошибки и показатели конкретного хранилища
+        """
+        with self._counters_lock:
+            lookups = self.hits + self.misses
+            result = {
+                "backend": self.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "errors": self.errors,
+            }
+        try:
+            result.update(self._backend_stats())
+        except Exception as e:
+            logger.warning(f"Не удалось получить статистику кэша {self.name}: {e}")
+        return result
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    LRU-кэш в памяти процесса, ограниченный суммарным размером в байтах.
+
+    Каждая запись хранит собственный срок годности, поэтому записи разных
+    тем устаревают с разной скоростью.
+    """
+
+    name = "memory"
+
+    def __init__(self, max_bytes):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _entry_size(key, value):
+        # Учитываем текстовые поля результата: ответ, разделы и источники
+        size = len(key.encode('utf-8'))
+        for field_value in value.values():
+            items = field_value if isinstance(field_value, list) else [field_value]
+            size += sum(len(item.encode('utf-8')) for item in items if isinstance(item, str))
+        return size
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at, _ = entry
+            if expires_at <= time.time():
+                self._remove(key)
+                self.expirations += 1
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def _set(self, key, value, ttl):
+        size = self._entry_size(key, value)
+        if size > self.max_bytes:
+            logger.info(f"Результат размером {size} байт больше всего кэша, не сохраняю")
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.time() + ttl, size)
+            self._bytes += size
+
+            while self._bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def _delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _backend_stats(self):
+        with self._lock:
+            return {
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    Кэш в SQLite-файле, общий для всех процессов на узле и переживающий перезапуск.
+
+    Каждый поток держит свое соединение; журнал WAL позволяет читать,
+    пока другой процесс записывает новый результат.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path, purge_every=500):
+        super().__init__()
+        self.path = path
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._writes = 0
+        self._connection()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        # После fork соединение родителя использовать нельзя, открываем новое
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS search_cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            conn.commit()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _get(self, key):
+        row = self._connection().execute(
+            'SELECT value, expires_at FROM search_cache WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[1] <= time.time():
+            self._delete(key)
+            return None
+        return json.loads(row[0])
+
+    def _set(self, key, value, ttl):
+        conn = self._connection()
+        conn.execute(
+            'INSERT OR REPLACE INTO search_cache (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, json.dumps(value, ensure_ascii=False), time.time() + ttl)
+        )
+        self._writes += 1
+        # Время от времени удаляем устаревшие записи, чтобы файл не рос бесконечно
+        if self._writes % self.purge_every == 0:
+            conn.execute('DELETE FROM search_cache WHERE expires_at <= ?', (time.time(),))
+        conn.commit()
+
+    def _delete(self, key):
+        conn = self._connection()
+        conn.execute('DELETE FROM search_cache WHERE key = ?', (key,))
+        conn.commit()
+
+    def _clear(self):
+        conn = self._connection()
+        conn.execute('DELETE FROM search_cache')
+        conn.commit()
+
+    def _backend_stats(self):
+        entries = self._connection().execute('SELECT COUNT(*) FROM search_cache').fetchone()[0]
+        return {"entries": entries, "path": self.path}
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Кэш в Redis или любом сервере, совместимом с протоколом RESP.
+
+    Реализует минимальный клиент протокола поверх сокета, поэтому не требует
+    дополнительных зависимостей. Записи устаревают средствами сервера (SET ... PX).
+    """
+
+    name = "redis"
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="search:", timeout=1.0):
+        super().__init__()
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.prefix = prefix
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            conn = (sock, sock.makefile('rb'))
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            if self.password:
+                self._command('AUTH', self.password)
+            if self.db:
+                self._command('SELECT', self.db)
+        return conn
+
+    def _disconnect(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn[1].close()
+                conn[0].close()
+            except OSError:
+                pass
+
+    @staticmethod
+    def _encode(args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        return b"".join(parts)
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line:
+            raise CacheBackendError("Соединение с Redis закрыто")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            raise CacheBackendError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            count = int(payload)
+            if count < 0:
+                return None
+            return [self._read_reply(reader) for _ in range(count)]
+        raise CacheBackendError(f"Неизвестный ответ Redis: {line[:50]!r}")
+
+    def _command(self, *args):
+        sock, reader = self._connection()
+        try:
+            sock.sendall(self._encode(args))
+            return self._read_reply(reader)
+        except (OSError, CacheBackendError):
+            # После сбоя состояние протокола неизвестно, переподключимся при следующем вызове
+            self._disconnect()
+            raise
+
+    def _get(self, key):
+        data = self._command('GET', self.prefix + key)
+        return json.loads(data) if data is not None else None
+
+    def _set(self, key, value, ttl):
+        self._command('SET', self.prefix + key, json.dumps(value, ensure_ascii=False), 'PX', int(ttl * 1000))
+
+    def _delete(self, key):
+        self._command('DEL', self.prefix + key)
+
+    def _clear(self):
+        cursor = b'0'
+        while True:
+            cursor, keys = self._command('SCAN', cursor, 'MATCH', self.prefix + '*', 'COUNT', 500)
+            if keys:
+                self._command('DEL', *keys)
+            if cursor in (b'0', '0'):
+                break
+
+    def _backend_stats(self):
+        return {"url": f"redis://{self.host}:{self.port}/{self.db}"}
+
+
+def create_cache_backend(kind=None):
+    """
+    Создает хранилище кэша по настройкам окружения.
+
+    SEARCH_CACHE_BACKEND выбирает хранилище: memory (по умолчанию), sqlite или redis.
+    Для sqlite путь к файлу задается SEARCH_CACHE_PATH, для redis адрес задается
+    SEARCH_CACHE_REDIS_URL.
+
+    Args:
+        kind (str, optional): Тип хранилища, переопределяет SEARCH_CACHE_BACKEND
+
+    Returns:
+        CacheBackend: Хранилище кэша
+    """
+    kind = (kind or os.getenv('SEARCH_CACHE_BACKEND', 'memory')).lower()
+    if kind == 'sqlite':
+        default_path = os.path.join(os.getenv('DB_PATH', os.path.dirname(os.path.abspath(__file__))), 'search_cache.db')
+        return SQLiteCacheBackend(os.getenv('SEARCH_CACHE_PATH', default_path))
+    if kind == 'redis':
+        return RedisCacheBackend(os.getenv('SEARCH_CACHE_REDIS_URL', 'redis://localhost:6379/0'))
+    if kind != 'memory':
+        logger.warning(f"Неизвестное хранилище кэша '{kind}', использую кэш в памяти")
+    return MemoryCacheBackend(max_bytes=int(os.getenv('SEARCH_CACHE_MAX_BYTES', str(32 * 1024 * 1024))))
+
+
+class NearDuplicateIndex:
+    """
+    MinHash/LSH индекс недавно сохраненных запросов для поиска перефразировок.
+
+    LSH по полосам MinHash-сигнатуры быстро отбирает кандидатов, после чего
+    похожесть проверяется точным коэффициентом Жаккара по признакам запроса
+    и попарным сопоставлением слов (terms_aligned). Перестановки слов допускаются,
+    но не меняющие направление запроса (directions_conflict).
+    Индекс хранится в памяти процесса, а сами результаты остаются в хранилище кэша.
+    """
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, threshold=0.5, num_perm=32, bands=16, max_entries=5000):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_entries = max_entries
+        # Фиксированное зерно: сигнатуры одинаковы во всех процессах и после перезапуска
+        rng = random.Random(42)
+        self._permutations = [(rng.randrange(1, self._PRIME), rng.randrange(0, self._PRIME)) for _ in range(num_perm)]
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _signature(self, shingles):
+        hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles]
+        return [min((a * h + b) % self._PRIME for h in hashes) for a, b in self._permutations]
+
+    def _bucket_keys(self, topic, signature):
+        return [
+            (topic, band, tuple(signature[band * self.rows:(band + 1) * self.rows]))
+            for band in range(self.bands)
+        ]
+
+    def _discard_locked(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for bucket_key in entry[4]:
+            bucket = self._buckets.get(bucket_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[bucket_key]
+
+    def add(self, topic, key, query):
+        """
+        Добавляет запрос в индекс.
+
+        Args:
+            topic (str): Тема запроса
+            key (str): Ключ кэша, под которым сохранен результат
+            query (str): Текст подзапроса
+        """
+        shingles = query_shingles(query)
+        if not shingles:
+            return
+        bucket_keys = self._bucket_keys(topic, self._signature(shingles))
+        with self._lock:
+            self._discard_locked(key)
+            self._entries[key] = (shingles, frozenset(query_terms(query)), query_numbers(query),
+                                  query_directions(query), bucket_keys)
+            for bucket_key in bucket_keys:
+                self._buckets.setdefault(bucket_key, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._discard_locked(next(iter(self._entries)))
+
+    def find(self, topic, query):
+        """
+        Ищет в той же теме ранее сохраненный запрос, достаточно похожий на данный.
+
+        Args:
+            topic (str): Тема запроса
+            query (str): Текст подзапроса
+
+        Returns:
+            str or None: Ключ кэша самого похожего запроса
+        """
+        shingles = query_shingles(query)
+        if not shingles:
+            return None
+        terms = frozenset(query_terms(query))
+        numbers = query_numbers(query)
+        directions = query_directions(query)
+        bucket_keys = self._bucket_keys(topic, self._signature(shingles))
+
+        best_key, best_score = None, self.threshold
+        with self._lock:
+            candidates = set()
+            for bucket_key in bucket_keys:
+                candidates.update(self._buckets.get(bucket_key, ()))
+            for candidate in candidates:
+                candidate_shingles, candidate_terms, candidate_numbers, candidate_directions, _ = self._entries[candidate]
+                # Запросы с разными числами (годами, суммами) или направлениями
+                # ("из Москвы в Казань" и "из Казани в Москву") не считаем перефразировкой
+                if candidate_numbers != numbers or directions_conflict(directions, candidate_directions):
+                    continue
+                score = len(shingles & candidate_shingles) / len(shingles | candidate_shingles)
+                if score >= best_score and terms_aligned(terms, candidate_terms):
+                    best_key, best_score = candidate, score
+        return best_key
+
+    def discard(self, key):
+        """Удаляет запрос из индекса."""
+        with self._lock:
+            self._discard_locked(key)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Общий для процесса кэш результатов поиска
+search_cache = create_cache_backend()
+
+# Индекс перефразировок поверх общего кэша
+near_duplicate_index = NearDuplicateIndex(threshold=float(os.getenv('SEARCH_CACHE_SIMILARITY', '0.5')))
+
+_lookup_counters = {"exact": 0, "near-duplicate": 0, "miss": 0}
+_lookup_lock = threading.Lock()
+
+
+def _count_lookup(status):
+    with _lookup_lock:
+        _lookup_counters[status] += 1
+
+
+def lookup(topic, query):
+    """
+    Ищет результат подзапроса в кэше: сначала по точному ключу,
+    затем среди похожих запросов той же темы.
+
+    Args:
+        topic (str): Тема запроса из classify_query_topic
+        query (str): Текст подзапроса
+
+    Returns:
+        tuple: (результат или None, статус "exact", "near-duplicate" или None)
+    """
+    key = make_cache_key(topic, query)
+    value = search_cache.get(key)
+    if value is not None:
+        if key not in near_duplicate_index:
+            near_duplicate_index.add(topic, key, query)
+        _count_lookup("exact")
+        return value, "exact"
+
+    similar_key = near_duplicate_index.find(topic, query)
+    if similar_key is not None and similar_key != key:
+        value = search_cache.get(similar_key)
+        if value is not None:
+            logger.info(f"Найден похожий запрос в кэше: '{query}' ~ '{similar_key}'")
+            _count_lookup("near-duplicate")
+            return value, "near-duplicate"
+        # Запись устарела или вытеснена из хранилища
+        near_duplicate_index.discard(similar_key)
+
+    _count_lookup("miss")
+    return None, None
+
+
+def store(topic, query, value):
+    """
+    Сохраняет результат подзапроса с временем жизни, соответствующим теме.
+
+    Args:
+        topic (str): Тема запроса из classify_query_topic
+        query (str): Текст подзапроса
+        value (dict): Результат подзапроса
+    """
+    key = make_cache_key(topic, query)
+    search_cache.set(key, value, get_topic_ttl(topic))
+    near_duplicate_index.add(topic, key, query)
+
+
+def get_cache_stats():
+    """Возвращает счетчики общего кэша результатов поиска."""
+    stats = search_cache.stats()
+    with _lookup_lock:
+        stats.update({
+            "exact_hits": _lookup_counters["exact"],
+            "near_duplicate_hits": _lookup_counters["near-duplicate"],
+            "lookup_misses": _lookup_counters["miss"],
+        })
+    stats["near_duplicate_index_size"] = len(near_duplicate_index)
+    return stats
@@ -0,0 +1,160 @@
+"""
+Local keyword classifier that decides whether a query needs a web search.
+"""
+import os
+import re
+import math
+import time
+import logging
+from collections import namedtuple
+from keyword_engine import KeywordEngine
+
+logger = logging.getLogger(__name__)
+
+# Основы слов и фразы по категориям. Каждая основа совпадает с началом слова,
+# поэтому "погод" находит "погода", "погоды", "погодой"; "$" в конце требует
+# совпадения целого слова ("топ$" не находит "топливо").
+KEYWORDS = {
+    # Фразы, которые почти всегда означают просьбу найти актуальную информацию
+    "strong": [
+        "найди", "поищи", "погугли", "узнай", "найди информацию", "сколько стоит", "какая цена",
+        "сколько сейчас", "на сегодня", "на текущий момент", "на данный момент", "в настоящее время",
+        "актуальный список", "текущий рейтинг", "что нового", "какие новости", "что происходит",
+        "последние изменения", "текущая ситуация", "как обстоят дела", "где купить", "где посмотреть",
+    ],
+    # Данные, которые постоянно меняются
+    "live": [
+        "погод", "температур", "осадк", "прогноз", "курс", "цен$", "цена", "цены", "цену", "ценам",
+        "ценах", "ценой", "ценник", "стоимост", "котировк", "акци",
+        "бирж", "капитализац", "биткоин", "bitcoin", "криптовалют", "крипто", "эфир$", "ethereum",
+        "инфляц", "ставк", "выручк", "прибыл", "новост", "событи", "происшеств", "расписани",
+        "пробк", "счет матча", "результат матча", "матч", "турнирн", "выборы", "выборах", "выборов",
+        "вакан", "релиз", "вышел", "вышла", "выйдет", "обновлени",
+    ],
+    # Слова свежести
+    "recency": [
+        "сейчас", "сегодня", "вчера", "завтра", "текущ", "актуальн", "последн", "свеж", "недавн",
+        "нынешн", "современн", "в этом году", "в этом месяце", "на этой неделе", "на выходных",
+        "новый", "новая", "новое", "новые", "нового$", "новому$", "новым$", "новыми$", "новых$",
+        "новой$", "новую$", "новом$", "новейш",
+    ],
+    # Списки и рейтинги
+    "ranking": [
+        "топ$", "рейтинг", "список", "лидер", "самых", "лучших", "богатейш", "крупнейш", "дорогих",
+        "популярн", "успешн",
+    ],
+    # Сущности, данные о которых меняются со временем
+    "entity": [
+        "компани", "организац", "банк", "бренд", "корпорац", "стартап", "apple", "google", "microsoft",
+        "amazon", "tesla", "nvidia", "openai", "сбербанк", "газпром", "яндекс", "президент", "министр",
+        "смартфон", "телефон", "iphone", "видеокарт", "ноутбук", "модел",
+    ],
+    # Вопросы, на которые модель отвечает сама: определения, объяснения, история, творческие задачи
+    "knowledge": [
+        "что такое", "что значит", "что означает", "объясни", "расскажи про принцип", "как работает",
+        "как устроен", "принцип", "определени", "в чем разница", "чем отличается", "почему", "зачем",
+        "история", "историческ", "кто был", "кто написал", "кто изобрел", "кто открыл", "когда был",
+        "в каком году был", "формул", "теорем", "докажи", "реши", "вычисли", "посчитай", "переведи",
+        "перевод", "напиши", "сочини", "придумай", "составь", "перефразируй", "исправь", "пример кода",
+        "функци", "алгоритм", "синтаксис", "грамматик", "правило", "значение слова", "синоним",
+        "рецепт", "как приготовить", "совет", "посоветуй",
+    ],
+}
+
+# Вес каждой категории в итоговой оценке (логит вероятности, что поиск нужен)
+WEIGHTS = {
+    "strong": 3.0,
+    "live": 2.5,
+    "recency": 1.5,
+    "ranking": 1.0,
+    "ranking_entity": 2.0,
+    "year_entity": 2.0,
+    "current_year": 2.0,
+    "past_year": -1.5,
+    "fresh_entity": 2.0,
+    "knowledge": -3.0,
+}
+
+# Наибольший вес признаков знаний, если в запросе есть известная сущность со словом свежести
+# или недавним годом: "какие функции у нового iphone 16" - вопрос о текущем товаре, а не о функциях
+# вообще, и "функци" не должна перевешивать сущность и свежесть
+FRESH_ENTITY_KNOWLEDGE_WEIGHT = -1.0
+
+# Смещение: запрос без признаков считается скорее вопросом к знаниям модели
+BIAS = -0.5
+
+# Решение принимается локально, только если вероятность дальше от 0.5, чем этот порог
+DEFAULT_CONFIDENCE = float(os.getenv('SEARCH_CLASSIFIER_CONFIDENCE', '0.8'))
+
+SearchDecision = namedtuple("SearchDecision", ["needs_search", "confidence", "score", "signals"])
+SearchDecision.__doc__ = """Решение классификатора: нужен ли поиск, уверенность (0.5-1.0), логит и найденные признаки."""
+
+
+_MATCHER = KeywordEngine(KEYWORDS, word_start=True)
+_YEAR_PATTERN = re.compile(r"(?<!\d)(1[0-9]{3}|20[0-9]{2})(?!\d)")
+# "нового macbook", "новых видеокарт": слово свежести перед названием делает его свежей
+# сущностью без списка брендов и товаров ("новый год" - праздник, а не товар)
+_NEW_ITEM_PATTERN = re.compile(r"\bнов(?:ый|ая|ое|ые|ого|ому|ым|ыми|ых|ой|ую|ом|ейш\w*)\s+(?!год(?:а|у|ом)?\b)[^\W\d_]",
+                               re.IGNORECASE)
+
+
+def _year_signals(text, current_year):
+    """Возвращает признаки по упомянутым годам: недавний/будущий год или прошлое."""
+    signals = set()
+    for match in _YEAR_PATTERN.finditer(text):
+        year = int(match.group(1))
+        signals.add("current_year" if year >= current_year - 1 else "past_year")
+    return signals
+
+
+def classify_search_need(query, current_year=None):
+    """
+    Определяет по ключевым словам, нужен ли для ответа на запрос веб-поиск.
+
+    Args:
+        query (str): Запрос пользователя
+        current_year (int, optional): Текущий год, по умолчанию берется из системного времени
+
+    Returns:
+        SearchDecision: Решение, уверенность и признаки, по которым оно принято
+    """
+    if current_year is None:
+        current_year = time.localtime().tm_year
+
+    signals = _MATCHER.match(query)
+    signals |= _year_signals(query, current_year)
+    if _NEW_ITEM_PATTERN.search(query):
+        signals.add("new_item")
+
+    if "entity" in signals or "new_item" in signals:
+        if "ranking" in signals:
+            signals.add("ranking_entity")
+        if "current_year" in signals:
+            signals.add("year_entity")
+        if "recency" in signals or "current_year" in signals:
+            signals.add("fresh_entity")
+
+    weights = dict(WEIGHTS)
+    # Знания ограничиваются только для известной сущности или года; "функции нового macbook"
+    # без них остается неуверенным (оценка около нуля), и решение принимает LLM
+    if "fresh_entity" in signals and ("entity" in signals or "current_year" in signals):
+        weights["knowledge"] = max(weights["knowledge"], FRESH_ENTITY_KNOWLEDGE_WEIGHT)
+    score = BIAS + sum(weights.get(signal, 0.0) for signal in signals)
+    probability = 1.0 / (1.0 + math.exp(-score))
+    needs_search = probability >= 0.5
+    confidence = probability if needs_search else 1.0 - probability
+    return SearchDecision(needs_search, round(confidence, 3), round(score, 2), tuple(sorted(signals)))
+
+
+def is_confident(decision, threshold=None):
+    """
+    Проверяет, достаточно ли уверен локальный классификатор, чтобы не спрашивать LLM.
+
+    Args:
+        decision (SearchDecision): Решение classify_search_need
+        threshold (float, optional): Минимальная уверенность, по умолчанию SEARCH_CLASSIFIER_CONFIDENCE
+
+    Returns:
+        bool: True, если решению можно доверять без дополнительной проверки
+    """
+    return decision.confidence >= (DEFAULT_CONFIDENCE if threshold is None else threshold)
@@ -0,0 +1,158 @@
+"""
+Typed results of Perplexity searches.
+"""
+from dataclasses import dataclass, field, asdict, replace
+from response_parser import parse_search_content
+
+
+@dataclass(slots=True)
+class SubQueryResult:
+    """
+    Результат поиска по одному подзапросу.
+
+    Attributes:
+        query (str): Подзапрос
+        content (str): Текст ответа поисковой модели
+        sections (list): Разделы ответа, выделенные response_parser
+        sources (list): Ссылки на источники
+        model (str): Поисковая модель
+        found (bool): Найдена ли информация
+        elapsed (float): Время запроса к API в секундах (0 для кэша и тестового режима)
+        cache (str or None): "exact" или "near-duplicate", если результат взят из кэша
+        fallback (bool): Получен ли результат резервным методом поиска
+        error (bool): Поиск не удался из-за ошибки, таймаута или недоступности сервиса
+            (а не потому, что информации нет); такой результат стоит запросить повторно
+    """
+    query: str
+    content: str
+    sections: list = field(default_factory=list)
+    sources: list = field(default_factory=list)
+    model: str = "sonar"
+    found: bool = True
+    elapsed: float = 0.0
+    cache: str = None
+    fallback: bool = False
+    error: bool = False
+
+    def render(self):
+        """Текст результата для промпта: ответ и список источников."""
+        if self.sources:
+            return self.content + "\n\nИСТОЧНИКИ:\n" + "\n".join(self.sources)
+        return self.content
+
+    def to_dict(self):
+        """Словарь для кэша и JSON-ответов API."""
+        return asdict(self)
+
+    @classmethod
+    def from_text(cls, query, content, **fields):
+        """
+        Оборачивает готовый текст (тестовый ответ, резервный поиск, строку старого API) в результат.
+
+        Args:
+            query (str): Запрос
+            content (str): Текст результата
+            **fields: Остальные поля SubQueryResult
+
+        Returns:
+            SubQueryResult: Результат с разделами и источниками, найденными в тексте
+        """
+        content = content or ""
+        parsed = parse_search_content(content)
+        fields.setdefault("found", bool(content))
+        return cls(query, content, parsed["sections"], parsed["sources"], **fields)
+
+    @classmethod
+    def from_dict(cls, data, **changes):
+        """
+        Восстанавливает результат из словаря to_dict.
+
+        Args:
+            data (dict): Словарь, сохраненный в кэше
+            **changes: Поля, которые нужно заменить (например, cache)
+
+        Returns:
+            SubQueryResult: Результат подзапроса
+        """
+        if "content" not in data:
+            # Записи кэша в прежнем формате: готовый текст в поле "result"
+            data = {"query": data.get("query", ""), "content": data.get("result", ""), "found": data.get("found", True)}
+        fields = {name: data[name] for name in cls.__dataclass_fields__ if name in data}
+        return replace(cls(**fields), **changes) if changes else cls(**fields)
+
+
+@dataclass(slots=True)
+class SearchResult:
+    """
+    Результат поиска по запросу пользователя: подзапросы и общее время.
+
+    Текст для промпта собирается только при вызове render() (или str()).
+
+    Attributes:
+        query (str): Исходный запрос
+        subqueries (list): Результаты подзапросов SubQueryResult в порядке split_complex_query
+        elapsed (float): Общее время поиска в секундах
+    """
+    query: str
+    subqueries: list = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def found(self):
+        """Найдена ли информация хотя бы по одному подзапросу."""
+        return any(result.found for result in self.subqueries)
+
+    @property
+    def missing(self):
+        """Подзапросы, по которым информация не найдена (поиск и резервный поиск не удались)."""
+        return [result.query for result in self.subqueries if not result.found]
+
+    @property
+    def failed(self):
+        """Подзапросы, поиск по которым не удался из-за ошибки, а не из-за отсутствия информации."""
+        return [result.query for result in self.subqueries if result.error]
+
+    @property
+    def complete(self):
+        """Найдена ли информация по всем подзапросам."""
+        return not self.missing
+
+    @property
+    def sources(self):
+        """Ссылки на источники всех подзапросов без повторов."""
+        return list(dict.fromkeys(url for result in self.subqueries for url in result.sources))
+
+    @property
+    def has_sources(self):
+        """Есть ли в результатах ссылки на источники."""
+        return any(result.sources for result in self.subqueries)
+
+    @property
+    def model(self):
+        """Поисковая модель первого подзапроса."""
+        return self.subqueries[0].model if self.subqueries else "sonar"
+
+    def render(self):
+        """
+        Собирает текст результатов для промпта LLM.
+
+        Подзапросы без найденной информации пропускаются, если найдено хоть что-то:
+        их список дает missing.
+
+        Returns:
+            str: Результат единственного подзапроса или результаты всех подзапросов с заголовками "ЗАПРОС:"
+        """
+        if len(self.subqueries) == 1:
+            return self.subqueries[0].render()
+        parts = ["\n\n=== РЕЗУЛЬТАТЫ ПОИСКА ===\n\n"]
+        for result in self.subqueries:
+            if self.found and not result.found:
+                continue
+            parts.append(f"ЗАПРОС: {result.query}\n\n{result.render()}\n\n---\n\n")
+        return "".join(parts)
+
+    def __str__(self):
+        return self.render()
+
+    def __bool__(self):
+        return self.found
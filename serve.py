@@ -0,0 +1,116 @@
+"""
+Production entry point: runs web_app under gunicorn with threaded workers.
+
+Usage: python serve.py [--bind 0.0.0.0:5007] [--workers 2] [--threads 16]
+
+Requests spend most of their time waiting on Perplexity and Claude, so each
+worker process serves many requests at once on threads (gthread). The app is
+imported once in the master process and shared copy-on-write with the workers.
+Its objects are moved out of the garbage collector's reach with gc.freeze(), so
+collections in the workers do not touch (and copy) the shared pages.
+"""
+import gc
+import os
+import sys
+import argparse
+import logging
+import threading
+from gunicorn.app.base import BaseApplication
+
+logger = logging.getLogger(__name__)
+
+
+def default_workers():
+    """Число рабочих процессов по умолчанию: по одному на ядро, но не больше 4 (нагрузка в основном - ожидание API)."""
+    return max(1, min(os.cpu_count() or 1, 4))
+
+
+def build_options(bind=None, workers=None, threads=None):
+    """
+    Собирает настройки gunicorn из аргументов и переменных окружения.
+
+    Настройки: WEB_BIND (по умолчанию 0.0.0.0:$PORT, PORT - 5007), WEB_WORKERS,
+    WEB_THREADS (16), WEB_MAX_REQUESTS (1000) и WEB_MAX_REQUESTS_JITTER (100) - перезапуск
+    рабочего процесса после стольких запросов, WEB_KEEPALIVE (75 секунд, дольше, чем
+    keepalive_timeout nginx по умолчанию), WEB_TIMEOUT (120) и WEB_GRACEFUL_TIMEOUT (30),
+    WEB_PRELOAD (1).
+
+    Args:
+        bind (str, optional): Адрес и порт
+        workers (int, optional): Число рабочих процессов
+        threads (int, optional): Потоков в каждом процессе
+
+    Returns:
+        dict: Настройки gunicorn
+    """
+    return {
+        "bind": bind or os.getenv('WEB_BIND', f"0.0.0.0:{os.getenv('PORT', '5007')}"),
+        "worker_class": "gthread",
+        "workers": workers or int(os.getenv('WEB_WORKERS', str(default_workers()))),
+        "threads": threads or int(os.getenv('WEB_THREADS', '16')),
+        "preload_app": os.getenv('WEB_PRELOAD', '1') != '0',
+        "max_requests": int(os.getenv('WEB_MAX_REQUESTS', '1000')),
+        "max_requests_jitter": int(os.getenv('WEB_MAX_REQUESTS_JITTER', '100')),
+        "keepalive": int(os.getenv('WEB_KEEPALIVE', '75')),
+        # Ответ с поиском укладывается в QUERY_DEADLINE; поток ответа может идти дольше
+        "timeout": int(os.getenv('WEB_TIMEOUT', '120')),
+        "graceful_timeout": int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30')),
+        "accesslog": os.getenv('WEB_ACCESS_LOG') or None,
+        "pre_fork": pre_fork,
+        "post_fork": post_fork,
+        "post_worker_init": post_worker_init,
+    }
+
+
+def pre_fork(server, worker):
+    """Перед fork переносит все объекты главного процесса в постоянное поколение сборщика мусора."""
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    """В рабочем процессе сборщик мусора снова включен; замороженные объекты он не обходит."""
+    gc.enable()
+
+
+def post_worker_init(worker):
+    """Прогревает пулы соединений рабочего процесса: сокеты главного процесса после fork не используются."""
+    import web_app
+    from http_client import prewarm
+    if not web_app.TEST_MODE:
+        threading.Thread(target=prewarm, daemon=True).start()
+
+
+class WebApplication(BaseApplication):
+    """Приложение gunicorn, которое берет настройки из словаря, а не из командной строки."""
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        import web_app
+        web_app.prepare_app(prewarm_pools=False)
+        return web_app.app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Запуск веб-интерфейса под gunicorn")
+    parser.add_argument("--bind", help="Адрес и порт (по умолчанию WEB_BIND или 0.0.0.0:$PORT)")
+    parser.add_argument("--workers", type=int, help="Число рабочих процессов (по умолчанию WEB_WORKERS)")
+    parser.add_argument("--threads", type=int, help="Потоков в рабочем процессе (по умолчанию WEB_THREADS)")
+    args = parser.parse_args(argv)
+
+    # Сборщик мусора в главном процессе отключен до fork: иначе он освобождает объекты
+    # вперемешку с живыми, и страницы памяти, общие с рабочими процессами, копируются
+    gc.disable()
+    WebApplication(build_options(args.bind, args.workers, args.threads)).run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
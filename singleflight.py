@@ -0,0 +1,109 @@
+"""
+Single-flight coalescing of identical in-flight upstream calls.
+"""
+import asyncio
+import logging
+import threading
+import concurrent.futures
+
+logger = logging.getLogger(__name__)
+
+# Все созданные группы, чтобы отдавать их счетчики в /api/metrics
+_groups = {}
+
+
+class _LeaderCancelled(Exception):
+    """Выполнявший вызов запрос отменен; ожидающие повторяют вызов сами."""
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные одинаковые вызовы: первый вызов с данным ключом
+    выполняется, остальные ждут и получают тот же результат (или исключение).
+
+    Ожидание построено на concurrent.futures.Future, поэтому к вызову могут
+    присоединиться корутины из любого event loop и любого потока.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.upstream_calls = 0
+        self.shared_calls = 0
+        _groups[name] = self
+
+    async def run(self, key, call):
+        """
+        Выполняет call() или присоединяется к уже идущему вызову с тем же ключом.
+
+        Отмена ожидающего не затрагивает остальных. Если отменен тот, кто выполняет
+        вызов, ожидающие его результат не получают чужую отмену: один из них
+        выполняет вызов заново.
+
+        Args:
+            key (str): Ключ, одинаковый для взаимозаменяемых вызовов
+            call (callable): Функция без аргументов, возвращающая корутину
+
+        Returns:
+            Результат корутины
+        """
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                leader = future is None
+                if leader:
+                    future = self._calls[key] = concurrent.futures.Future()
+                    self.upstream_calls += 1
+                else:
+                    self.shared_calls += 1
+
+            if leader:
+                break
+            logger.info(f"Запрос к {self.name} присоединен к уже выполняющемуся вызову")
+            try:
+                # shield: отмена этого ожидающего не должна отменять общий future
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except _LeaderCancelled:
+                logger.info(f"Вызов {self.name} отменен ведущим запросом, повторяю")
+                with self._lock:
+                    self.shared_calls -= 1
+
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            self._finish(key, future)
+            future.set_exception(_LeaderCancelled())
+            raise
+        except BaseException as e:
+            self._finish(key, future)
+            future.set_exception(e)
+            raise
+        self._finish(key, future)
+        future.set_result(result)
+        return result
+
+    def _finish(self, key, future):
+        """Убирает завершенный вызов, чтобы следующие вызовы с ключом выполнялись заново."""
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def stats(self):
+        """
+        Возвращает счетчики группы.
+
+        Returns:
+            dict: Число реальных вызовов, сэкономленных вызовов и вызовов в полете
+        """
+        with self._lock:
+            return {
+                "upstream_calls": self.upstream_calls,
+                "saved_calls": self.shared_calls,
+                "in_flight": len(self._calls),
+            }
+
+
+def get_single_flight_stats():
+    """Возвращает счетчики всех групп объединения запросов."""
+    return {name: group.stats() for name, group in _groups.items()}
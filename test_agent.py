@@ -46,7 +46,7 @@ def run_test_scenario(scenario_id, query, test_mode=False):
         if search_needed:
             start_time = time.time()
             print("Выполняется поиск информации...")
-            search_results = search_perplexity(processed_query, test_mode=test_mode)
+            search_results = str(search_perplexity(processed_query, test_mode=test_mode))
             search_time = time.time() - start_time
             print(f"Поиск выполнен за {search_time:.2f} секунд")
             print(f"Результаты поиска (первые 200 символов): {search_results[:200]}...")
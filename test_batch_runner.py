@@ -0,0 +1,101 @@
+"""
+Тестирование пакетной обработки JSONL-файлов в тестовом режиме.
+"""
+import json
+import asyncio
+import httpx
+import llm_api
+from http_client import ANTHROPIC, PERPLEXITY
+from retry_policy import RetryPolicy
+from batch_runner import run_batch, load_checkpoint
+
+QUERIES = ["Погода в Москве сегодня", "Курс биткоина", "Объясни квантовые вычисления", "Топ 5 компаний по капитализации"]
+
+
+def _write_input(path):
+    path.write_text("".join(json.dumps({"id": f"q{index}", "query": query}, ensure_ascii=False) + "\n"
+                            for index, query in enumerate(QUERIES)), encoding="utf-8")
+
+
+def _read_output(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+def test_batch_writes_rows_with_timings(tmp_path):
+    """Каждая строка входа дает строку результата с ответом и временем этапов."""
+    source, output = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    _write_input(source)
+    summary = asyncio.run(run_batch(str(source), str(output), concurrency=3, test_mode=True))
+    assert summary["processed"] == len(QUERIES) and summary["errors"] == 0
+
+    rows = {row["id"]: row for row in _read_output(output)}
+    assert set(rows) == {f"q{index}" for index in range(len(QUERIES))}
+    assert rows["q1"]["search_performed"] and rows["q1"]["response"]
+    assert not rows["q2"]["search_performed"]
+    assert set(rows["q0"]["timings"]) == {"wait", "search", "llm", "total"}
+
+
+def test_resume_skips_finished_rows(tmp_path):
+    """Повторный запуск пропускает готовые строки и отрезает оборванную запись."""
+    source, output = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    _write_input(source)
+    output.write_text(json.dumps({"id": "q0", "response": "готово"}) + "\n"
+                      + json.dumps({"id": "q2", "response": None, "error": "HTTP 529"}) + "\n"
+                      + '{"id": "q1", "resp', encoding="utf-8")
+    assert load_checkpoint(str(output)) == {"q0"}
+
+    summary = asyncio.run(run_batch(str(source), str(output), concurrency=2, test_mode=True))
+    assert summary["skipped"] == 1 and summary["processed"] == len(QUERIES) - 1
+    ids = [row["id"] for row in _read_output(output)]
+    assert sorted(ids) == sorted(["q2"] + [f"q{index}" for index in range(len(QUERIES))])
+    assert load_checkpoint(str(output)) == {f"q{index}" for index in range(len(QUERIES))}
+
+
+def test_rate_limit_spaces_calls(tmp_path, mock_api):
+    """Ограничение частоты Claude (всплеск 4, затем 4 в секунду) растягивает пакет и учитывается во времени ожидания строк."""
+    def handler(request):
+        return httpx.Response(200, json={"content": [{"type": "text", "text": "ok"}], "usage": {"input_tokens": 1, "output_tokens": 1}})
+
+    # Отдельные ограничители, чтобы настройки теста не влияли на другие тесты
+    mock_api(handler)
+
+    source, output = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    source.write_text("".join(json.dumps({"query": f"Объясни теорему номер {index}"}, ensure_ascii=False) + "\n"
+                              for index in range(6)), encoding="utf-8")
+    summary = asyncio.run(run_batch(str(source), str(output), concurrency=6, llm_rps=4))
+    assert summary["processed"] == 6 and summary["errors"] == 0
+    assert summary["elapsed"] >= 0.4
+    assert max(row["timings"]["wait"] for row in _read_output(output)) >= 0.4
+
+
+def test_error_responses_are_retried_on_resume(tmp_path, mock_api):
+    """Текст ошибки Claude и недоступный поиск отмечаются как ошибка, и следующий запуск повторяет строку."""
+    available = False
+
+    def handler(request):
+        # Пока available ложно, Perplexity недоступен, а Claude перегружен для запроса про рекурсию
+        if request.url.host == "api.perplexity.ai":
+            if not available:
+                return httpx.Response(529, json={"error": "overloaded"})
+            return httpx.Response(200, json={"model": "sonar", "choices": [{"message": {"content": "Курс биткоина $92,467"}}]})
+        if not available and "рекурси" in request.content.decode():
+            return httpx.Response(529, json={"error": {"type": "overloaded_error"}})
+        return httpx.Response(200, json={"content": [{"type": "text", "text": "ok"}], "usage": {"input_tokens": 1, "output_tokens": 1}})
+
+    mock_api(handler, policies={ANTHROPIC: RetryPolicy(ANTHROPIC, max_attempts=1, budget=5),
+                                PERPLEXITY: RetryPolicy(PERPLEXITY, max_attempts=1, budget=5)})
+    source, output = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    source.write_text(json.dumps({"id": "q0", "query": "Объясни рекурсию"}, ensure_ascii=False) + "\n"
+                      + json.dumps({"id": "q1", "query": "Курс биткоина"}, ensure_ascii=False) + "\n", encoding="utf-8")
+
+    summary = asyncio.run(run_batch(str(source), str(output), concurrency=2))
+    rows = {row["id"]: row for row in _read_output(output)}
+    assert summary["errors"] == 2
+    assert llm_api.is_error_response(rows["q0"]["error"]) and rows["q0"]["response"] is None
+    assert rows["q1"]["error"].startswith("поиск не удался") and rows["q1"]["response"] == "ok"
+    assert load_checkpoint(str(output)) == set()
+
+    available = True
+    summary = asyncio.run(run_batch(str(source), str(output), concurrency=2))
+    assert summary["processed"] == 2 and summary["errors"] == 0
+    assert load_checkpoint(str(output)) == {"q0", "q1"}
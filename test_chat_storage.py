@@ -0,0 +1,125 @@
+"""
+Тестирование хранилища чатов в SQLite.
+"""
+import sqlite3
+import threading
+import multiprocessing
+import pytest
+import web_app
+
+
+@pytest.fixture
+def chat_db(tmp_path, monkeypatch):
+    """База чатов во временном каталоге и свежие соединения потоков."""
+    monkeypatch.setattr(web_app, "DATABASE", str(tmp_path / "chats.db"))
+    monkeypatch.setattr(web_app, "_db_local", threading.local())
+    web_app.init_db()
+    return web_app.DATABASE
+
+
+def _write_chats(count, errors):
+    """Записывает count чатов из нескольких потоков; ошибки складывает в errors."""
+    def worker():
+        for i in range(count):
+            try:
+                chat_id = web_app.save_chat(f"вопрос {i}", "ответ " * 200, True, False, "writer-session")
+                assert web_app.get_chat_by_id(chat_id, "writer-session")["user_input"] == f"вопрос {i}"
+            except sqlite3.OperationalError as e:
+                errors.append(str(e))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _write_chats_process(count, queue):
+    errors = []
+    _write_chats(count, errors)
+    queue.put(errors)
+
+
+def test_connection_is_reused_with_wal(chat_db):
+    """Поток использует одно соединение в режиме WAL с synchronous=NORMAL."""
+    db = web_app.get_db()
+    assert web_app.get_db() is db
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert db.execute("PRAGMA synchronous").fetchone()[0] == 1
+    assert db.execute("PRAGMA busy_timeout").fetchone()[0] == int(web_app.DB_BUSY_TIMEOUT * 1000)
+
+
+def test_concurrent_writers_from_several_processes(chat_db):
+    """Несколько процессов по несколько потоков пишут одновременно без 'database is locked'."""
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    processes = [context.Process(target=_write_chats_process, args=(25, queue)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    errors = []
+    _write_chats(25, errors)
+    for _ in processes:
+        errors.extend(queue.get(timeout=60))
+    for process in processes:
+        process.join()
+
+    assert errors == []
+    assert web_app.get_db().execute("SELECT count(*) FROM chats").fetchone()[0] == 4 * 4 * 25
+
+
+def test_history_pages_by_cursor_within_session(chat_db, monkeypatch):
+    """История сессии отдается страницами по курсору, без ответов и без чатов других сессий."""
+    monkeypatch.setattr(web_app, "HISTORY_PREVIEW_CHARS", 10)
+    for i in range(5):
+        web_app.save_chat(f"вопрос номер {i} " + "x" * 50, "полный ответ", False, True, "session-alice")
+    web_app.save_chat("чужой вопрос", "чужой ответ", False, True, "session-bob")
+
+    client = web_app.app.test_client()
+    pages, cursor = [], None
+    while True:
+        query = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        data = client.get('/api/history', query_string=query, headers={"X-Session-Id": "session-alice"}).get_json()
+        pages.append(data["history"])
+        cursor = data["next_cursor"]
+        if not cursor:
+            break
+
+    assert [len(page) for page in pages] == [2, 2, 1]
+    chats = [chat for page in pages for chat in page]
+    assert [chat["query"] for chat in chats] == ["вопрос ном"] * 5
+    assert set(chats[0]) == {"id", "timestamp", "query"}
+    assert chats == sorted(chats, key=lambda chat: (chat["timestamp"], chat["id"]), reverse=True)
+
+    chat_id = chats[0]["id"]
+    full = client.get(f'/api/history/{chat_id}', headers={"X-Session-Id": "session-alice"}).get_json()["chat"]
+    assert full["response"] == "полный ответ"
+    assert client.get(f'/api/history/{chat_id}', headers={"X-Session-Id": "session-bob"}).status_code == 404
+    assert client.get('/api/history', query_string={"cursor": "испорчен"}).status_code == 400
+
+
+def test_history_query_uses_session_index(chat_db):
+    """Страница истории читается по индексу (session_id, timestamp, id) без сортировки."""
+    db = web_app.get_db()
+    for sql, args in ((web_app.SELECT_HISTORY_SQL, (10, "s", 21)),
+                      (web_app.SELECT_HISTORY_AFTER_SQL, (10, "s", "2025-01-01", "id", 21))):
+        plan = " ".join(row[-1] for row in db.execute("EXPLAIN QUERY PLAN " + sql, args))
+        assert "idx_chats_session_timestamp" in plan and "TEMP B-TREE" not in plan
+
+
+def test_migration_adds_session_column(tmp_path, monkeypatch):
+    """База, созданная до появления сессий, получает колонку session_id и индекс."""
+    path = tmp_path / "old.db"
+    old = sqlite3.connect(path)
+    old.execute("CREATE TABLE chats (id TEXT PRIMARY KEY, timestamp TEXT NOT NULL, user_input TEXT NOT NULL, "
+                "response TEXT NOT NULL, search_performed INTEGER NOT NULL, test_mode INTEGER NOT NULL)")
+    old.execute("INSERT INTO chats VALUES ('old', '2024-01-01T00:00:00', 'вопрос', 'ответ', 0, 0)")
+    old.commit()
+    old.close()
+
+    monkeypatch.setattr(web_app, "DATABASE", str(path))
+    monkeypatch.setattr(web_app, "_db_local", threading.local())
+    web_app.init_db()
+    assert web_app.get_chat_by_id("old", "")["user_input"] == "вопрос"
+    indexes = [row["name"] for row in web_app.get_db().execute("PRAGMA index_list(chats)")]
+    assert "idx_chats_session_timestamp" in indexes
+    assert web_app.get_chat_history("new-session") == ([], None)
@@ -0,0 +1,75 @@
+"""
+Тестирование автоматов отключения внешних сервисов.
+"""
+import time
+import asyncio
+import httpx
+import pytest
+import search_api
+import search_cache
+from http_client import PERPLEXITY
+from circuit_breaker import CircuitBreaker, CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+from retry_policy import RetryPolicy
+
+
+def test_breaker_trips_on_failure_rate_and_slow_calls():
+    """Автомат размыкается по доле ошибок или медленных ответов; 429 и 4xx не учитываются."""
+    breaker = CircuitBreaker("test", window=10, min_calls=4, failure_rate=0.5, slow_call=1.0)
+    for status in (429, 400, 503):
+        breaker.allow()
+        breaker.record(status, latency=0.1)
+    assert breaker.state == CLOSED
+
+    breaker.allow()
+    breaker.record(200, latency=2.0)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    assert breaker.stats()["opened"] == 1 and breaker.stats()["rejected"] == 1
+
+
+def test_breaker_half_opens_after_timeout():
+    """После паузы пропускаются только пробные вызовы; их успех замыкает автомат, ошибка - снова размыкает."""
+    breaker = CircuitBreaker("test", min_calls=1, failure_rate=0.5, open_seconds=0.05, half_open_calls=2)
+    breaker.record(None, error=True)
+    assert breaker.state == OPEN
+
+    time.sleep(0.06)
+    assert breaker.allow() and breaker.allow()
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    breaker.record(502, latency=0.1, probe=True)
+    assert breaker.state == OPEN
+
+    time.sleep(0.06)
+    assert breaker.state == HALF_OPEN
+    for _ in range(2):
+        breaker.record(200, latency=0.1, probe=breaker.allow())
+    assert breaker.state == CLOSED
+
+
+def test_open_breaker_skips_search_without_waiting(mock_api):
+    """Разомкнутый автомат Perplexity отдает кэш, а непокрытые подзапросы сразу помечает недоступными."""
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503, json={"error": "unavailable"})
+
+    breaker = CircuitBreaker(PERPLEXITY, min_calls=2, failure_rate=0.5, open_seconds=60)
+    mock_api(handler, policies={PERPLEXITY: RetryPolicy(PERPLEXITY, max_attempts=1, budget=5)}, breakers={PERPLEXITY: breaker})
+
+    # Ошибки первого запроса (основной и резервный вызов) размыкают автомат
+    asyncio.run(search_api.asearch_perplexity("курс рубля к юане"))
+    assert breaker.state == OPEN and len(calls) == 2
+
+    topic = search_api.classify_query_topic("погода в Казани")
+    search_cache.store(topic, "погода в Казани", {"query": "погода в Казани", "content": "В Казани +5°C", "sources": []})
+
+    start = time.monotonic()
+    cached = asyncio.run(search_api.asearch_perplexity("погода в Казани"))
+    skipped = asyncio.run(search_api.asearch_perplexity("курс рубля к юане"))
+    assert time.monotonic() - start < 0.5 and len(calls) == 2
+    assert "+5°C" in str(cached) and cached.subqueries[0].cache == "exact"
+    assert not skipped and skipped.subqueries[0].content == search_api.UNAVAILABLE_MESSAGE
+    assert breaker.stats()["rejected"] == 1
@@ -0,0 +1,104 @@
+"""
+Тестирование срока запроса и деградации при его истечении.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import subprocess
+import httpx
+import pytest
+import search_api
+from http_client import PERPLEXITY
+from deadline import Deadline, deadline_scope, time_left, current_deadline, PARTIAL
+from retry_policy import RetryPolicy
+
+
+@pytest.fixture
+def slow_perplexity(mock_api):
+    """Подменяет Perplexity: подзапросы про биткоин отвечают через 3 секунды, остальные сразу."""
+    async def handler(request):
+        content = json.loads(request.content)["messages"][-1]["content"]
+        if "биткоин" in content:
+            await asyncio.sleep(3)
+        return httpx.Response(200, json={"model": "sonar", "choices": [{"message": {"content": f"Ответ: {content}"}}]})
+
+    mock_api(handler, policies={PERPLEXITY: RetryPolicy(PERPLEXITY, budget=60)})
+
+
+def test_deadline_budgets():
+    """Поиск оставляет резерв на ответ Claude; таймауты этапов не выходят за срок."""
+    deadline = Deadline(10, llm_reserve=4)
+    assert 5.9 < deadline.search_budget() <= 6
+    assert Deadline(4, llm_reserve=12).search_budget() <= 2
+    with pytest.raises(ValueError):
+        Deadline(10, degrade="wait")
+
+    assert time_left(45) == 45
+    with deadline_scope(3):
+        assert time_left(45) <= 3
+        assert current_deadline() is not None
+    assert current_deadline() is None
+
+
+def test_invalid_default_degrade_falls_back_to_partial():
+    """Неизвестный DEADLINE_DEGRADE заменяется на partial при импорте, а не ломает каждый запрос."""
+    env = dict(os.environ, DEADLINE_DEGRADE="wait")
+    result = subprocess.run([sys.executable, "-c", "import deadline; print(deadline.Deadline(5).degrade)"],
+                            capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == PARTIAL
+
+
+def test_run_until_waits_for_cancelled_tasks():
+    """Не успевшие к сроку задачи отменяются, и _run_until дожидается их очистки."""
+    cleaned = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        finally:
+            await asyncio.sleep(0.01)
+            cleaned.append(True)
+
+    async def fast():
+        return "готово"
+
+    async def run():
+        return await search_api._run_until([fast(), slow()], time.monotonic() + 0.1)
+
+    assert asyncio.run(run()) == ["готово", search_api._TIMED_OUT]
+    assert cleaned == [True]
+
+
+def test_search_returns_arrived_results_at_deadline(slow_perplexity):
+    """Медленный подзапрос отменяется по сроку, пришедшие результаты сохраняются."""
+    async def run():
+        with deadline_scope(2) as deadline:
+            start = time.monotonic()
+            results = await search_api.asearch_perplexity("погода в Москве и курс биткоина")
+            return results, deadline, time.monotonic() - start
+
+    results, deadline, elapsed = asyncio.run(run())
+    assert elapsed < 1.5
+    assert results and results.missing == ["курс биткоина"]
+    assert results.subqueries[1].content == search_api.TIMEOUT_MESSAGE
+    assert deadline.events == ["search_timeout"]
+
+
+def test_summary_mode_skips_claude(slow_perplexity, monkeypatch):
+    """В режиме summary по истечении времени поиска Claude не вызывается, возвращаются результаты поиска."""
+    import web_app
+    monkeypatch.setattr(web_app, "save_chat", lambda *args: "chat-id")
+    monkeypatch.setattr(web_app, "query_llm", lambda *args, **kwargs: pytest.fail("Claude не должен вызываться"))
+
+    client = web_app.app.test_client()
+    response = client.post('/api/query', json={"query": "погода в Москве и курс биткоина", "deadline": 2, "degrade": "summary"})
+    data = response.get_json()
+    assert response.status_code == 200
+    assert data["degraded"] == ["search_timeout"]
+    assert "Ответ: погода в Москве" in data["response"]
+
+    response = client.post('/api/query', json={"query": "погода", "degrade": "wait"})
+    assert response.status_code == 400
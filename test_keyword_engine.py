@@ -0,0 +1,53 @@
+"""
+Тестирование движка поиска ключевых слов.
+"""
+from keyword_engine import KeywordEngine
+from search_api import split_complex_query, classify_query_topic, enhance_query
+
+
+def test_overlapping_keywords_in_one_pass():
+    """Все категории находятся за один проход, даже если слова перекрываются."""
+    engine = KeywordEngine({
+        "rate": ["курс"],
+        "crypto": ["крипто", "криптовалют"],
+        "company": ["компани", "компании"],
+    })
+    found = engine.scan("Курс КРИПТОВАЛЮТ и компании")
+    assert found == {"rate": {"курс"}, "crypto": {"крипто", "криптовалют"}, "company": {"компани", "компании"}}
+
+
+def test_whole_word_and_word_start():
+    """"$" требует конца слова, word_start - начала слова."""
+    engine = KeywordEngine({"ranking": ["топ$"], "price": ["цен"]}, word_start=True)
+    assert engine.match("топ-10 цен") == {"ranking", "price"}
+    assert engine.match("топливо") == set()
+    assert engine.match("процент") == set()
+
+
+def test_matches_list_scan():
+    """Результат совпадает с перебором списков через any(word in text.lower() ...)."""
+    keywords = {
+        "weather": ["погода", "температура"],
+        "finance": ["курс", "доллар", "eth", "акци"],
+        "future": ["2025", "будущ"],
+    }
+    engine = KeywordEngine(keywords)
+    for text in ["Погода и курс доллара в 2025", "Ethereum", "ничего", "АКЦИИ будущего", ""]:
+        expected = {category for category, words in keywords.items() if any(word in text.lower() for word in words)}
+        assert engine.match(text) == expected
+
+
+def test_query_functions_use_engine():
+    """Функции обработки запросов работают через общий движок так же, как раньше."""
+    assert split_complex_query("Погода в Москве, курс биткоина") == ["Погода в Москве", "курс биткоина"]
+    assert classify_query_topic("Капитализация Apple") == "capitalization"
+    assert classify_query_topic("цена акций Tesla") == "stock"
+    assert "apple, microsoft" in enhance_query("капитализация Microsoft и Apple")
+
+
+if __name__ == "__main__":
+    test_overlapping_keywords_in_one_pass()
+    test_whole_word_and_word_start()
+    test_matches_list_scan()
+    test_query_functions_use_engine()
+    print("✅ Все проверки движка ключевых слов пройдены")
@@ -0,0 +1,89 @@
+"""
+Тестирование консольного агента: спекулятивный поиск во время решения Claude о поиске.
+"""
+import json
+import time
+import asyncio
+import httpx
+import pytest
+import main
+import llm_api
+
+QUERY = "что там с биткоином"
+
+# Потоковый ответ Claude из одного фрагмента текста
+ANSWER_STREAM = (b'event: content_block_delta\n'
+                 b'data: {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "OK"}}\n\n'
+                 b'event: message_stop\ndata: {"type": "message_stop"}\n\n')
+
+
+@pytest.fixture
+def agent(mock_api, monkeypatch):
+    """
+    Запускает main() на одном запросе с подмененными Claude и Perplexity.
+
+    Локальный классификатор всегда не уверен, поэтому решение принимает Claude.
+
+    Returns:
+        callable: run(decision) -> dict с запросами к сервисам; decision - первая строка ответа Claude
+    """
+    monkeypatch.setattr(main, "is_confident", lambda decision: False)
+    monkeypatch.setattr(llm_api, "is_confident", lambda decision: False)
+
+    def run(decision):
+        calls = {"search": [], "search_cancelled": [], "claude": [], "search_started_before_decision": None}
+
+        async def handler(request):
+            payload = json.loads(request.content)
+            if request.url.host == "api.perplexity.ai":
+                calls["search"].append(payload["messages"][-1]["content"])
+                try:
+                    await asyncio.sleep(0.3)
+                except asyncio.CancelledError:
+                    calls["search_cancelled"].append(True)
+                    raise
+                return httpx.Response(200, json={"model": "sonar", "choices": [{"message": {"content": "Курс биткоина $92,467"}}]})
+
+            calls["claude"].append(payload)
+            if payload.get("stream"):
+                return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=ANSWER_STREAM)
+            # Решение о поиске отвечает, когда спекулятивный поиск уже отправлен
+            for _ in range(100):
+                if calls["search"]:
+                    break
+                await asyncio.sleep(0.01)
+            calls["search_started_before_decision"] = bool(calls["search"])
+            return httpx.Response(200, json={"content": [{"type": "text", "text": decision}]})
+
+        mock_api(handler)
+        answers = iter([QUERY, "выход"])
+        monkeypatch.setattr("builtins.input", lambda prompt="": next(answers))
+        main.main()
+        return calls
+
+    return run
+
+
+def test_search_cancelled_when_claude_says_no(agent):
+    """На "НЕТ" начатый спекулятивно поиск отменяется, а ответ дается без результатов поиска."""
+    calls = agent("НЕТ")
+
+    assert calls["search_started_before_decision"]
+    # Отмена доходит до фонового event loop асинхронно
+    for _ in range(100):
+        if calls["search_cancelled"]:
+            break
+        time.sleep(0.01)
+    assert calls["search_cancelled"] == [True]
+    answer_prompt = calls["claude"][-1]["messages"][-1]["content"]
+    assert calls["claude"][-1]["stream"] and "$92,467" not in json.dumps(answer_prompt, ensure_ascii=False)
+
+
+def test_search_result_reused_when_claude_says_yes(agent):
+    """На "ДА" используется результат уже идущего поиска, повторного запроса к Perplexity нет."""
+    calls = agent("ДА\nкурс биткоина")
+
+    assert calls["search_started_before_decision"]
+    assert len(calls["search"]) == 1 and not calls["search_cancelled"]
+    answer_prompt = calls["claude"][-1]["messages"][-1]["content"]
+    assert calls["claude"][-1]["stream"] and "$92,467" in json.dumps(answer_prompt, ensure_ascii=False)
@@ -0,0 +1,60 @@
+"""
+Тестирование упаковки результатов поиска в бюджет токенов.
+"""
+from prompt_budget import estimate_tokens, truncate_to_tokens, pack_search_results
+from search_models import SearchResult, SubQueryResult
+from utils import combine_input
+
+FILLER = "Дополнительные сведения без отношения к вопросу. " * 40
+
+
+def _result(query, sections, sources):
+    return SubQueryResult(query, "\n\n".join(sections), sections, sources)
+
+
+def test_estimate_and_truncate():
+    """Оценка растет с длиной текста, обрезка укладывается в бюджет."""
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("курс биткоина") < estimate_tokens("курс биткоина " * 10)
+    text, dropped = truncate_to_tokens("слово " * 500, 100)
+    assert estimate_tokens(text) <= 100 and dropped > 0
+    assert truncate_to_tokens("коротко", 100) == ("коротко", 0)
+
+
+def test_fitting_results_are_unchanged():
+    """Если результаты помещаются, текст совпадает с render()."""
+    results = SearchResult("погода", [_result("погода", ["+7°C"], ["https://yandex.ru/pogoda"])])
+    packed = pack_search_results("погода", results, 1000)
+    assert packed.text == results.render() and packed.dropped_tokens == 0
+
+
+def test_relevant_sections_and_sources_are_kept():
+    """В бюджет попадают релевантные разделы обоих подзапросов с источниками, лишнее отбрасывается."""
+    results = SearchResult("Погода в Москве, курс биткоина", [
+        _result("Погода в Москве", [FILLER, "Погода в Москве: +7°C, облачно."], ["https://yandex.ru/pogoda"]),
+        _result("курс биткоина", ["Курс биткоина $92,467.", FILLER], ["https://coinmarketcap.com/"]),
+    ])
+    packed = pack_search_results("Погода в Москве, курс биткоина", results, 120)
+    assert packed.tokens <= 120
+    assert packed.dropped_sections == 2 and packed.dropped_tokens > 0
+    assert "Погода в Москве: +7°C" in packed.text and "$92,467" in packed.text
+    assert "https://yandex.ru/pogoda" in packed.text and "https://coinmarketcap.com/" in packed.text
+    assert "ЗАПРОС: курс биткоина" in packed.text and FILLER not in packed.text
+
+
+def test_combine_input_keeps_query_and_query_type():
+    """Запрос и тип запроса сохраняются при любом объеме результатов, промпт укладывается в бюджет."""
+    results = SearchResult("сколько стоит биткоин", [_result("сколько стоит биткоин", ["Курс биткоина $92,467."] + [FILLER] * 20, [])])
+    prompt = combine_input("сколько стоит биткоин", results, token_budget=800)
+    assert prompt.startswith("Запрос пользователя: сколько стоит биткоин")
+    assert "Тип запроса: фактическая информация" in prompt and prompt.endswith("Ответ для пользователя:")
+    assert "$92,467" in prompt
+    assert estimate_tokens(prompt) <= 800
+
+
+if __name__ == "__main__":
+    test_estimate_and_truncate()
+    test_fitting_results_are_unchanged()
+    test_relevant_sections_and_sources_are_kept()
+    test_combine_input_keeps_query_and_query_type()
+    print("✅ Все проверки бюджета промпта пройдены")
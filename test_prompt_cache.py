@@ -0,0 +1,51 @@
+"""
+Тестирование кэширования промптов Claude: порядок блоков и учет использования токенов.
+"""
+import asyncio
+import json
+import httpx
+import llm_api
+from search_models import SearchResult, SubQueryResult
+from utils import combine_input
+
+
+def _mock_claude(mock_api, requests, usage):
+    """Подменяет Messages API: сохраняет тела запросов и отвечает с заданным usage."""
+    def handler(request):
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, json={"content": [{"type": "text", "text": "ok"}], "usage": usage})
+
+    mock_api(handler)
+
+
+def test_static_instructions_are_cached_prefix(mock_api):
+    """Инструкции для результатов поиска идут в кэшируемом системном блоке, а не в сообщении."""
+    requests = []
+    _mock_claude(mock_api, requests, {"input_tokens": 10, "output_tokens": 2})
+    results = SearchResult("топ 5 компаний", [SubQueryResult("топ 5 компаний", "1. Apple", ["1. Apple"])])
+    prompt = combine_input("топ 5 компаний", results)
+    assert "СТРОГО ИСПОЛЬЗУЙ" not in prompt and "Тип запроса: рейтинг или список" in prompt
+
+    assert asyncio.run(llm_api.aquery_llm(prompt)) == "ok"
+    assert asyncio.run(llm_api.aquery_llm("Объясни квантовые вычисления")) == "ok"
+
+    search_system, plain_system = requests[0]["system"], requests[1]["system"]
+    assert [block["text"] for block in search_system] == [llm_api.DEFAULT_SYSTEM_PROMPT, llm_api.SEARCH_INSTRUCTIONS]
+    assert all(block["cache_control"] == {"type": "ephemeral"} for block in search_system)
+    # Запрос без результатов поиска разделяет с ним первый блок
+    assert plain_system == search_system[:1]
+    assert requests[0]["messages"][0]["content"] == prompt
+
+
+def test_cache_usage_is_recorded(mock_api):
+    """Токены записи и чтения кэша из usage суммируются в статистике."""
+    requests = []
+    _mock_claude(mock_api, requests, {"input_tokens": 20, "output_tokens": 5,
+                                         "cache_creation_input_tokens": 0, "cache_read_input_tokens": 60})
+    before = llm_api.get_llm_usage_stats()
+    asyncio.run(llm_api.aquery_llm("Сколько планет в Солнечной системе?"))
+    after = llm_api.get_llm_usage_stats()
+    assert after["requests"] == before["requests"] + 1
+    assert after["cache_read_input_tokens"] == before["cache_read_input_tokens"] + 60
+    assert after["input_tokens"] == before["input_tokens"] + 20
+    assert 0 < after["cache_read_ratio"] <= 1
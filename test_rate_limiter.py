@@ -0,0 +1,96 @@
+"""
+Тестирование ограничителя запросов к внешним сервисам.
+"""
+import time
+import asyncio
+from rate_limiter import UpstreamLimiter, queue_wait
+
+
+async def _call(limiter, status, duration=0.0):
+    async with limiter.limit() as permit:
+        await asyncio.sleep(duration)
+        permit.record(status)
+
+
+def test_token_bucket_spaces_requests():
+    """После всплеска запросы идут с частотой rate, ожидание учитывается в статистике."""
+    limiter = UpstreamLimiter("test", rate=20, burst=2)
+
+    async def run():
+        waits = []
+        queue_wait.set(waits)
+        start = time.monotonic()
+        await asyncio.gather(*(_call(limiter, 200) for _ in range(6)))
+        return time.monotonic() - start, waits
+
+    elapsed, waits = asyncio.run(run())
+    # 2 запроса сразу, еще 4 - по одному каждые 50 мс
+    assert 0.18 <= elapsed < 0.5
+    assert len(waits) == 6 and max(waits) >= 0.15
+    stats = limiter.stats()
+    assert stats["acquired"] == 6 and stats["queue_wait_max"] >= 0.15 and stats["queued"] == 0
+
+
+def test_concurrency_limit_is_respected():
+    """Одновременно выполняется не больше запросов, чем разрешает лимит."""
+    limiter = UpstreamLimiter("test", rate=0, max_concurrency=3)
+    peak = 0
+
+    async def call():
+        nonlocal peak
+        async with limiter.limit() as permit:
+            peak = max(peak, limiter.stats()["in_flight"])
+            await asyncio.sleep(0.01)
+            permit.record(200)
+
+    async def run():
+        await asyncio.gather(*(call() for _ in range(12)))
+
+    asyncio.run(run())
+    assert peak == 3
+
+
+def test_aimd_shrinks_on_throttling_and_recovers():
+    """429 и 5xx вдвое снижают лимит, успешные ответы постепенно возвращают его."""
+    # Задержки здесь - микросекунды, любая пауза планировщика выглядела бы всплеском
+    limiter = UpstreamLimiter("test", rate=0, max_concurrency=8, spike_factor=1000)
+    asyncio.run(_call(limiter, 429))
+    assert limiter.stats()["concurrency_limit"] == 4
+    assert limiter.stats()["throttled"] == 1
+
+    async def successes(count):
+        for _ in range(count):
+            await _call(limiter, 200)
+
+    asyncio.run(successes(4))
+    assert 4 < limiter.stats()["concurrency_limit"] < 6
+
+    limiter._decreased_at = 0.0
+    asyncio.run(_call(limiter, 503))
+    assert limiter.stats()["failures"] == 1 and limiter.stats()["concurrency_limit"] < 3
+    asyncio.run(successes(200))
+    assert limiter.stats()["concurrency_limit"] == 8
+
+
+def test_latency_spike_and_errors_shrink_limit():
+    """Ответ в разы медленнее обычного и ошибка сети тоже считаются перегрузкой."""
+    limiter = UpstreamLimiter("test", rate=0, max_concurrency=8)
+
+    async def run():
+        for _ in range(10):
+            await _call(limiter, 200, 0.005)
+        await _call(limiter, 200, 0.1)
+
+    asyncio.run(run())
+    assert limiter.stats()["latency_spikes"] == 1 and limiter.stats()["concurrency_limit"] < 8
+
+    async def failing():
+        async with limiter.limit():
+            raise ConnectionError("сбой сети")
+
+    limiter._decreased_at = 0.0
+    try:
+        asyncio.run(failing())
+    except ConnectionError:
+        pass
+    assert limiter.stats()["failures"] == 1 and limiter.stats()["in_flight"] == 0
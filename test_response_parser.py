@@ -0,0 +1,67 @@
+"""
+Тестирование разбора ответов Perplexity на разделы и источники.
+"""
+import time
+from response_parser import parse_search_content
+
+# Ответы, на которых прежний разбор регулярными выражениями с (?:.|\n)*? работал за квадратичное время
+ADVERSARIAL = {
+    "маркеры без переводов строк": lambda size: "1)2)" + " http://a" * (size // 9),
+    "много маркеров 1.": lambda size: "2) " + "1." * (size // 2),
+    "много строк в разделе": lambda size: "1) x\n2) " + "a\n" * (size // 2),
+    "источники без конца": lambda size: "источники " + "\nx" * (size // 2),
+    "повторяющиеся заголовки": lambda size: "1) a\n2) b\n3) c\n" + "Источники 3. " * (size // 13),
+}
+
+
+def test_numbered_sections_and_sources():
+    """Разделы 1-3 и раздел источников выделяются, ссылки берутся из раздела источников."""
+    content = ("1) Основная информация\nКурс биткоина $92,467.\n\n2) Детали\nРост за сутки 2%.\n\n"
+               "3) Контекст\nРынок растет.\n\nИСТОЧНИКИ:\n- https://coinmarketcap.com/\n- https://www.coingecko.com/en")
+    parsed = parse_search_content(content)
+    assert parsed["sections"] == ["Курс биткоина $92,467.", "Рост за сутки 2%.", "Рынок растет.",
+                                  "- https://coinmarketcap.com/\n- https://www.coingecko.com/en"]
+    assert parsed["sources"] == ["https://coinmarketcap.com/", "https://www.coingecko.com/en"]
+    assert parsed["has_sources"]
+
+
+def test_paragraphs_and_inline_sources():
+    """Без маркеров текст делится по абзацам, источники ищутся после слова "источники"."""
+    parsed = parse_search_content("Погода в Москве +7°C, облачно.\n\nИсточники: https://yandex.ru/pogoda (Яндекс), https://gismeteo.ru")
+    assert parsed["sections"] == ["Погода в Москве +7°C, облачно.", "Источники: https://yandex.ru/pogoda (Яндекс), https://gismeteo.ru"]
+    assert parsed["sources"] == ["https://yandex.ru/pogoda", "https://gismeteo.ru"]
+
+    parsed = parse_search_content("Просто текст без ссылок.")
+    assert parsed == {"sections": ["Просто текст без ссылок."], "sources": [], "has_sources": False}
+
+
+def test_markers_inside_urls_are_ignored():
+    """"1." и "2)" внутри ссылки не начинают новый раздел."""
+    parsed = parse_search_content("1) Цена\n$10\n2) Источник https://example.com/v1.2)/page\n")
+    assert parsed["sections"] == ["$10"]
+    assert parsed["sources"] == ["https://example.com/v1.2"]
+
+
+def test_adversarial_responses_are_linear():
+    """Ответы по 100 КБ разбираются быстро, а вдвое больший ответ - не более чем втрое дольше."""
+    for name, build in ADVERSARIAL.items():
+        timings = []
+        for size in (100_000, 200_000):
+            content = build(size)
+            # Лучший из трех замеров: паузы сборщика мусора и планировщика не должны ронять тест
+            best = float("inf")
+            for _ in range(3):
+                start = time.perf_counter()
+                parse_search_content(content)
+                best = min(best, time.perf_counter() - start)
+            timings.append(best)
+        assert timings[0] < 0.5, f"{name}: {timings[0]:.3f} с на 100 КБ"
+        assert timings[1] < max(timings[0] * 3, 0.05), f"{name}: {timings[0]:.3f} с -> {timings[1]:.3f} с"
+
+
+if __name__ == "__main__":
+    test_numbered_sections_and_sources()
+    test_paragraphs_and_inline_sources()
+    test_markers_inside_urls_are_ignored()
+    test_adversarial_responses_are_linear()
+    print("✅ Все проверки разбора ответов пройдены")
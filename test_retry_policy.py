@@ -0,0 +1,85 @@
+"""
+Тестирование политики повторов запросов к внешним сервисам.
+"""
+import time
+import asyncio
+import httpx
+import pytest
+import llm_api
+from http_client import ANTHROPIC
+from retry_policy import RetryPolicy, parse_retry_after
+
+
+def _mock_claude(mock_api, statuses, headers=None):
+    """Подменяет Messages API: отвечает статусами из списка по очереди, затем 200."""
+    calls = []
+
+    def handler(request):
+        calls.append(time.monotonic())
+        status = statuses[len(calls) - 1] if len(calls) <= len(statuses) else 200
+        if status != 200:
+            return httpx.Response(status, headers=headers or {}, json={"error": {"type": "overloaded_error"}})
+        return httpx.Response(200, json={"content": [{"type": "text", "text": "ok"}], "usage": {"input_tokens": 1, "output_tokens": 1}})
+
+    policy = RetryPolicy(ANTHROPIC, max_attempts=3, base_delay=0.01, max_delay=0.05, budget=5)
+    mock_api(handler, policies={ANTHROPIC: policy})
+    return calls, policy
+
+
+def test_transient_errors_are_retried(mock_api):
+    """529 и 503 повторяются, и пользователь получает ответ, а не текст ошибки."""
+    calls, policy = _mock_claude(mock_api, [529, 503])
+    assert asyncio.run(llm_api.aquery_llm("Объясни квантовые вычисления")) == "ok"
+    assert len(calls) == 3
+    assert policy.stats() == {"calls": 1, "retries": 2, "recovered": 1, "exhausted": 0,
+                              "reasons": {"HTTP 529": 1, "HTTP 503": 1}}
+
+
+def test_retry_after_is_honored_and_attempts_are_capped(mock_api):
+    """Пауза берется из Retry-After; после последней попытки возвращается ошибка."""
+    calls, policy = _mock_claude(mock_api, [429, 429, 429, 429], headers={"retry-after": "0.2"})
+    response = asyncio.run(llm_api.aquery_llm("Объясни теорему Ферма"))
+    assert "429" in response
+    assert len(calls) == 3 and calls[1] - calls[0] >= 0.19
+    assert policy.stats()["exhausted"] == 1
+
+
+def test_client_errors_and_budget_are_respected(mock_api):
+    """400 не повторяется, а Retry-After длиннее бюджета прекращает повторы сразу."""
+    calls, _ = _mock_claude(mock_api, [400])
+    asyncio.run(llm_api.aquery_llm("Объясни рекурсию"))
+    assert len(calls) == 1
+
+    calls, policy = _mock_claude(mock_api, [503], headers={"retry-after": "120"})
+    asyncio.run(llm_api.aquery_llm("Объясни сортировку"))
+    assert len(calls) == 1 and policy.stats()["exhausted"] == 1
+
+
+def test_idempotency_and_commit():
+    """Таймаут чтения не повторяется для неидемпотентного вызова и после начала передачи ответа."""
+    policy = RetryPolicy("test", base_delay=0.01, budget=5)
+
+    async def run(idempotent, commit):
+        attempts = 0
+        async for attempt in policy.attempts(idempotent=idempotent):
+            async with attempt:
+                attempts += 1
+                if commit:
+                    attempt.commit()
+                if attempts == 1:
+                    raise httpx.ReadTimeout("таймаут")
+        return attempts
+
+    assert asyncio.run(run(idempotent=True, commit=False)) == 2
+    with pytest.raises(httpx.ReadTimeout):
+        asyncio.run(run(idempotent=False, commit=False))
+    with pytest.raises(httpx.ReadTimeout):
+        asyncio.run(run(idempotent=True, commit=True))
+
+
+def test_parse_retry_after():
+    """Retry-After в секундах, миллисекундах и как HTTP-дата."""
+    assert parse_retry_after(httpx.Response(429, headers={"retry-after": "2"})) == 2.0
+    assert parse_retry_after(httpx.Response(429, headers={"retry-after-ms": "1500"})) == 1.5
+    assert parse_retry_after(httpx.Response(429, headers={"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0.0
+    assert parse_retry_after(httpx.Response(503)) is None
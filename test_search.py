@@ -31,7 +31,7 @@ def test_search():
     
     # Выполняем поиск
     try:
-        result = search_perplexity(query)
+        result = str(search_perplexity(query))
         
         # Выводим результат
         print("\n--- Результат поиска ---\n")
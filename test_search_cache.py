@@ -0,0 +1,185 @@
+"""
+Тестирование хранилищ кэша результатов поиска.
+"""
+import os
+import time
+import socket
+import tempfile
+import threading
+from search_cache import MemoryCacheBackend, SQLiteCacheBackend, RedisCacheBackend, NearDuplicateIndex, make_cache_key
+
+
+def start_fake_redis():
+    """
+    Запускает локальную замену Redis, понимающую GET, SET с PX, DEL и SCAN.
+
+    Returns:
+        int: Порт, на котором слушает сервер
+    """
+    store = {}
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+
+    def read_command(reader):
+        header = reader.readline()
+        if not header:
+            return None
+        args = []
+        for _ in range(int(header[1:])):
+            length = int(reader.readline()[1:])
+            args.append(reader.read(length + 2)[:-2])
+        return args
+
+    def handle(conn):
+        reader = conn.makefile('rb')
+        while True:
+            args = read_command(reader)
+            if args is None:
+                break
+            command = args[0].upper()
+            if command == b'SET':
+                expires_at = time.time() + int(args[4]) / 1000 if len(args) > 4 else None
+                store[args[1]] = (args[2], expires_at)
+                conn.sendall(b"+OK\r\n")
+            elif command == b'GET':
+                value, expires_at = store.get(args[1], (None, None))
+                if value is None or (expires_at and expires_at <= time.time()):
+                    conn.sendall(b"$-1\r\n")
+                else:
+                    conn.sendall(b"$%d\r\n%s\r\n" % (len(value), value))
+            elif command == b'DEL':
+                removed = sum(1 for key in args[1:] if store.pop(key, None) is not None)
+                conn.sendall(b":%d\r\n" % removed)
+            elif command == b'SCAN':
+                prefix = args[3].rstrip(b'*')
+                keys = [key for key in store if key.startswith(prefix)]
+                reply = b"*2\r\n$1\r\n0\r\n*%d\r\n" % len(keys)
+                reply += b"".join(b"$%d\r\n%s\r\n" % (len(key), key) for key in keys)
+                conn.sendall(reply)
+            else:
+                conn.sendall(b"-ERR unknown command\r\n")
+        conn.close()
+
+    def serve():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def check_backend(cache):
+    """Общие проверки для любого хранилища: запись, чтение, истечение срока и очистка."""
+    value = {"query": "курс биткоина", "result": "Bitcoin: $92,467", "found": True}
+    assert cache.get("crypto:курс биткоина") is None
+
+    cache.set("crypto:курс биткоина", value, ttl=60)
+    assert cache.get("crypto:курс биткоина") == value
+
+    cache.set("crypto:устаревший", value, ttl=0.05)
+    time.sleep(0.1)
+    assert cache.get("crypto:устаревший") is None
+
+    cache.clear()
+    assert cache.get("crypto:курс биткоина") is None
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 3
+
+
+def test_memory_backend_evicts_least_recently_used():
+    """Кэш в памяти вытесняет давно не использованные записи при превышении лимита."""
+    check_backend(MemoryCacheBackend(max_bytes=1024 * 1024))
+
+    cache = MemoryCacheBackend(max_bytes=210)
+    for i in range(3):
+        cache.set(f"general:{i}", {"result": "x" * 60}, ttl=60)
+    cache.get("general:0")
+    cache.set("general:3", {"result": "x" * 60}, ttl=60)
+
+    assert cache.get("general:0") is not None
+    assert cache.get("general:1") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_sqlite_backend_survives_restart():
+    """Записи SQLite-кэша видны новому экземпляру, как после перезапуска процесса."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "search_cache.db")
+        check_backend(SQLiteCacheBackend(path))
+
+        SQLiteCacheBackend(path).set("weather:погода в москве", {"result": "+7°C"}, ttl=60)
+        assert SQLiteCacheBackend(path).get("weather:погода в москве") == {"result": "+7°C"}
+
+
+def test_redis_backend_with_local_stand_in():
+    """Клиент протокола Redis работает с локальной заменой сервера."""
+    port = start_fake_redis()
+    check_backend(RedisCacheBackend(f"redis://127.0.0.1:{port}/0"))
+
+
+def test_redis_backend_unavailable_is_a_miss():
+    """Недоступный Redis не ломает поиск: чтение считается промахом, ошибки записи и очистки учитываются."""
+    cache = RedisCacheBackend("redis://127.0.0.1:1/0", timeout=0.2)
+    assert cache.get("general:что угодно") is None
+    cache.set("general:что угодно", {"result": "x"}, ttl=60)
+    cache.clear()
+    assert cache.stats()["errors"] == 3
+
+
+def test_paraphrased_query_gets_same_key():
+    """Регистр, ё/е, окончания и служебные слова не меняют ключ кэша."""
+    assert make_cache_key("weather", "погода в Москве сегодня") == make_cache_key("weather", "какая сегодня погода в москве")
+    assert make_cache_key("general", "Ёлки новогодние цены") == make_cache_key("general", "елка новогодняя цена")
+    assert make_cache_key("weather", "погода в Москве") != make_cache_key("weather", "погода в Казани")
+
+
+def test_direction_changes_key():
+    """Порядок слов и предлоги направления остаются в ключе: обратный запрос - другой ключ."""
+    assert make_cache_key("general", "курс доллара к евро") != make_cache_key("general", "курс евро к доллару")
+    assert make_cache_key("general", "рейс из Москвы в Казань") != make_cache_key("general", "рейс из Казани в Москву")
+    assert make_cache_key("general", "курс доллара ко евро") == make_cache_key("general", "какой курс доллара к евро")
+
+
+def test_near_duplicate_index():
+    """Индекс находит перефразировку той же темы и не путает запросы о разном."""
+    index = NearDuplicateIndex()
+    index.add("crypto", "crypto:биткоин курс", "курс биткоина")
+    index.add("general", "general:spacex новост последн", "последние новости spacex")
+
+    assert index.find("crypto", "курс биткойна") == "crypto:биткоин курс"
+    assert index.find("general", "последние новости spasex") == "general:spacex новост последн"
+    assert index.find("general", "курс биткойна") is None
+    assert index.find("crypto", "курс биткоина к евро") is None
+    assert index.find("general", "последние новости spacex 2024") is None
+
+    # Перестановка слов - перефразировка, если направление не меняется
+    index.add("general", "general:елк новогодн цен", "Ёлки новогодние цены")
+    assert index.find("general", "цена новогодней елки") == "general:елк новогодн цен"
+
+
+def test_near_duplicate_index_respects_direction():
+    """Индекс не выдает запрос с обратным направлением за перефразировку."""
+    index = NearDuplicateIndex()
+    index.add("financial", "financial:курс доллар к евр", "курс доллара к евро")
+    index.add("general", "general:рейс из москв в казан", "рейс из Москвы в Казань")
+
+    assert index.find("financial", "курс евро к доллару") is None
+    assert index.find("general", "рейс из Казани в Москву") is None
+    assert index.find("financial", "к евро курс доллара") == "financial:курс доллар к евр"
+    assert index.find("general", "рейс в Казань из Москвы") == "general:рейс из москв в казан"
+
+
+if __name__ == "__main__":
+    test_memory_backend_evicts_least_recently_used()
+    test_sqlite_backend_survives_restart()
+    test_redis_backend_with_local_stand_in()
+    test_redis_backend_unavailable_is_a_miss()
+    test_paraphrased_query_gets_same_key()
+    test_direction_changes_key()
+    test_near_duplicate_index()
+    test_near_duplicate_index_respects_direction()
+    print("✅ Все проверки кэша пройдены")
@@ -0,0 +1,78 @@
+"""
+Тестирование локального классификатора необходимости поиска.
+"""
+from search_classifier import classify_search_need, is_confident
+from evaluate_search_classifier import load_dataset, evaluate, DEFAULT_DATASET, HOLDOUT_DATASET
+
+
+def test_clear_cases_are_decided_locally():
+    """Очевидные запросы решаются без обращения к LLM."""
+    live = classify_search_need("Какая погода в Москве сегодня")
+    assert live.needs_search and is_confident(live)
+
+    ranking = classify_search_need("Топ 5 крупнейших компаний мира по капитализации на 2024 год", current_year=2024)
+    assert ranking.needs_search and "ranking_entity" in ranking.signals
+
+    knowledge = classify_search_need("Что такое фотосинтез")
+    assert not knowledge.needs_search and is_confident(knowledge)
+
+
+def test_whole_word_keywords():
+    """Ключевые слова с "$" не срабатывают на другие слова с тем же началом."""
+    assert "ranking" not in classify_search_need("цены на топливо").signals
+    assert "live" not in classify_search_need("где находится центр города").signals
+
+
+def test_fresh_entity_outweighs_knowledge_words():
+    """Сущность со словом свежести требует поиска, даже если в запросе есть слово из знаний."""
+    decision = classify_search_need("какие функции у нового iphone 16")
+    assert decision.needs_search and is_confident(decision)
+    assert "fresh_entity" in decision.signals
+
+    assert not classify_search_need("какие функции выполняет печень").needs_search
+    assert not classify_search_need("история создания компании Apple").needs_search
+
+
+def test_new_product_is_not_confident_knowledge():
+    """"Нового/новых" перед названием товара - свежая сущность и без списка брендов."""
+    for query in ("что умеет новый pixel", "характеристики новейшего galaxy"):
+        decision = classify_search_need(query)
+        assert decision.needs_search and is_confident(decision) and "new_item" in decision.signals
+
+    # Слово из знаний спорит со свежестью неизвестной сущности: решает LLM, а не локальный "без поиска"
+    decision = classify_search_need("расскажи о функциях нового macbook")
+    assert not is_confident(decision)
+    assert "fresh_entity" in decision.signals
+
+    assert "new_item" not in classify_search_need("традиции встречи нового года").signals
+
+
+def test_year_signals():
+    """Недавний год говорит о свежих данных, далекое прошлое - об исторических."""
+    assert "current_year" in classify_search_need("итоги 2025 года", current_year=2025).signals
+    assert "past_year" in classify_search_need("что произошло в 1945 году", current_year=2025).signals
+
+
+def test_labeled_set_accuracy():
+    """Локальные решения на размеченном наборе точны, а большинство запросов не требует LLM."""
+    report = evaluate(load_dataset(DEFAULT_DATASET), repeats=1)
+    assert report["local_accuracy"] >= 0.95
+    assert report["local_coverage"] >= 0.8
+
+
+def test_holdout_set_accuracy():
+    """На отложенном наборе, не использованном при подборе весов, локальные решения тоже точны."""
+    report = evaluate(load_dataset(HOLDOUT_DATASET), repeats=1)
+    assert report["local_accuracy"] >= 0.95
+    assert report["local_coverage"] >= 0.8
+
+
+if __name__ == "__main__":
+    test_clear_cases_are_decided_locally()
+    test_whole_word_keywords()
+    test_fresh_entity_outweighs_knowledge_words()
+    test_new_product_is_not_confident_knowledge()
+    test_year_signals()
+    test_labeled_set_accuracy()
+    test_holdout_set_accuracy()
+    print("✅ Все проверки классификатора пройдены")
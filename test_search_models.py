@@ -0,0 +1,149 @@
+"""
+Тестирование типизированных результатов поиска.
+"""
+import json
+import asyncio
+import httpx
+import search_api
+from http_client import PERPLEXITY
+from retry_policy import RetryPolicy
+from search_models import SearchResult, SubQueryResult
+from search_api import search_perplexity
+from utils import combine_input
+
+
+def test_render_single_and_combined():
+    """Один подзапрос выводится как есть, несколько - с заголовками "ЗАПРОС:"."""
+    weather = SubQueryResult("Погода в Москве", "+7°C, облачно.", ["+7°C, облачно."], ["https://yandex.ru/pogoda"])
+    rate = SubQueryResult("курс биткоина", "$92,467", ["$92,467"], ["https://coinmarketcap.com/", "https://yandex.ru/pogoda"])
+
+    assert str(SearchResult("Погода в Москве", [weather])) == "+7°C, облачно.\n\nИСТОЧНИКИ:\nhttps://yandex.ru/pogoda"
+    combined = SearchResult("Погода в Москве, курс биткоина", [weather, rate]).render()
+    assert combined.startswith("\n\n=== РЕЗУЛЬТАТЫ ПОИСКА ===\n\nЗАПРОС: Погода в Москве\n\n+7°C")
+    assert "---\n\nЗАПРОС: курс биткоина\n\n$92,467\n\nИСТОЧНИКИ:\nhttps://coinmarketcap.com/" in combined
+    assert SearchResult("", [weather, rate]).sources == ["https://yandex.ru/pogoda", "https://coinmarketcap.com/"]
+
+
+def test_found_and_cache_round_trip():
+    """Результат без найденной информации ложен; словарь кэша восстанавливается без потерь."""
+    missing = SubQueryResult("запрос", "Информация по запросу не найдена.", found=False)
+    assert not SearchResult("запрос", [missing])
+    assert not SearchResult("запрос")
+
+    result = SubQueryResult("курс", "$10", ["$10"], ["https://example.com"], elapsed=1.5)
+    assert SubQueryResult.from_dict(result.to_dict()) == result
+    assert SubQueryResult.from_dict(result.to_dict(), cache="exact").cache == "exact"
+
+    # Запись кэша в прежнем формате с готовым текстом
+    legacy = SubQueryResult.from_dict({"query": "курс", "result": "$10", "sources": ["https://example.com"], "found": True})
+    assert legacy.render() == "$10" and legacy.found
+
+
+def test_test_mode_flows_into_prompt():
+    """Результат тестового режима передается в combine_input без повторного разбора."""
+    results = search_perplexity("курс биткоина", test_mode=True)
+    assert isinstance(results, SearchResult) and results.found
+    prompt = combine_input("курс биткоина", results)
+    assert results.render() in prompt
+    assert "поисковой модели test" in prompt
+
+
+def test_partial_results_are_marked():
+    """Подзапросы без результатов не попадают в текст, но перечисляются в промпте."""
+    weather = SubQueryResult("погода в Москве", "+7°C, облачно.", ["+7°C, облачно."])
+    missing = SubQueryResult("курс биткоина", "Информация по запросу не найдена.", found=False)
+    results = SearchResult("погода в Москве и курс биткоина", [weather, missing])
+
+    assert results and not results.complete and results.missing == ["курс биткоина"]
+    assert "не найдена" not in results.render()
+    prompt = combine_input("погода в Москве и курс биткоина", results)
+    assert "+7°C" in prompt and "Поиск не дал результатов по части запроса: курс биткоина" in prompt
+
+
+def test_failed_subquery_falls_back_alone(mock_api):
+    """Ошибка одного подзапроса стоит одного резервного запроса, остальные результаты сохраняются."""
+    calls = []
+
+    def handler(request):
+        content = json.loads(request.content)["messages"][-1]["content"]
+        calls.append(content)
+        if "биткоин" in content and len(calls) < 3:
+            return httpx.Response(400, json={"error": "bad request"})
+        return httpx.Response(200, json={"model": "sonar", "choices": [{"message": {"content": f"Ответ: {content}"}}]})
+
+    mock_api(handler, policies={PERPLEXITY: RetryPolicy(PERPLEXITY, max_attempts=1, budget=5)})
+
+    results = asyncio.run(search_api.asearch_perplexity("погода в Москве и курс биткоина"))
+    assert [result.query for result in results.subqueries] == ["погода в Москве", "курс биткоина"]
+    assert len(calls) == 3 and calls[-1] == "курс биткоина"
+    assert not results.subqueries[0].fallback and results.subqueries[1].fallback
+    assert results.complete
+
+
+
+def test_unexpected_subquery_error_keeps_other_results(mock_api):
+    """Непредвиденное исключение в одном подзапросе не отбрасывает результаты остальных."""
+    def handler(request):
+        content = json.loads(request.content)["messages"][-1]["content"]
+        if "биткоин" in content:
+            raise KeyError("choices")
+        return httpx.Response(200, json={"model": "sonar", "choices": [{"message": {"content": f"Ответ: {content}"}}]})
+
+    mock_api(handler, policies={PERPLEXITY: RetryPolicy(PERPLEXITY, max_attempts=1, budget=5)})
+    results = asyncio.run(search_api.asearch_perplexity("погода в Москве и курс биткоина"))
+    assert [result.query for result in results.subqueries] == ["погода в Москве", "курс биткоина"]
+    assert "Ответ: погода в Москве" in results.subqueries[0].content
+    assert results.missing == ["курс биткоина"] and results.failed == ["курс биткоина"]
+
+
+def test_concurrency_is_limited_and_order_kept(mock_api):
+    """Одновременно выполняется не больше max_concurrency подзапросов; порядок результатов - порядок подзапросов."""
+    delays = {"погода": 0.2, "биткоин": 0.05, "доллар": 0.15, "спорт": 0.01}
+    in_flight, peak, finished = [0], [0], []
+
+    async def handler(request):
+        content = json.loads(request.content)["messages"][-1]["content"]
+        key = next(word for word in delays if word in content)
+        in_flight[0] += 1
+        peak[0] = max(peak[0], in_flight[0])
+        await asyncio.sleep(delays[key])
+        in_flight[0] -= 1
+        finished.append(key)
+        return httpx.Response(200, json={"model": "sonar", "choices": [{"message": {"content": f"Ответ: {key}"}}]})
+
+    mock_api(handler)
+    query = "погода в Москве и курс биткоина и курс доллара и новости спорта"
+    results = asyncio.run(search_api.asearch_perplexity(query, max_concurrency=2))
+
+    assert peak[0] == 2
+    assert finished != ["погода", "биткоин", "доллар", "спорт"]
+    assert [result.query for result in results.subqueries] == ["погода в Москве", "курс биткоина", "курс доллара", "новости спорта"]
+    assert [result.content for result in results.subqueries] == [f"Ответ: {key}" for key in delays]
+
+
+def test_inherited_cancellation_is_a_failed_subquery(mock_api, monkeypatch):
+    """Отмена, пришедшая подзапросу из общего вызова, не роняет поиск: подзапрос идет в резервный поиск."""
+    def handler(request):
+        content = json.loads(request.content)["messages"][-1]["content"]
+        return httpx.Response(200, json={"model": "sonar", "choices": [{"message": {"content": f"Ответ: {content}"}}]})
+
+    class CancellingFlight:
+        async def run(self, key, call):
+            if "биткоин" in key:
+                raise asyncio.CancelledError()
+            return await call()
+
+    mock_api(handler)
+    monkeypatch.setattr(search_api, "perplexity_flight", CancellingFlight())
+    results = asyncio.run(search_api.asearch_perplexity("погода в Москве и курс биткоина"))
+    assert [result.query for result in results.subqueries] == ["погода в Москве", "курс биткоина"]
+    assert not results.subqueries[0].fallback and results.subqueries[1].fallback
+    assert results.complete
+
+
+if __name__ == "__main__":
+    test_render_single_and_combined()
+    test_found_and_cache_round_trip()
+    test_test_mode_flows_into_prompt()
+    test_partial_results_are_marked()
+    print("✅ Все проверки результатов поиска пройдены")
@@ -0,0 +1,26 @@
+"""
+Тестирование настроек production-сервера.
+"""
+import serve
+
+
+def test_options_from_environment(monkeypatch):
+    """Настройки берутся из окружения, аргументы командной строки важнее."""
+    monkeypatch.setenv("PORT", "8080")
+    monkeypatch.setenv("WEB_THREADS", "32")
+    monkeypatch.setenv("WEB_MAX_REQUESTS", "500")
+    options = serve.build_options(workers=3)
+
+    assert options["bind"] == "0.0.0.0:8080"
+    assert options["worker_class"] == "gthread" and options["preload_app"]
+    assert options["workers"] == 3 and options["threads"] == 32
+    assert options["max_requests"] == 500 and options["keepalive"] == 75
+
+
+def test_options_are_valid_gunicorn_settings():
+    """Все ключи - настройки gunicorn, хуки подключаются к конфигурации."""
+    application = serve.WebApplication(serve.build_options(bind="127.0.0.1:0"))
+
+    assert set(application.options) <= set(application.cfg.settings)
+    assert application.cfg.worker_class_str == "gthread"
+    assert application.cfg.pre_fork is serve.pre_fork
@@ -0,0 +1,152 @@
+"""
+Тестирование объединения одновременных одинаковых запросов.
+"""
+import json
+import asyncio
+import threading
+import httpx
+import pytest
+import singleflight
+import search_api
+from singleflight import SingleFlight
+
+
+@pytest.fixture(autouse=True)
+def fresh_groups(monkeypatch):
+    """Группы тестов не попадают в счетчики /api/metrics."""
+    monkeypatch.setattr(singleflight, "_groups", {})
+
+
+def test_concurrent_identical_calls_share_one_upstream_call():
+    """Одновременные вызовы с одним ключом выполняются один раз и получают один результат."""
+    flight = SingleFlight("test")
+    calls = []
+
+    async def call():
+        calls.append(True)
+        await asyncio.sleep(0.05)
+        return {"content": "ответ"}
+
+    async def run():
+        return await asyncio.gather(*(flight.run("курс биткоина", call) for _ in range(5)),
+                                    flight.run("погода", call))
+
+    results = asyncio.run(run())
+    assert len(calls) == 2
+    assert all(result is results[0] for result in results[:5])
+    assert flight.stats() == {"upstream_calls": 2, "saved_calls": 4, "in_flight": 0}
+
+
+def test_exception_reaches_every_waiter():
+    """Исключение вызова получают все ожидающие, а следующий вызов выполняется заново."""
+    flight = SingleFlight("test")
+    calls = []
+
+    async def failing():
+        calls.append(True)
+        await asyncio.sleep(0.05)
+        raise httpx.ConnectError("нет соединения")
+
+    async def run():
+        return await asyncio.gather(*(flight.run("ключ", failing) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(isinstance(result, httpx.ConnectError) for result in results)
+
+    asyncio.run(run())
+    assert len(calls) == 2 and flight.stats()["in_flight"] == 0
+
+
+def test_waiter_from_another_thread_joins():
+    """К вызову присоединяется корутина из event loop другого потока."""
+    flight = SingleFlight("test")
+    started = threading.Event()
+    release = threading.Event()
+    results = []
+
+    async def call():
+        started.set()
+        await asyncio.get_running_loop().run_in_executor(None, release.wait)
+        return "ответ"
+
+    leader = threading.Thread(target=lambda: results.append(asyncio.run(flight.run("ключ", call))))
+    leader.start()
+    started.wait(5)
+
+    async def join():
+        waiter = asyncio.ensure_future(flight.run("ключ", call))
+        await asyncio.sleep(0.01)
+        release.set()
+        return await waiter
+
+    results.append(asyncio.run(join()))
+    leader.join(5)
+    assert results == ["ответ", "ответ"]
+    assert flight.stats()["saved_calls"] == 1
+
+
+def test_identical_searches_make_one_request(mock_api, monkeypatch):
+    """Одновременные одинаковые поиски отправляют в Perplexity один запрос."""
+    requests = []
+
+    async def handler(request):
+        requests.append(json.loads(request.content)["messages"][-1]["content"])
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={"model": "sonar", "choices": [{"message": {"content": "Курс биткоина $92,467"}}]})
+
+    mock_api(handler)
+    flight = SingleFlight("perplexity")
+    monkeypatch.setattr(search_api, "perplexity_flight", flight)
+
+    async def run():
+        return await asyncio.gather(*(search_api.asearch_perplexity("курс биткоина") for _ in range(3)))
+
+    results = asyncio.run(run())
+
+    assert len(requests) == 1
+    assert all("$92,467" in str(result) for result in results)
+    assert flight.stats()["saved_calls"] == 2
+
+
+def test_cancelled_leader_does_not_cancel_waiters():
+    """Отмена выполняющего вызов не доходит до ожидающих: один из них повторяет вызов."""
+    flight = SingleFlight("test")
+    calls = []
+
+    async def call():
+        calls.append(True)
+        await asyncio.sleep(0.05)
+        return "ответ"
+
+    async def run():
+        leader = asyncio.ensure_future(flight.run("ключ", call))
+        await asyncio.sleep(0.01)
+        waiters = [asyncio.ensure_future(flight.run("ключ", call)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await asyncio.gather(*waiters), leader.cancelled()
+
+    results, leader_cancelled = asyncio.run(run())
+    assert leader_cancelled and results == ["ответ", "ответ"]
+    assert len(calls) == 2
+    assert flight.stats() == {"upstream_calls": 2, "saved_calls": 1, "in_flight": 0}
+
+
+def test_cancelled_waiter_leaves_others_alone():
+    """Отмена одного ожидающего не отменяет общий вызов для остальных."""
+    flight = SingleFlight("test")
+
+    async def call():
+        await asyncio.sleep(0.05)
+        return "ответ"
+
+    async def run():
+        tasks = [asyncio.ensure_future(flight.run("ключ", call)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        tasks[1].cancel()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert results[0] == results[2] == "ответ"
+    assert isinstance(results[1], asyncio.CancelledError)
@@ -0,0 +1,290 @@
+"""
+Тестирование потоковых ответов: Claude и Perplexity по Server-Sent Events и маршруты /api/*/stream.
+"""
+import json
+import time
+import asyncio
+import httpx
+import pytest
+import llm_api
+import singleflight
+import search_api
+from singleflight import SingleFlight
+from http_client import PERPLEXITY
+from retry_policy import RetryPolicy
+
+
+def sse(*events):
+    """Тело ответа Server-Sent Events из словарей событий."""
+    return "".join(f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n" for event in events).encode()
+
+
+def claude_stream(*texts, usage=None):
+    """Поток Messages API: message_start, фрагменты текста, message_delta с выходными токенами и message_stop."""
+    usage = usage or {"input_tokens": 12, "output_tokens": 1, "cache_read_input_tokens": 30}
+    return sse(
+        {"type": "message_start", "message": {"usage": usage}},
+        {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+        {"type": "ping"},
+        *({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text}} for text in texts),
+        {"type": "content_block_stop", "index": 0},
+        {"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": 7}},
+        {"type": "message_stop"},
+    )
+
+
+def perplexity_stream(*texts):
+    """Поток Perplexity в формате OpenAI: фрагменты в choices[0].delta.content и [DONE]."""
+    chunks = [{"id": "px-1", "model": "sonar", "choices": [{"delta": {"content": text}}]} for text in texts]
+    return "".join(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n" for chunk in chunks).encode() + b"data: [DONE]\n\n"
+
+
+def cut_perplexity_stream(*texts):
+    """Поток Perplexity, оборванный до [DONE]."""
+    return perplexity_stream(*texts)[:-len(b"data: [DONE]\n\n")]
+
+
+def read_events(response):
+    """Разбирает ответ маршрута Flask на список (событие, данные)."""
+    events = []
+    for block in response.get_data(as_text=True).split("\n\n"):
+        if block.strip():
+            name, data = block.split("\n", 1)
+            events.append((name[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+def test_stream_yields_text_deltas_and_records_usage(mock_api):
+    """Текст берется из content_block_delta по порядку, usage складывается из message_start и message_delta."""
+    requests = []
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=claude_stream("Рекурсия - ", "это вызов ", "себя."))
+
+    mock_api(handler)
+    before = llm_api.get_llm_usage_stats()
+
+    async def collect():
+        return [chunk async for chunk in llm_api.astream_llm("Объясни рекурсию")]
+
+    assert asyncio.run(collect()) == ["Рекурсия - ", "это вызов ", "себя."]
+    assert requests[0]["stream"] is True
+    after = llm_api.get_llm_usage_stats()
+    assert after["requests"] == before["requests"] + 1
+    assert after["input_tokens"] == before["input_tokens"] + 12
+    assert after["output_tokens"] == before["output_tokens"] + 7
+    assert after["cache_read_input_tokens"] == before["cache_read_input_tokens"] + 30
+
+
+def test_stream_error_event_and_status(mock_api):
+    """Событие error в потоке и ошибочный статус превращаются в текст ошибки."""
+    def handler(request):
+        if json.loads(request.content)["messages"][0]["content"] == "сбой":
+            return httpx.Response(400, json={"error": {"type": "invalid_request_error"}})
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=sse(
+            {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "Начало"}},
+            {"type": "error", "error": {"type": "overloaded_error"}},
+        ))
+
+    mock_api(handler)
+    assert list(llm_api.stream_llm("Объясни рекурсию")) == ["Начало", "\nОшибка при получении ответа от API Claude."]
+    chunks = list(llm_api.stream_llm("сбой"))
+    assert len(chunks) == 1 and llm_api.is_error_response(chunks[0])
+
+
+def test_stream_rejects_search_detection():
+    """Потоковый вызов не может вернуть решение о поиске и отклоняет detect_search_needs."""
+    with pytest.raises(ValueError):
+        llm_api.query_llm("Объясни рекурсию", detect_search_needs=True, stream=True)
+
+
+def test_query_stream_route_saves_chat_after_stream(mock_api, monkeypatch):
+    """/api/query/stream отдает meta, фрагменты и done, а чат сохраняется с полным текстом после потока."""
+    import web_app
+    saved = []
+    monkeypatch.setattr(web_app, "save_chat", lambda *args: saved.append(args) or "chat-id")
+    mock_api(lambda request: httpx.Response(200, headers={"content-type": "text/event-stream"},
+                                            content=claude_stream("Рекурсия - ", "это вызов себя.")))
+
+    response = web_app.app.test_client().post('/api/query/stream', json={"query": "Объясни рекурсию", "test_mode": False})
+    events = read_events(response)
+    assert [name for name, _ in events] == ["meta", "token", "token", "done"]
+    assert events[0][1]["search_performed"] is False
+    assert [data["text"] for name, data in events if name == "token"] == ["Рекурсия - ", "это вызов себя."]
+    assert events[-1][1]["id"] == "chat-id"
+
+    assert len(saved) == 1
+    user_input, formatted_response, search_performed, test_mode, session_id = saved[0]
+    assert user_input == "Объясни рекурсию" and formatted_response == events[-1][1]["response"]
+    assert "Рекурсия - это вызов себя." in formatted_response
+    assert session_id and not search_performed and not test_mode
+
+
+def test_search_stream_yields_tokens_then_result(mock_api):
+    """Токены Perplexity приходят по порядку, затем результат подзапроса с собранным текстом и done."""
+    requests = []
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, headers={"content-type": "text/event-stream"},
+                              content=perplexity_stream("Курс биткоина ", "$92,467"))
+
+    mock_api(handler)
+
+    async def collect():
+        return [event async for event in search_api.astream_search("курс биткоина", stream_tokens=True)]
+
+    events = asyncio.run(collect())
+    assert [event["type"] for event in events] == ["plan", "token", "token", "result", "done"]
+    assert [event["text"] for event in events if event["type"] == "token"] == ["Курс биткоина ", "$92,467"]
+    result = events[3]
+    assert result["found"] and result["query"] == "курс биткоина" and "$92,467" in result["result"]
+    assert requests[0]["stream"] is True
+
+
+def test_identical_token_streams_share_one_request(mock_api, monkeypatch):
+    """Одновременные одинаковые потоковые поиски отправляют один запрос; токены получает первый поток."""
+    requests = []
+
+    async def handler(request):
+        requests.append(True)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, headers={"content-type": "text/event-stream"},
+                              content=perplexity_stream("Курс биткоина ", "$92,467"))
+
+    mock_api(handler)
+    monkeypatch.setattr(singleflight, "_groups", {})
+    flight = SingleFlight("perplexity")
+    monkeypatch.setattr(search_api, "perplexity_flight", flight)
+
+    async def collect():
+        return [event async for event in search_api.astream_search("курс биткоина", stream_tokens=True)]
+
+    async def run():
+        return await asyncio.gather(collect(), collect())
+
+    streams = asyncio.run(run())
+    assert len(requests) == 1 and flight.stats()["saved_calls"] == 1
+    assert sorted(sum(event["type"] == "token" for event in events) for events in streams) == [0, 2]
+    for events in streams:
+        result = next(event for event in events if event["type"] == "result")
+        assert result["found"] and "$92,467" in result["result"]
+
+
+def test_search_stream_route_cuts_slow_subquery_at_deadline(mock_api):
+    """/api/search/stream укладывается в срок: медленный подзапрос отменяется и приходит как результат с ошибкой."""
+    async def handler(request):
+        content = json.loads(request.content)["messages"][-1]["content"]
+        if "биткоин" in content:
+            await asyncio.sleep(3)
+        return httpx.Response(200, headers={"content-type": "text/event-stream"},
+                              content=perplexity_stream(f"Ответ: {content}"))
+
+    mock_api(handler)
+    import web_app
+
+    start = time.monotonic()
+    response = web_app.app.test_client().post('/api/search/stream', json={
+        "query": "погода в Москве и курс биткоина", "test_mode": False, "stream_tokens": True, "deadline": 1})
+    events = read_events(response)
+    assert time.monotonic() - start < 2.5
+
+    assert events[0][0] == "plan" and len(events[0][1]["subqueries"]) == 2
+    assert events[-1][0] == "done"
+    results = {data["index"]: data for name, data in events if name == "result"}
+    assert len(results) == 2
+    weather, bitcoin = (results[index] for index in sorted(results))
+    assert weather["found"] and "погода" in weather["result"].lower()
+    assert not bitcoin["found"] and search_api.TIMEOUT_MESSAGE in bitcoin["result"]
+
+    assert web_app.app.test_client().post('/api/search/stream', json={"query": "курс биткоина", "deadline": -1}).status_code == 400
+
+
+def test_cancelled_stream_does_not_stall_coalesced_stream(mock_api, monkeypatch):
+    """Отмена одного из двух объединенных потоков не оставляет второй без результата."""
+    requests = []
+
+    async def handler(request):
+        requests.append(True)
+        await asyncio.sleep(0.1)
+        return httpx.Response(200, headers={"content-type": "text/event-stream"},
+                              content=perplexity_stream("Курс биткоина ", "$92,467"))
+
+    mock_api(handler)
+    monkeypatch.setattr(singleflight, "_groups", {})
+    monkeypatch.setattr(search_api, "perplexity_flight", SingleFlight("perplexity"))
+
+    async def collect():
+        return [event async for event in search_api.astream_search("курс биткоина", stream_tokens=True)]
+
+    async def run():
+        first = asyncio.ensure_future(collect())
+        await asyncio.sleep(0.02)
+        second = asyncio.ensure_future(collect())
+        await asyncio.sleep(0.02)
+        first.cancel()
+        return await asyncio.wait_for(second, 2)
+
+    events = asyncio.run(run())
+    result = next(event for event in events if event["type"] == "result")
+    assert result["found"] and "$92,467" in result["result"]
+    assert events[-1]["type"] == "done" and len(requests) == 2
+
+
+def test_stream_reports_subquery_ended_by_cancellation(mock_api, monkeypatch):
+    """Подзапрос, прерванный чужой отменой, все равно отдает результат с ошибкой, и поток завершается."""
+    class CancellingFlight:
+        async def run(self, key, call):
+            raise asyncio.CancelledError()
+
+    mock_api(lambda request: httpx.Response(500))
+    monkeypatch.setattr(search_api, "perplexity_flight", CancellingFlight())
+
+    async def collect():
+        return [event async for event in search_api.astream_search("курс биткоина", stream_tokens=True)]
+
+    events = asyncio.run(asyncio.wait_for(collect(), 2))
+    assert [event["type"] for event in events] == ["plan", "result", "done"]
+    assert not events[1]["found"] and events[1]["query"] == "курс биткоина"
+
+
+def test_stream_cut_after_tokens_is_an_error_result(mock_api):
+    """Поток, оборванный после первых токенов, не повторяется и дает результат с ошибкой, а не неполный ответ в кэше."""
+    requests = []
+
+    def handler(request):
+        requests.append(True)
+        return httpx.Response(200, headers={"content-type": "text/event-stream"},
+                              content=cut_perplexity_stream("Курс биткоина "))
+
+    mock_api(handler, policies={PERPLEXITY: RetryPolicy(PERPLEXITY, base_delay=0.01)})
+
+    async def collect():
+        return [event async for event in search_api.astream_search("курс биткоина", stream_tokens=True)]
+
+    events = asyncio.run(collect())
+    assert [event["type"] for event in events] == ["plan", "token", "result", "done"]
+    assert not events[2]["found"] and len(requests) == 1
+
+    asyncio.run(collect())
+    assert len(requests) == 2
+
+
+def test_stream_cut_before_tokens_is_retried(mock_api):
+    """Поток, оборванный до первого токена, повторяется, и клиент получает полный ответ."""
+    requests = []
+
+    def handler(request):
+        requests.append(True)
+        content = cut_perplexity_stream() if len(requests) == 1 else perplexity_stream("Курс биткоина ", "$92,467")
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=content)
+
+    mock_api(handler, policies={PERPLEXITY: RetryPolicy(PERPLEXITY, base_delay=0.01)})
+
+    async def collect():
+        return [event async for event in search_api.astream_search("курс биткоина", stream_tokens=True)]
+
+    events = asyncio.run(collect())
+    assert [event["type"] for event in events] == ["plan", "token", "token", "result", "done"]
+    assert events[3]["found"] and "$92,467" in events[3]["result"] and len(requests) == 2
@@ -4,6 +4,11 @@ Utility functions for the AI agent.
 import logging
 import os
 from dotenv import load_dotenv
+from search_classifier import classify_search_need, is_confident
+from keyword_engine import KeywordEngine
+from search_models import SearchResult, SubQueryResult
+from prompt_budget import PROMPT_TOKEN_BUDGET, estimate_tokens, pack_search_results
+from llm_api import SEARCH_RESULTS_HEADING, QUERY_TYPES
 
 # Set up logging
 logging.basicConfig(
@@ -16,6 +21,14 @@ logger = logging.getLogger(__name__)
 # Load environment variables from .env file if it exists
 load_dotenv()
 
+# Признаки запроса, от которых зависят инструкции для LLM в combine_input
+QUERY_MARKERS = KeywordEngine({
+    # Годы с 2025 по 2099 и слова о будущем
+    "future": [f"20{year}" for year in range(25, 100)] + ["будущ", "следующ", "прогноз"],
+    "ranking": ["топ", "рейтинг", "список", "самый", "лучший"],
+    "factual": ["сколько", "где", "когда", "кто", "факт", "статистика"],
+})
+
 def process_input(user_input):
     """
     Clean and prepare the user input.
@@ -37,6 +50,7 @@ def process_input(user_input):
 def needs_search(processed_input):
     """
     Determine if search is needed based on keywords in the input.
+    Low-confidence queries default to searching.
     
     Args:
         processed_input (str): Processed user input
@@ -45,124 +59,34 @@ def needs_search(processed_input):
         bool: True if search is needed, False otherwise
     """
     try:
-        # Всегда возвращаем True для включения поиска по умолчанию
-        # Это обеспечит, что Perplexity будет использоваться для всех запросов
-        logger.info(f"Активирую поиск для запроса: {processed_input}")
+        # Локальный классификатор по ключевым словам: сильные индикаторы, комбинации
+        # рейтинг + сущность и год + сущность, слова свежести и вопросы к знаниям модели
+        decision = classify_search_need(processed_input)
+        if is_confident(decision):
+            logger.info(f"Поиск {'нужен' if decision.needs_search else 'не нужен'} (уверенность {decision.confidence}, признаки: {', '.join(decision.signals) or 'нет'}): {processed_input}")
+            return decision.needs_search
+        
+        # В случае сомнений лучше выполнить поиск
+        logger.info(f"Низкая уверенность классификатора ({decision.confidence}), активирую поиск для запроса: {processed_input}")
         return True
-        
-        # Оставляем старый код закомментированным для возможного будущего использования
-        '''
-        # Convert to lowercase for case-insensitive matching
-        lower_input = processed_input.lower()
-        
-        # Keywords that might indicate a need for up-to-date information
-        search_keywords = [
-            # Временные маркеры
-            "сейчас", "текущий", "актуальный", "свежий", "недавний", 
-            "сегодня", "вчера", "последний", "новый", "обновленный",
-            "современный", "на данный момент", "в настоящее время",
-            "2023", "2024", "2025", "этот год", "этот месяц", "эта неделя",
-            "январь", "февраль", "март", "апрель", "май", "июнь",
-            "июль", "август", "сентябрь", "октябрь", "ноябрь", "декабрь",
-            
-            # Категории информации, требующие актуальных данных
-            "новости", "погода", "цена", "курс", "статистика", "данные", 
-            "обновление", "событие", "происшествие", "случилось",
-            
-            # Запросы о конкретных сущностях
-            "компания", "компаний", "организация", "технология", "продукт", 
-            "сервис", "приложение", "устройство", "гаджет",
-            
-            # Списки и рейтинги
-            "топ", "рейтинг", "список", "лидер", "самых", "лучших", "богатейших", 
-            "известных", "популярных", "дорогих", "крупнейших", "успешных",
-            
-            # Вопросы, требующие актуальной информации
-            "как сейчас", "что нового", "последние изменения", "текущая ситуация",
-            "как обстоят дела", "что происходит", "какие новости",
-            
-            # Финансовые и экономические запросы
-            "акции", "биржа", "валюта", "доллар", "евро", "рубль", "биткоин", "криптовалюта",
-            "инвестиции", "экономика", "инфляция", "ставка", "банк", "капитализация",
-            "рыночная стоимость", "стоимость", "цена акций", "выручка", "доход", "прибыль"
-        ]
-        
-        # Фразы, которые почти всегда требуют поиска
-        strong_indicators = [
-            "расскажи о", "что такое", "кто такой", "где находится", 
-            "как работает", "объясни", "опиши", "найди информацию",
-            "поищи", "узнай", "сколько стоит", "какая цена", "как купить",
-            "как сделать", "как использовать", "как применять", "инструкция",
-            "найди топ", "покажи топ", "рейтинг", "кто самый", "найди список",
-            "актуальный список", "текущий рейтинг", "на сегодня", "на текущий момент"
-        ]
-        '''
-
-        
-        # Весь код закомментирован, так как теперь мы всегда возвращаем True выше
-        '''
-        # Проверяем наличие сильных индикаторов
-        for indicator in strong_indicators:
-            if indicator in lower_input:
-                logger.info(f"Strong search indicator found: '{indicator}' in input: {processed_input}")
-                return True
-        
-        # Проверяем комбинации слов, указывающие на необходимость поиска актуальных данных
-        ranking_words = ["топ", "рейтинг", "список", "самых", "лучших"]
-        entity_words = ["компания", "компаний", "организация", "банк", "бренд"]
-        year_markers = ["2023", "2024", "2025", "год", "года"]
-        
-        # Ищем комбинации (рейтинг + сущность)
-        for rank_word in ranking_words:
-            for entity_word in entity_words:
-                if rank_word in lower_input and entity_word in lower_input:
-                    logger.info(f"Found ranking + entity combination: '{rank_word}' + '{entity_word}' in: {processed_input}")
-                    return True
-        
-        # Ищем комбинации (временной маркер + сущность)
-        for year in year_markers:
-            for entity_word in entity_words:
-                if year in lower_input and entity_word in lower_input:
-                    logger.info(f"Found year + entity combination: '{year}' + '{entity_word}' in: {processed_input}")
-                    return True
-        
-        # Проверяем наличие отдельных ключевых слов
-        for keyword in search_keywords:
-            if keyword in lower_input:
-                logger.info(f"Search keyword found: '{keyword}' in input: {processed_input}")
-                return True
-        
-        # Если запрос содержит год (цифры 2023, 2024, 2025 и т.д.), то вероятно нужен поиск
-        import re
-        if re.search(r'20[2-9][0-9]', lower_input):
-            logger.info(f"Year reference detected, enabling search for: {processed_input}")
-            return True
-        
-        # Если запрос длинный (более 50 символов), вероятно, это сложный вопрос, требующий поиска
-        if len(processed_input) > 50:
-            logger.info(f"Long query detected, enabling search for: {processed_input}")
-            return True
-        
-        # В случае сомнений, лучше выполнить поиск
-        if any(word in lower_input for word in ["актуальный", "последний", "текущий", "сейчас"]):
-            logger.info(f"Ambiguous query with recency indicators, enabling search: {processed_input}")
-            return True
-        
-        logger.info(f"No search indicators found for input: {processed_input}")
-        return False
-        '''
     except Exception as e:
         logger.error(f"Error determining if search is needed: {e}")
         # В случае ошибки лучше выполнить поиск
         return True
 
-def combine_input(processed_input, search_results):
+def combine_input(processed_input, search_results, token_budget=None):
     """
     Combine user input and search results for the LLM.
     
+    Only the variable parts (query, search results, query type) are returned; the
+    static instructions are sent by llm_api as a cached system prompt block. The
+    query is always kept; search sections are ranked by relevance to the query and
+    packed into the remaining token budget.
+    
     Args:
         processed_input (str): Processed user input
-        search_results (str): Results from the search API as text
+        search_results (SearchResult or str): Results from the search API
+        token_budget (int, optional): Prompt budget in tokens, PROMPT_TOKEN_BUDGET by default
         
     Returns:
         str: Combined input for the LLM
@@ -172,73 +96,50 @@ def combine_input(processed_input, search_results):
             logger.warning("No search results to combine")
             return f"Запрос пользователя: {processed_input}\n\nПожалуйста, ответь на этот запрос, используя свои знания."
         
-        # Теперь search_results - это готовый текст из поиска
-        search_text = search_results
+        # Строки принимаются для совместимости и разбираются на разделы один раз
+        if isinstance(search_results, str):
+            search_results = SearchResult(processed_input, [SubQueryResult.from_text(processed_input, search_results)])
+        search_model = search_results.model
         
-        # Анализируем запрос на предмет наличия временных маркеров будущего времени
-        future_date_request = False
-        import re
-        future_year_match = re.search(r'20(2[5-9]|[3-9][0-9])', processed_input.lower())
-        if future_year_match or any(word in processed_input.lower() for word in ["будущ", "следующ", "прогноз"]):
-            future_date_request = True
-            logger.info(f"Запрос содержит указание на будущую дату: {processed_input}")
+        # Все признаки запроса находим за один проход
+        markers = QUERY_MARKERS.match(processed_input)
         
-        # Проверяем наличие источников в тексте
-        has_sources = "источник" in search_text.lower() or "источники" in search_text.lower()
-        search_model = "sonar"  # Предполагаем, что мы используем модель sonar
+        if "future" in markers:
+            logger.info(f"Запрос содержит указание на будущую дату: {processed_input}")
         
         # Указываем модель поиска и дату
         from datetime import datetime
         current_date = datetime.now().strftime("%d.%m.%Y")
-        search_info = f"[Информация получена с помощью поисковой модели sonar по состоянию на {current_date}]"
-        
-        # Определяем ключевые индикаторы запроса для более точных инструкций LLM
-        contains_ranking = any(word in processed_input.lower() for word in ["топ", "рейтинг", "список", "самый", "лучший"])
-        contains_factual = any(word in processed_input.lower() for word in ["сколько", "где", "когда", "кто", "факт", "статистика"])
+        search_info = f"[Информация получена с помощью поисковой модели {search_model} по состоянию на {current_date}]"
+        if search_results.missing:
+            # Часть подзапросов осталась без результатов: Claude должен сказать об этом, а не додумывать
+            search_info += f"\n[Поиск не дал результатов по части запроса: {'; '.join(search_results.missing)}]"
         
-        # Создаем специальные инструкции в зависимости от типа запроса
-        special_instructions = ""
-        if future_date_request:
-            special_instructions = (
-                "ВАЖНО: Запрос касается будущего периода. Не делай предположений о будущем. "
-                "Используй ТОЛЬКО самые актуальные данные из поиска и явно укажи, что это последние доступные данные, "
-                "а не прогноз на запрашиваемый период. Чётко обозначь дату актуальности информации."
-            )
-        elif contains_ranking:
-            special_instructions = (
-                "ВАЖНО: Запрос касается рейтинга или списка. Приведи точный список из поисковых результатов. "
-                "Не изменяй порядок элементов и сохрани все числовые показатели. "
-                "Обязательно укажи источник данных и дату их актуальности."
-            )
-        elif contains_factual:
-            special_instructions = (
-                "ВАЖНО: Запрос требует фактической информации. Приведи точные данные из поисковых результатов. "
-                "Включи все релевантные числа, даты и факты. Избегай обобщений."
-            )
+        # Общие инструкции и требования по типам запросов неизменны и передаются в кэшируемом
+        # системном промпте (llm_api.SEARCH_INSTRUCTIONS); здесь указывается только тип запроса
+        query_type = next((name for name in ("future", "ranking", "factual") if name in markers), None)
         
-        # Создаем улучшенный промпт для LLM
-        combined_text = (
+        # Создаем промпт для LLM: только переменные части
+        header = (
             f"Запрос пользователя: {processed_input}\n\n"
-            f"АКТУАЛЬНАЯ ИНФОРМАЦИЯ ИЗ ИНТЕРНЕТА:\n{search_text}\n"
-            f"{search_info}\n\n"
-            f"ИНСТРУКЦИИ:\n"
-            f"1. Для ответа на запрос пользователя СТРОГО ИСПОЛЬЗУЙ предоставленную информацию из поиска.\n"
-            f"2. НИКОГДА не выдумывай факты и не дополняй информацию своими знаниями, когда отвечаешь на вопросы "
-            f"о текущих данных, рейтингах, ценах или событиях.\n"
-            f"3. Если в поисковых результатах есть противоречия, укажи это и приведи разные данные с источниками.\n"
-            f"4. Четко укажи временной период, к которому относятся данные, и приведи источники информации.\n"
-            f"5. Для запросов о будущих периодах всегда опирайся на последние известные данные и явно "
-            f"указывай, что это актуальная информация на текущий момент, а не прогноз.\n"
+            f"{SEARCH_RESULTS_HEADING}\n"
         )
-        
-        # Добавляем специальные инструкции, если они есть
-        if special_instructions:
-            combined_text += f"\n{special_instructions}\n"
-        
-        # Завершаем промпт
-        combined_text += "\nОтвет для пользователя:"
-        
-        logger.info("Successfully combined input and search results with enhanced structure and specific instructions")
+        footer = f"\n{search_info}\n"
+        if query_type:
+            footer += f"\nТип запроса: {QUERY_TYPES[query_type][0]}\n"
+        footer += "\nОтвет для пользователя:"
+        
+        # Результаты поиска получают бюджет, оставшийся после запроса и типа запроса
+        if token_budget is None:
+            token_budget = PROMPT_TOKEN_BUDGET
+        search_budget = max(token_budget - estimate_tokens(header + footer), 0)
+        packed = pack_search_results(processed_input, search_results, search_budget)
+        if packed.dropped_tokens:
+            logger.warning(f"Результаты поиска сокращены до {packed.tokens} токенов: отброшено {packed.dropped_tokens} токенов "
+                           f"({packed.dropped_sections} разделов) при бюджете {token_budget}")
+        combined_text = header + packed.text + footer
+        
+        logger.info("Successfully combined input and search results")
         return combined_text
     except Exception as e:
         logger.error(f"Error combining input and search results: {e}")
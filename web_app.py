@@ -6,12 +6,23 @@ import logging
 import sqlite3
 import json
 import uuid
+import re
+import base64
 import datetime
-from flask import Flask, request, jsonify, g, send_from_directory
+import threading
+from flask import Flask, Response, request, jsonify, g, send_from_directory, stream_with_context
 from flask_cors import CORS
-from llm_api import query_llm
-from search_api import search_perplexity
+from llm_api import query_llm, get_llm_usage_stats
+from search_api import search_perplexity, stream_search
 from utils import process_input, format_output, needs_search, combine_input
+from http_client import prewarm
+from search_cache import get_cache_stats
+from singleflight import get_single_flight_stats
+from prompt_budget import get_prompt_budget_stats
+from rate_limiter import get_rate_limiter_stats
+from retry_policy import get_retry_stats
+from circuit_breaker import get_breaker_stats
+from deadline import deadline_scope, current_deadline, get_deadline_stats, DEGRADE_MODES, NO_SEARCH, SUMMARY
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения из .env файла
@@ -44,31 +55,98 @@ TEST_MODE = False
 DB_PATH = os.getenv('DB_PATH', os.path.dirname(__file__))
 DATABASE = os.path.join(DB_PATH, 'chat_history.db')
 
+# Срок обработки запроса по умолчанию для маршрутов (секунд); запрос может задать свой в поле deadline
+QUERY_DEADLINE = float(os.getenv('QUERY_DEADLINE', '40'))
+QUERY_STREAM_DEADLINE = float(os.getenv('QUERY_STREAM_DEADLINE', '40'))
+SEARCH_STREAM_DEADLINE = float(os.getenv('SEARCH_STREAM_DEADLINE', '30'))
+
 # Примечание: SQLite подходит для небольших приложений, но для продакшена на VPS
 # рекомендуется использовать более надежные решения, такие как PostgreSQL или MySQL
 
+# Сколько ждать, пока другой процесс или поток закончит запись, прежде чем вернуть "database is locked"
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', '5'))
+# Размер файла базы, читаемого через отображение в память (байт); 0 отключает mmap
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', str(64 * 1024 * 1024)))
+
+# Запросы к базе чатов - постоянные строки: sqlite3 кэширует подготовленные выражения
+# в каждом соединении по тексту запроса и не компилирует их повторно
+INSERT_CHAT_SQL = 'INSERT INTO chats (id, session_id, timestamp, user_input, response, search_performed, test_mode) VALUES (?, ?, ?, ?, ?, ?, ?)'
+# Страница истории - только id, время и начало запроса; сортировка и условие курсора
+# совпадают с индексом (session_id, timestamp, id), поэтому страница читается по индексу
+# за одно и то же время, сколько бы чатов ни было в таблице
+HISTORY_COLUMNS_SQL = 'SELECT id, timestamp, substr(user_input, 1, ?) AS query FROM chats'
+SELECT_HISTORY_SQL = HISTORY_COLUMNS_SQL + ' WHERE session_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?'
+SELECT_HISTORY_AFTER_SQL = HISTORY_COLUMNS_SQL + ' WHERE session_id = ? AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?'
+SELECT_CHAT_SQL = 'SELECT * FROM chats WHERE id = ? AND session_id = ?'
+DELETE_CHAT_SQL = 'DELETE FROM chats WHERE id = ? AND session_id = ?'
+
+# Размер страницы истории по умолчанию и наибольший, который может запросить клиент
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '20'))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv('HISTORY_MAX_PAGE_SIZE', '100'))
+# Сколько символов запроса показывается в списке истории
+HISTORY_PREVIEW_CHARS = int(os.getenv('HISTORY_PREVIEW_CHARS', '100'))
+
+# Сессия пользователя: заголовок X-Session-Id или cookie, которую сервер выдает при первом запросе
+SESSION_COOKIE = 'session_id'
+SESSION_HEADER = 'X-Session-Id'
+SESSION_MAX_AGE = 365 * 24 * 3600
+_session_id_pattern = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+
+# Каждый поток держит одно соединение на все время работы, а не открывает новое на каждый запрос
+_db_local = threading.local()
+
+def _connect_db():
+    """Открывает соединение с базой чатов: журнал WAL, synchronous=NORMAL, mmap и ожидание блокировки."""
+    db = sqlite3.connect(DATABASE, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    # В режиме WAL чтение истории не ждет записи нового чата, а запись не ждет чтения
+    db.execute('PRAGMA journal_mode=WAL')
+    # С WAL synchronous=NORMAL не теряет целостность при сбое, но не вызывает fsync на каждый commit
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+    db.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}')
+    return db
+
 def get_db():
-    """Соединение с базой данных на протяжении запроса."""
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
+    """Соединение с базой данных текущего потока."""
+    db = getattr(_db_local, 'db', None)
+    # После fork (рабочие процессы serve.py) соединение родителя использовать нельзя, открываем новое
+    if db is None or _db_local.pid != os.getpid():
+        db = _db_local.db = _connect_db()
+        _db_local.pid = os.getpid()
     return db
 
 @app.teardown_appcontext
 def close_connection(exception):
-    """Закрываем соединение с базой данных в конце запроса."""
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    """Соединение остается открытым; транзакцию, прерванную ошибкой, откатываем, чтобы не держать блокировку."""
+    db = getattr(_db_local, 'db', None)
+    if db is not None and db.in_transaction:
+        db.rollback()
+
+def migrate_db(db):
+    """Добавляет в таблицу чатов, созданную старой версией схемы, колонку session_id.
+
+    Чаты, сохраненные до миграции, получают пустую сессию и в историю пользователей не попадают."""
+    columns = {row['name'] for row in db.execute('PRAGMA table_info(chats)')}
+    if columns and 'session_id' not in columns:
+        logger.info("Миграция базы чатов: добавляю колонку session_id")
+        db.execute("ALTER TABLE chats ADD COLUMN session_id TEXT NOT NULL DEFAULT ''")
+        db.commit()
 
 def init_db():
     """Инициализация базы данных."""
-    with app.app_context():
-        db = get_db()
-        with app.open_resource('schema.sql', mode='r') as f:
-            db.cursor().executescript(f.read())
-        db.commit()
+    db = get_db()
+    # Индекс по session_id из schema.sql можно создать только после миграции старой таблицы
+    migrate_db(db)
+    with app.open_resource('schema.sql', mode='r') as f:
+        db.executescript(f.read())
+    db.commit()
+
+def write_db(query, args=()):
+    """Выполнение изменяющего запроса в отдельной транзакции."""
+    db = get_db()
+    with db:
+        db.execute(query, args)
 
 def query_db(query, args=(), one=False):
     """Выполнение запроса к базе данных."""
@@ -77,35 +155,148 @@ def query_db(query, args=(), one=False):
     cur.close()
     return (rv[0] if rv else None) if one else rv
 
-def save_chat(user_input, response, search_performed, test_mode):
+def save_chat(user_input, response, search_performed, test_mode, session_id=''):
     """Сохранение сообщения чата в базу данных."""
-    db = get_db()
     chat_id = str(uuid.uuid4())
     timestamp = datetime.datetime.now().isoformat()
     
-    db.execute(
-        'INSERT INTO chats (id, timestamp, user_input, response, search_performed, test_mode) VALUES (?, ?, ?, ?, ?, ?)',
-        (chat_id, timestamp, user_input, response, 1 if search_performed else 0, 1 if test_mode else 0)
-    )
-    db.commit()
+    write_db(INSERT_CHAT_SQL, (chat_id, session_id, timestamp, user_input, response, 1 if search_performed else 0, 1 if test_mode else 0))
     return chat_id
 
-def get_chat_history():
-    """Получение истории чатов."""
-    chats = query_db('SELECT * FROM chats ORDER BY timestamp DESC')
-    return [dict(chat) for chat in chats]
+def encode_cursor(chat):
+    """Курсор страницы истории: время и id последнего чата на странице."""
+    return base64.urlsafe_b64encode(f"{chat['timestamp']}|{chat['id']}".encode()).decode()
+
+def decode_cursor(cursor):
+    """Разбирает курсор страницы истории; ValueError, если курсор испорчен."""
+    try:
+        timestamp, chat_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|', 1)
+    except (ValueError, UnicodeError):
+        raise ValueError("Некорректный курсор истории")
+    return timestamp, chat_id
+
+def get_chat_history(session_id, limit=HISTORY_PAGE_SIZE, cursor=None):
+    """
+    Получение страницы истории чатов сессии, от новых к старым.
+    
+    Args:
+        session_id (str): Сессия пользователя
+        limit (int): Число чатов на странице
+        cursor (str, optional): Курсор из предыдущей страницы
+        
+    Returns:
+        tuple: (список чатов - id, timestamp и начало запроса query; курсор следующей страницы или None)
+    """
+    # Лишняя строка показывает, есть ли следующая страница
+    if cursor:
+        timestamp, chat_id = decode_cursor(cursor)
+        chats = query_db(SELECT_HISTORY_AFTER_SQL, (HISTORY_PREVIEW_CHARS, session_id, timestamp, chat_id, limit + 1))
+    else:
+        chats = query_db(SELECT_HISTORY_SQL, (HISTORY_PREVIEW_CHARS, session_id, limit + 1))
+    chats = [dict(chat) for chat in chats]
+    next_cursor = encode_cursor(chats[limit - 1]) if len(chats) > limit else None
+    return chats[:limit], next_cursor
 
-def get_chat_by_id(chat_id):
-    """Получение чата по ID."""
-    chat = query_db('SELECT * FROM chats WHERE id = ?', [chat_id], one=True)
+def get_chat_by_id(chat_id, session_id):
+    """Получение полного чата сессии по ID."""
+    chat = query_db(SELECT_CHAT_SQL, [chat_id, session_id], one=True)
     return dict(chat) if chat else None
 
+def current_session_id():
+    """Сессия текущего запроса; если клиент ее не передал, создается новая и отправляется в cookie."""
+    session_id = getattr(g, 'session_id', None)
+    if session_id is None:
+        session_id = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+        if not session_id or not _session_id_pattern.match(session_id):
+            session_id = g.new_session_id = uuid.uuid4().hex
+        g.session_id = session_id
+    return session_id
+
+@app.after_request
+def set_session_cookie(response):
+    """Отправляет клиенту cookie с новой сессией."""
+    session_id = getattr(g, 'new_session_id', None)
+    if session_id:
+        response.set_cookie(SESSION_COOKIE, session_id, max_age=SESSION_MAX_AGE, httponly=True, samesite='Lax')
+    return response
+
 @app.route('/', methods=['GET'])
 def home():
     """Serve the React app - only in production.
     In development, React app is served by its own dev server."""
     return send_from_directory(app.static_folder, 'index.html')
 
+def deadline_params(data, default):
+    """
+    Читает срок запроса и режим деградации из тела запроса.
+    
+    Args:
+        data (dict): Тело запроса с необязательными полями deadline (секунд) и degrade
+        default (float): Срок по умолчанию для маршрута
+        
+    Returns:
+        tuple: (срок в секундах, режим деградации или None)
+        
+    Raises:
+        ValueError: Срок не положительное число или режим неизвестен
+    """
+    seconds = float(data.get('deadline') or default)
+    degrade = data.get('degrade')
+    if seconds <= 0:
+        raise ValueError("deadline должен быть положительным числом секунд")
+    if degrade is not None and degrade not in DEGRADE_MODES:
+        raise ValueError(f"degrade должен быть одним из: {', '.join(DEGRADE_MODES)}")
+    return seconds, degrade
+
+def search_summary(search_results):
+    """Ответ из найденных результатов без обработки Claude (деградация по сроку)."""
+    return "Ответ не успел сформироваться к сроку, ниже приведены найденные результаты поиска.\n\n" + search_results.render()
+
+def summary_instead_of_answer(search_results):
+    """Нужно ли по сроку запроса вернуть результаты поиска вместо ответа Claude."""
+    deadline = current_deadline()
+    if deadline is None or not search_results:
+        return False
+    if "llm_timeout" in deadline.events:
+        return True
+    return deadline.degrade == SUMMARY and "search_timeout" in deadline.events
+
+def prepare_llm_input(processed_input, test_mode):
+    """
+    Выполняет поиск (если он нужен) и собирает входной текст для LLM.
+    
+    Если поиск не успел завершиться к сроку запроса, в режиме no_search его
+    результаты отбрасываются, в остальных режимах используются пришедшие.
+    
+    Args:
+        processed_input (str): Обработанный запрос пользователя
+        test_mode (bool): Тестовый режим без обращения к API
+        
+    Returns:
+        tuple: (входной текст для LLM, SearchResult или None, если поиск не выполнялся)
+    """
+    search_results = None
+    
+    # Поиск пропускается только для запросов, на которые модель уверенно ответит сама
+    if needs_search(processed_input):
+        logger.info(f"Выполняю поиск для запроса: {processed_input}")
+        search_results = search_perplexity(processed_input, test_mode=test_mode)
+        
+        deadline = current_deadline()
+        if search_results and deadline and deadline.degrade == NO_SEARCH and "search_timeout" in deadline.events:
+            logger.warning("Поиск не успел завершиться к сроку, отвечаю без результатов поиска")
+            search_results = None
+        
+        if search_results:
+            logger.info(f"Получены результаты поиска: {len(search_results.subqueries)} подзапросов, {len(search_results.sources)} источников")
+        else:
+            logger.warning(f"Поиск выполнен, но результаты не получены для запроса: {processed_input}")
+    
+    # Combine input and search results
+    llm_input = combine_input(processed_input, search_results)
+    logger.info(f"Подготовлен запрос к LLM длиной {len(llm_input)} символов")
+    return llm_input, search_results
+
 @app.route('/api/query', methods=['POST'])
 def api_query():
     """API endpoint to process user queries."""
@@ -120,44 +311,40 @@ def api_query():
         if not user_input:
             return jsonify({'error': 'No query provided'}), 400
         
+        try:
+            seconds, degrade = deadline_params(data, QUERY_DEADLINE)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         # Process the input
         processed_input = process_input(user_input)
         if not processed_input:
             return jsonify({'error': 'Error processing input'}), 500
         
-        # Determine if search is needed
-        search_performed = False
-        search_results = ""
-        
-        # Всегда выполняем поиск, так как needs_search всегда возвращает True
-        if needs_search(processed_input):
-            logger.info(f"Выполняю поиск для запроса: {processed_input}")
-            search_results = search_perplexity(processed_input, test_mode=test_mode)
+        # Поиск и ответ Claude укладываются в срок запроса
+        with deadline_scope(seconds, degrade) as deadline:
+            # Determine if search is needed and combine input and search results
+            llm_input, search_results = prepare_llm_input(processed_input, test_mode)
             search_performed = bool(search_results)
             
-            if search_results:
-                logger.info(f"Получены результаты поиска длиной {len(search_results)} символов")
+            # Query the LLM - не используем параметр test_mode для совместимости с серверной версией
+            # Если нужен тестовый режим, обрабатываем его отдельно
+            if test_mode:
+                # Генерируем тестовый ответ без прямого использования test_mode в query_llm
+                from llm_api import generate_test_response
+                response = generate_test_response(processed_input)
+            elif summary_instead_of_answer(search_results):
+                response = search_summary(search_results)
             else:
-                logger.warning(f"Поиск выполнен, но результаты не получены для запроса: {processed_input}")
-        
-        # Combine input and search results
-        llm_input = combine_input(processed_input, search_results)
-        logger.info(f"Подготовлен запрос к LLM длиной {len(llm_input)} символов")
-        
-        # Query the LLM - не используем параметр test_mode для совместимости с серверной версией
-        # Если нужен тестовый режим, обрабатываем его отдельно
-        if test_mode:
-            # Генерируем тестовый ответ без прямого использования test_mode в query_llm
-            from llm_api import generate_test_response
-            response = generate_test_response(processed_input)
-        else:
-            response = query_llm(llm_input, detect_search_needs=False)
+                response = query_llm(llm_input, detect_search_needs=False)
+                if summary_instead_of_answer(search_results):
+                    response = search_summary(search_results)
         
         # Format the response
         formatted_response = format_output(response)
         
         # Сохраняем диалог в базу данных
-        chat_id = save_chat(user_input, formatted_response, search_performed, test_mode)
+        chat_id = save_chat(user_input, formatted_response, search_performed, test_mode, current_session_id())
         
         # Return the response
         return jsonify({
@@ -165,6 +352,8 @@ def api_query():
             'query': user_input,
             'response': formatted_response,
             'search_performed': search_performed,
+            'sources': search_results.sources if search_performed else [],
+            'degraded': deadline.events,
             'test_mode': test_mode,
             'timestamp': datetime.datetime.now().isoformat()
         })
@@ -173,6 +362,116 @@ def api_query():
         logger.error(f"Error processing API request: {e}")
         return jsonify({'error': str(e)}), 500
 
+def sse_event(event, payload):
+    """Форматирует событие Server-Sent Events с JSON-данными."""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.route('/api/query/stream', methods=['POST'])
+def api_query_stream():
+    """API endpoint to process user queries with the answer streamed as Server-Sent Events.
+    
+    События: meta (выполнен ли поиск, источники), token (очередной фрагмент ответа),
+    done (id сохраненного чата), error."""
+    data = request.json
+    user_input = data.get('query', '')
+    test_mode = data.get('test_mode', TEST_MODE)
+    
+    if not user_input:
+        return jsonify({'error': 'No query provided'}), 400
+    
+    try:
+        seconds, degrade = deadline_params(data, QUERY_STREAM_DEADLINE)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    processed_input = process_input(user_input)
+    if not processed_input:
+        return jsonify({'error': 'Error processing input'}), 500
+    
+    # Сессия определяется до начала потока, чтобы cookie попала в заголовки ответа
+    session_id = current_session_id()
+    
+    def generate():
+        try:
+            # Срок ограничивает поиск и начало ответа; уже идущий поток ответа не обрывается
+            with deadline_scope(seconds, degrade) as deadline:
+                llm_input, search_results = prepare_llm_input(processed_input, test_mode)
+                search_performed = bool(search_results)
+                yield sse_event('meta', {
+                    'query': user_input,
+                    'search_performed': search_performed,
+                    'sources': search_results.sources if search_performed else [],
+                    'degraded': list(deadline.events),
+                    'test_mode': test_mode
+                })
+                
+                if test_mode:
+                    from llm_api import generate_test_response
+                    chunks = [generate_test_response(processed_input)]
+                elif summary_instead_of_answer(search_results):
+                    chunks = [search_summary(search_results)]
+                else:
+                    chunks = query_llm(llm_input, stream=True)
+                
+                parts = []
+                for chunk in chunks:
+                    parts.append(chunk)
+                    yield sse_event('token', {'text': chunk})
+            
+            # Сохраняем итоговый текст только после завершения потока
+            formatted_response = format_output("".join(parts))
+            chat_id = save_chat(user_input, formatted_response, search_performed, test_mode, session_id)
+            yield sse_event('done', {
+                'id': chat_id,
+                'response': formatted_response,
+                'degraded': deadline.events,
+                'timestamp': datetime.datetime.now().isoformat()
+            })
+        except Exception as e:
+            logger.error(f"Error processing streaming API request: {e}")
+            yield sse_event('error', {'error': str(e)})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/search/stream', methods=['POST'])
+def api_search_stream():
+    """Потоковый поиск: результаты подзапросов отправляются как Server-Sent Events по мере готовности.
+    
+    События: plan (список подзапросов), token (фрагмент ответа Perplexity, если stream_tokens),
+    result (результат подзапроса с источниками), done, error. Поиск ограничен сроком
+    SEARCH_STREAM_DEADLINE или полем deadline запроса."""
+    data = request.json
+    user_input = data.get('query', '')
+    test_mode = data.get('test_mode', TEST_MODE)
+    stream_tokens = bool(data.get('stream_tokens', False))
+    
+    processed_input = process_input(user_input) if user_input else None
+    if not processed_input:
+        return jsonify({'error': 'No query provided'}), 400
+    
+    try:
+        seconds, _ = deadline_params(data, SEARCH_STREAM_DEADLINE)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    def generate():
+        try:
+            # Claude здесь не вызывается, поэтому поиску достается весь срок
+            with deadline_scope(seconds, llm_reserve=0):
+                for event in stream_search(processed_input, test_mode=test_mode, stream_tokens=stream_tokens):
+                    yield sse_event(event['type'], event)
+        except Exception as e:
+            logger.error(f"Ошибка потокового поиска: {e}")
+            yield sse_event('error', {'error': str(e)})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 # Функция для обеспечения наличия build директории для React-приложения
 def ensure_react_build_directory():
     """Проверяет наличие build директории для React-приложения и создает её при необходимости."""
@@ -186,12 +485,15 @@ def ensure_schema_file():
     schema_content = '''
 CREATE TABLE IF NOT EXISTS chats (
     id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL DEFAULT '',
     timestamp TEXT NOT NULL,
     user_input TEXT NOT NULL,
     response TEXT NOT NULL,
     search_performed INTEGER NOT NULL,
     test_mode INTEGER NOT NULL
 );
+
+CREATE INDEX IF NOT EXISTS idx_chats_session_timestamp ON chats (session_id, timestamp, id);
 '''
     
     # Проверяем, существует ли файл схемы
@@ -248,16 +550,37 @@ def toggle_test_mode():
         'message': f"Тестовый режим {'включен' if TEST_MODE else 'выключен'}"
     })
 
+# Метрики производительности для мониторинга
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Получить счетчики кэша поиска, объединения одинаковых запросов, упаковки промптов, токенов Claude, ограничителей, повторов запросов, автоматов отключения и сроков запросов"""
+    return jsonify({
+        'search_cache': get_cache_stats(),
+        'single_flight': get_single_flight_stats(),
+        'prompt_budget': get_prompt_budget_stats(),
+        'llm_usage': get_llm_usage_stats(),
+        'rate_limits': get_rate_limiter_stats(),
+        'retries': get_retry_stats(),
+        'circuit_breakers': get_breaker_stats(),
+        'deadlines': get_deadline_stats()
+    })
+
 # Маршруты для работы с историей чатов
 @app.route('/api/history', methods=['GET'])
 def get_history():
-    """Получить историю чатов"""
+    """Получить страницу истории чатов сессии: параметры limit и cursor (next_cursor предыдущей страницы)"""
     try:
-        history = get_chat_history()
+        limit = int(request.args.get('limit', HISTORY_PAGE_SIZE))
+        if not 1 <= limit <= HISTORY_MAX_PAGE_SIZE:
+            raise ValueError(f"limit должен быть от 1 до {HISTORY_MAX_PAGE_SIZE}")
+        history, next_cursor = get_chat_history(current_session_id(), limit, request.args.get('cursor'))
         return jsonify({
             'success': True,
-            'history': history
+            'history': history,
+            'next_cursor': next_cursor
         })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Ошибка при получении истории чатов: {e}")
         return jsonify({'error': str(e)}), 500
@@ -266,7 +589,7 @@ def get_history():
 def get_chat(chat_id):
     """Получить конкретный чат по ID"""
     try:
-        chat = get_chat_by_id(chat_id)
+        chat = get_chat_by_id(chat_id, current_session_id())
         if chat:
             return jsonify({
                 'success': True,
@@ -282,9 +605,7 @@ def get_chat(chat_id):
 def delete_chat(chat_id):
     """Удалить чат по ID"""
     try:
-        db = get_db()
-        db.execute('DELETE FROM chats WHERE id = ?', [chat_id])
-        db.commit()
+        write_db(DELETE_CHAT_SQL, [chat_id, current_session_id()])
         return jsonify({
             'success': True,
             'message': 'Чат успешно удален'
@@ -312,7 +633,18 @@ def build_react_app():
         print(f"Ошибка при сборке React-приложения: {e}")
         return False
 
-if __name__ == '__main__':
+def prepare_app(prewarm_pools=True):
+    """
+    Готовит приложение к запуску: схема и база данных, проверка API ключей, сборка React.
+    
+    Вызывается и при запуске сервера разработки, и из serve.py.
+    
+    Args:
+        prewarm_pools (bool): Прогреть пулы соединений к внешним сервисам в фоновом потоке.
+            serve.py прогревает их в каждом рабочем процессе после fork
+    """
+    global TEST_MODE
+    
     # Выводим информацию о расположении базы данных
     print(f"База данных будет размещена по пути: {DATABASE}")
     if os.getenv('DB_PATH'):
@@ -346,6 +678,9 @@ if __name__ == '__main__':
         print("Автоматически включен тестовый режим. Для полноценной работы установите API ключи.")
     else:
         print("API ключи найдены. Приложение работает в обычном режиме.")
+        if prewarm_pools:
+            # Прогреваем пулы соединений к Perplexity и Anthropic в фоне, не задерживая запуск
+            threading.Thread(target=prewarm, daemon=True).start()
     
         # Создаем директорию для React-сборки, если она не существует
     ensure_react_build_directory()
@@ -365,6 +700,9 @@ if __name__ == '__main__':
     
     # Для сборки React-приложения раскомментируйте эту строку
     # build_react_app()
+
+if __name__ == '__main__':
+    prepare_app()
     
-    # Run the Flask app
+    # Сервер разработки с перезагрузкой и отладчиком; для продакшена используйте serve.py
     app.run(debug=True, host='0.0.0.0', port=5001)